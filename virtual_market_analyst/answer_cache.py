@@ -0,0 +1,127 @@
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import config
+
+# Semantic cache of the chatbot's first RAG answer, shared by every session in the process.
+#
+# An answer is reused when a new question
+#   - was asked for the same start_date / end_date / iso
+#   - retrieved exactly the same set of parent documents (semi_chunked_ids)
+#   - has a prompt embedding within similarity_threshold (cosine) of the cached question
+#
+# [answer_cache]
+# enabled = true
+# similarity_threshold = 0.97
+# ttl_seconds = 21600
+# max_entries = 500
+
+
+def normalise(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticAnswerCache:
+    def __init__(self, similarity_threshold, ttl_seconds, max_entries):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        # entry id --> entry, oldest used first
+        self.entries = OrderedDict()
+        # (start_date, end_date, iso, parent ids) --> entry ids, so a lookup only compares vectors within its own bucket
+        self.buckets = {}
+        self.next_id = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def bucket_key(start_date, end_date, iso, parent_ids):
+        return (start_date, end_date, iso, frozenset(str(_id) for _id in parent_ids))
+
+    def _remove(self, entry_id):
+        entry = self.entries.pop(entry_id)
+        bucket = self.buckets[entry['bucket']]
+        bucket.remove(entry_id)
+        if not bucket:
+            del self.buckets[entry['bucket']]
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl_seconds
+        for entry_id in [entry_id for entry_id, entry in self.entries.items() if entry['created_at'] < cutoff]:
+            self._remove(entry_id)
+
+    # returns the cached {'answer', 'context'} or None
+    def get(self, prompt_vector, start_date, end_date, iso, parent_ids):
+        query = normalise(prompt_vector)
+        key = self.bucket_key(start_date, end_date, iso, parent_ids)
+
+        with self.lock:
+            self._expire()
+
+            best_id = None
+            best_score = self.similarity_threshold
+            for entry_id in self.buckets.get(key, []):
+                score = float(self.entries[entry_id]['vector'] @ query)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(best_id)
+            entry = self.entries[best_id]
+            return {'answer': entry['answer'], 'context': entry['context'], 'similarity': best_score}
+
+    def put(self, prompt_vector, start_date, end_date, iso, parent_ids, answer, context):
+        key = self.bucket_key(start_date, end_date, iso, parent_ids)
+
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+
+            self.entries[entry_id] = {
+                'vector': normalise(prompt_vector),
+                'bucket': key,
+                'answer': answer,
+                'context': context,
+                'created_at': time.time()
+            }
+            self.buckets.setdefault(key, []).append(entry_id)
+
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+# one cache per process, shared by every session
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def enabled():
+    return config.get_setting("answer_cache", "enabled", True)
+
+
+def get_answer_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SemanticAnswerCache(
+                config.get_setting("answer_cache", "similarity_threshold", 0.97),
+                config.get_setting("answer_cache", "ttl_seconds", 21600),
+                config.get_setting("answer_cache", "max_entries", 500)
+            )
+        return _cache
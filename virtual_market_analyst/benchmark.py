@@ -0,0 +1,504 @@
+import sys
+import json
+import time
+import base64
+import random
+import hashlib
+import argparse
+import resource
+import threading
+import tracemalloc
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from bson import ObjectId
+
+import chat
+import config
+import prompts
+import pipeline
+import context_builder
+import retrieval
+import local_index
+import embedding_cache
+
+# Offline benchmark of the retrieval and chat pipelines.
+#
+#   python benchmark.py                                   --> 10k, 100k and 1M chunk corpora
+#   python benchmark.py --sizes 10000 --queries 50 --backend local --json results.json
+#
+# Nothing talks to Atlas or OpenAI:
+#   - the Chunked / NonChunked collections are an in-memory stand-in over a synthetic corpus with realistic
+#     date / tags / semi_chunked_id fields ($vectorSearch is answered by an exact NumPy search)
+#   - the OpenAI client is pointed at a local HTTP server returning deterministic embeddings and canned chat answers,
+#     with configurable latency, so the real client / connection pool code is exercised
+#
+# For every corpus size it reports per-stage latency percentiles (embed, filter, search, parents, context, chat),
+# end-to-end throughput at the given concurrency, and memory (corpus size, peak RSS and optionally per-stage allocations).
+
+STAGES = ('embed', 'filter', 'search', 'parents', 'context', 'chat', 'retrieve_total', 'rag_total')
+
+ISO_TAGS = [iso.lower() for iso in retrieval.ISOS if iso != 'N/A']
+EXTRA_TAGS = ['natural gas', 'power', 'lng', 'weather']
+WORDS = "gas power demand supply storage injection withdrawal hdds cdds heat cold front lng export terminal feedgas outage pipeline production rig count basis spread forward curve positioning speculators managed money data center load growth".split()
+
+
+def fake_embedding(text, dims):
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dims).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def fake_text(seed, words):
+    rng = random.Random(seed)
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+############################################################################################### Fake OpenAI Server ##################################################################################################################
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately; without this every response waits on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path.endswith("/embeddings"):
+            self.embeddings(request)
+        elif self.path.endswith("/chat/completions"):
+            self.chat_completions(request)
+        else:
+            self.send_error(404)
+
+    def embeddings(self, request):
+        settings = self.server.settings
+        time.sleep(settings['embed_latency'])
+
+        texts = request['input'] if isinstance(request['input'], list) else [request['input']]
+        data = []
+        for index, text in enumerate(texts):
+            vector = fake_embedding(text, request.get('dimensions') or settings['dims'])
+            if request.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(vector.tobytes()).decode('ascii')
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+
+        tokens = sum(len(text.split()) for text in texts)
+        self.send_json({"object": "list", "data": data, "model": request['model'], "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+    def chat_completions(self, request):
+        settings = self.server.settings
+        prompt_tokens = sum(len(message['content']) // 4 for message in request['messages'])
+        answer_tokens = [word + ' ' for word in fake_text(prompt_tokens, settings['answer_tokens']).split()]
+
+        time.sleep(settings['chat_latency'])
+
+        if not request.get('stream'):
+            time.sleep(settings['token_latency'] * len(answer_tokens))
+            self.send_json({
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request['model'],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": ''.join(answer_tokens)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(answer_tokens), "total_tokens": prompt_tokens + len(answer_tokens)}
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for token in answer_tokens + [None]:
+            time.sleep(settings['token_latency'])
+            chunk = {
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request['model'],
+                "choices": [{"index": 0, "delta": {} if token is None else {"content": token}, "finish_reason": "stop" if token is None else None}]
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+        if (request.get('stream_options') or {}).get('include_usage'):
+            usage = {
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request['model'],
+                "choices": [],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(answer_tokens), "total_tokens": prompt_tokens + len(answer_tokens)}
+            }
+            self.wfile.write(f"data: {json.dumps(usage)}\n\n".encode('utf-8'))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+def start_fake_openai_server(settings):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.settings = settings
+    threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+############################################################################################### Fake MongoDB ##################################################################################################################
+
+# column store standing in for Chunked; only the query shapes the apps generate are supported
+class FakeChunked:
+    def __init__(self, vectors, dates, tag_masks, parent_numbers):
+        self.vectors = vectors
+        self.dates = dates
+        self.tag_masks = tag_masks
+        self.parent_numbers = parent_numbers
+
+    def filter_mask(self, vector_filter):
+        mask = np.ones(len(self.dates), dtype=bool)
+        if vector_filter is None:
+            return mask
+
+        clauses = vector_filter['$and'] if '$and' in vector_filter else [vector_filter]
+        for clause in clauses:
+            if 'date' in clause:
+                start = np.datetime64(clause['date']['$gte'], 's')
+                end = np.datetime64(clause['date']['$lte'], 's')
+                mask &= (self.dates >= start) & (self.dates <= end)
+            if 'tags' in clause:
+                tag_mask = np.zeros(len(self.dates), dtype=bool)
+                for tag in clause['tags']['$in']:
+                    tag_mask |= self.tag_masks.get(tag, np.zeros(len(self.dates), dtype=bool))
+                mask &= tag_mask
+        return mask
+
+    def chunk_document(self, row, score):
+        return {
+            '_id': ObjectId(f"{row:024x}"),
+            'source': f"Synthetic Wire {self.parent_numbers[row] % 50}",
+            'contents': fake_text(row, 60),
+            'semi_chunked_id': ObjectId(f"{int(self.parent_numbers[row]):024x}"),
+            'date': self.dates[row].astype(dt.datetime),
+            'vector': self.vectors[row],
+            'score': score
+        }
+
+    def aggregate(self, pipeline_stages):
+        search = pipeline_stages[0]['$vectorSearch']
+        rows = np.flatnonzero(self.filter_mask(search.get('filter')))
+        if len(rows) == 0:
+            return iter([])
+
+        query = np.asarray(search['queryVector'], dtype=np.float32)
+        scores = self.vectors[rows] @ (query / np.linalg.norm(query))
+        k = min(search['limit'], len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        projection = pipeline_stages[1]['$project'] if len(pipeline_stages) > 1 else {}
+        results = []
+        for position in top:
+            document = self.chunk_document(int(rows[position]), float(scores[position]))
+            if projection:
+                document = {
+                    field: document['score'] if isinstance(value, dict) else document[field]
+                    for field, value in projection.items() if value
+                }
+            results.append(document)
+        return iter(results)
+
+    # the chunk contents lookup for local index hits
+    def find(self, query, projection=None):
+        rows = [int(str(_id), 16) for _id in query['_id']['$in']]
+        return [{'_id': ObjectId(f"{row:024x}"), 'contents': fake_text(row, 60)} for row in rows if row < len(self.dates)]
+
+    def find_one(self, query, projection=None, sort=None):
+        rows = np.flatnonzero(self.filter_mask(query))
+        if len(rows) == 0:
+            return None
+        return {'_id': ObjectId(f"{int(rows.max()):024x}")}
+
+
+class FakeNonChunked:
+    def __init__(self, parent_count, parent_words):
+        self.parent_count = parent_count
+        self.parent_words = parent_words
+
+    def find(self, query, projection=None):
+        documents = []
+        for _id in query['_id']['$in']:
+            number = int(str(_id), 16)
+            if number < self.parent_count:
+                documents.append({'_id': _id, 'source': f"Synthetic Wire {number % 50}", 'contents': fake_text(-number - 1, self.parent_words)})
+        return documents
+
+    def find_one(self, query, projection=None, sort=None):
+        return {'_id': ObjectId(f"{self.parent_count - 1:024x}")}
+
+
+class FakeDatabase:
+    def __init__(self, collections):
+        self.collections = collections
+
+    def __getitem__(self, name):
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        try:
+            return self.collections[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+def build_corpus(size, dims, months, chunks_per_parent, parent_words, seed):
+    rng = np.random.default_rng(seed)
+
+    vectors = rng.standard_normal((size, dims), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    # spread evenly over the last `months` months, sorted by date like the local index expects
+    end = np.datetime64(dt.date.today(), 's')
+    start = end - np.timedelta64(months * 30, 'D')
+    dates = np.sort(start + (rng.random(size) * (end - start).astype(np.int64)).astype('timedelta64[s]'))
+
+    # most commentaries carry one or two ISO tags, some none
+    tag_masks = {tag: rng.random(size) < 0.3 for tag in ISO_TAGS}
+    for tag in EXTRA_TAGS:
+        tag_masks[tag] = rng.random(size) < 0.5
+
+    parent_numbers = np.arange(size) // chunks_per_parent
+    parent_count = int(parent_numbers[-1]) + 1
+
+    db = FakeDatabase({
+        'Chunked': FakeChunked(vectors, dates, tag_masks, parent_numbers),
+        'NonChunked': FakeNonChunked(parent_count, parent_words)
+    })
+
+    tag_rows = {tag: np.flatnonzero(mask) for tag, mask in tag_masks.items()}
+    index = local_index.LocalVectorIndex(
+        vectors,
+        dates,
+        np.array([f"{int(number):024x}" for number in parent_numbers]),
+        np.array([f"{row:024x}" for row in range(size)]),
+        tag_rows
+    )
+    return db, index
+
+
+############################################################################################### Measurements ##################################################################################################################
+
+def random_query(rng):
+    if rng.random() < 0.5:
+        user_prompt = rng.choice(list(prompts.CANNED_PROMPTS.values()))
+    else:
+        user_prompt = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 20))) + f" {rng.random()}"
+
+    # the apps default to the current month
+    end_date = dt.date.today() - dt.timedelta(days=rng.randint(0, 60))
+    start_date = end_date - dt.timedelta(days=rng.choice([7, 30, 30, 30, 90]))
+    return user_prompt, start_date, end_date, rng.choice(retrieval.ISOS)
+
+
+class StageTimer:
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.latencies = {stage: [] for stage in STAGES}
+        self.allocations = {stage: [] for stage in STAGES}
+
+    def run(self, stage, function, *args):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        result = function(*args)
+        self.latencies[stage].append(time.perf_counter() - started)
+        if self.trace_memory:
+            self.allocations[stage].append(tracemalloc.get_traced_memory()[1] - before)
+        return result
+
+
+# one query through the same steps as the chatbot's rag(), each stage timed on its own
+def run_staged_query(db, timer, user_prompt, start_date, end_date, iso, num_candidates, limit):
+    started = time.perf_counter()
+    prompt_vector = timer.run('embed', embedding_cache.get_embedding, user_prompt)
+    prepared = timer.run('filter', retrieval.prepare_search, db, start_date, end_date, iso)
+    chunked_docs = timer.run('search', lambda: list(retrieval.iter_search(db, prepared, prompt_vector, num_candidates, limit)))
+    non_chunked_docs = timer.run('parents', retrieval.fetch_parent_docs, db, chunked_docs)
+    timer.latencies['retrieve_total'].append(time.perf_counter() - started)
+
+    context = timer.run('context', context_builder.build_context, non_chunked_docs, chunked_docs)
+    messages = [
+        {"role": "system", "content": prompts.system_prompt},
+        {"role": "user", "content": prompts.build_contextualized_prompt(context, user_prompt)}
+    ]
+    timer.run('chat', chat.create_chat_completion, messages, .5)
+    timer.latencies['rag_total'].append(time.perf_counter() - started)
+
+
+def run_pipeline_query(db, user_prompt, start_date, end_date, iso, num_candidates, limit):
+    results = pipeline.retrieve(db, user_prompt, start_date, end_date, iso, num_candidates, limit)
+    context = context_builder.build_context(results['non_chunked_docs'], results['chunked_docs'])
+    messages = [
+        {"role": "system", "content": prompts.system_prompt},
+        {"role": "user", "content": prompts.build_contextualized_prompt(context, user_prompt)}
+    ]
+    return ''.join(chat.stream_chat_completion(messages, .5))
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values) * 1000
+    return {
+        'count': len(values),
+        'mean_ms': float(values.mean()),
+        'p50_ms': float(np.percentile(values, 50)),
+        'p95_ms': float(np.percentile(values, 95)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'max_ms': float(values.max())
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def benchmark_size(args, size):
+    corpus_started = time.perf_counter()
+    db, index = build_corpus(size, args.dims, args.months, args.chunks_per_parent, args.parent_words, args.seed)
+    corpus_seconds = time.perf_counter() - corpus_started
+    local_index.use_local_index(index)
+
+    rng = random.Random(args.seed)
+    queries = [random_query(rng) for _ in range(args.queries)]
+
+    # per-stage latencies, one query at a time
+    timer = StageTimer(args.trace_memory)
+    if args.trace_memory:
+        tracemalloc.start()
+    for user_prompt, start_date, end_date, iso in queries:
+        run_staged_query(db, timer, user_prompt, start_date, end_date, iso, args.num_candidates, args.limit)
+    if args.trace_memory:
+        tracemalloc.stop()
+
+    # end-to-end throughput through pipeline.retrieve() + a streamed answer, the way the apps run it
+    throughput_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(lambda query: run_pipeline_query(db, *query, args.num_candidates, args.limit), queries))
+    throughput_seconds = time.perf_counter() - throughput_started
+
+    result = {
+        'chunks': size,
+        'dims': args.dims,
+        'corpus_build_seconds': corpus_seconds,
+        'corpus_vector_mb': index.vectors.nbytes / (1024 * 1024),
+        'stages': {stage: percentiles(timer.latencies[stage]) for stage in STAGES},
+        'throughput_qps': len(queries) / throughput_seconds,
+        'concurrency': args.concurrency,
+        'peak_rss_mb': peak_rss_mb()
+    }
+    if args.trace_memory:
+        result['stage_peak_alloc_kb'] = {
+            stage: max(values) / 1024 for stage, values in timer.allocations.items() if values
+        }
+    return result
+
+
+def print_result(result):
+    print(f"\n=== {result['chunks']:,} chunks x {result['dims']} dims "
+          f"(vectors {result['corpus_vector_mb']:.0f} MB, built in {result['corpus_build_seconds']:.1f}s) ===")
+    print(f"{'stage':<16}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}   (ms)")
+    for stage, stats in result['stages'].items():
+        if stats is None:
+            continue
+        print(f"{stage:<16}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}")
+    print(f"throughput: {result['throughput_qps']:.1f} queries/s at concurrency {result['concurrency']}")
+    print(f"peak RSS: {result['peak_rss_mb']:.0f} MB")
+    for stage, kb in result.get('stage_peak_alloc_kb', {}).items():
+        print(f"  peak allocation {stage:<14} {kb:>10.1f} KB")
+
+
+def configure(args, base_url):
+    # every cache off so each query pays for every stage, unless asked otherwise
+    config.overrides[("retrieval", "backend")] = args.backend
+    config.overrides[("retrieval", "mode")] = "prefilter"
+    config.overrides[("local_index", "reload_seconds")] = float('inf')
+    # the fake database has no partitions, lexical index or short vectors, whatever secrets.toml turns on
+    config.overrides[("retrieval", "partitioned")] = False
+    config.overrides[("hybrid", "enabled")] = False
+    config.overrides[("candidates", "enabled")] = False
+    if not args.with_caches:
+        config.overrides[("embedding_cache", "enabled")] = False
+        config.overrides[("retrieval_cache", "enabled")] = False
+        config.overrides[("parent_cache", "enabled")] = False
+        config.overrides[("answer_cache", "enabled")] = False
+
+    # the real client, connection pool included, pointed at the fake server
+    config.overrides[("openai", "api_key")] = "benchmark"
+    config.overrides[("openai", "base_url")] = base_url
+    config.overrides[("openai", "max_retries")] = 0
+    config.overrides[("openai", "max_connections")] = max(20, args.concurrency * 2)
+    # measure the pipeline, not the account's quota (see gateway.py)
+    config.overrides[("gateway", "rate_limit")] = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the retrieval and chat pipelines.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--dims", type=int, default=256, help="embedding width (text-embedding-3-large is 3072)")
+    parser.add_argument("--months", type=int, default=24, help="history the corpus is spread over")
+    parser.add_argument("--chunks-per-parent", type=int, default=5)
+    parser.add_argument("--parent-words", type=int, default=400)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--num-candidates", type=int, default=100)
+    parser.add_argument("--limit", type=int, default=3)
+    parser.add_argument("--backend", choices=retrieval.RETRIEVAL_BACKENDS, default="atlas", help="atlas = in-memory $vectorSearch stand-in")
+    parser.add_argument("--with-caches", action="store_true", help="leave the embedding / retrieval / parent / answer caches on")
+    parser.add_argument("--embed-latency-ms", type=float, default=150)
+    parser.add_argument("--chat-latency-ms", type=float, default=400)
+    parser.add_argument("--token-latency-ms", type=float, default=0)
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--trace-memory", action="store_true", help="record peak allocations per stage (slower)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    server, base_url = start_fake_openai_server({
+        'dims': args.dims,
+        'embed_latency': args.embed_latency_ms / 1000,
+        'chat_latency': args.chat_latency_ms / 1000,
+        'token_latency': args.token_latency_ms / 1000,
+        'answer_tokens': args.answer_tokens
+    })
+    configure(args, base_url)
+
+    results = []
+    for size in args.sizes:
+        result = benchmark_size(args, size)
+        print_result(result)
+        results.append(result)
+
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+import io
+import os
+import csv
+import json
+import time
+import argparse
+import tempfile
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import config
+import gateway
+import pipeline
+import retrieval
+import embedding_cache
+
+# Bulk mode of the vector search app: a CSV or JSONL file of queries in, one row per hit out.
+#
+# Each input row has a `query` plus optional `start_date` / `end_date` (YYYY-MM-DD) and `iso`; missing ones take the defaults
+# from the search form. The queries are embedded embedding_batch_size at a time in one embeddings call each (cached ones
+# skipped, at the gateway's batch priority so the apps' interactive queries go first), the searches run max_workers at a
+# time, and every query's hits are written to the output file as soon as it finishes, so a cancelled or failed run still
+# leaves what was done so far. A query that fails gets a row with its error instead of stopping the run.
+#
+#   python bulk_search.py queries.csv results.jsonl
+#   python bulk_search.py queries.jsonl results.parquet --limit 20
+#
+# Parquet needs pyarrow.
+#
+# [bulk]
+# embedding_batch_size = 256
+# max_workers = 8
+# max_queries = 5000
+# num_candidates = 500
+# limit = 10
+# output_dir = ""               --> where result files are written, the system temp directory by default
+# keep_seconds = 3600           --> result files still there after this long are deleted by the next run
+
+FIELDS = (
+    ('query_id', 'int64'),
+    ('query', 'string'),
+    ('start_date', 'string'),
+    ('end_date', 'string'),
+    ('iso', 'string'),
+    ('rank', 'int64'),
+    ('score', 'float64'),
+    ('chunk_id', 'string'),
+    ('parent_id', 'string'),
+    ('source', 'string'),
+    ('contents', 'string'),
+    ('error', 'string')
+)
+
+FORMATS = ('jsonl', 'parquet')
+
+OUTPUT_PREFIX = "bulk_search_"
+
+
+class BulkInputError(ValueError):
+    pass
+
+
+def available_formats():
+    return FORMATS if pyarrow is not None else ('jsonl',)
+
+
+def parse_date(value, default):
+    if value in (None, ""):
+        return default
+    if isinstance(value, dt.date):
+        return value
+    return dt.date.fromisoformat(str(value).strip()[:10])
+
+
+def parse_iso(value, default):
+    if value in (None, ""):
+        return default
+    for iso in retrieval.ISOS:
+        if iso.lower() == str(value).strip().lower():
+            return iso
+    raise ValueError(f"unknown ISO {value!r}")
+
+
+# rows of {'query', 'start_date', 'end_date', 'iso'} from the uploaded file; every bad row is reported, not just the first
+def parse_queries(data, filename, default_start_date, default_end_date, default_iso="N/A"):
+    text = data.decode('utf-8-sig') if isinstance(data, bytes) else data
+    errors = []
+    if filename.lower().endswith(('.jsonl', '.ndjson', '.json')):
+        records = []
+        for line, raw in enumerate(text.splitlines(), 1):
+            if not raw.strip():
+                continue
+            try:
+                records.append((line, json.loads(raw)))
+            except ValueError as e:
+                errors.append(f"row {line}: {e}")
+    else:
+        records = list(enumerate(csv.DictReader(io.StringIO(text)), 1))
+
+    queries = []
+    for line, record in records:
+        record = {str(key).strip().lower(): value for key, value in record.items() if key is not None}
+        query = (record.get('query') or record.get('user_prompt') or "").strip()
+        if not query:
+            errors.append(f"row {line}: no query")
+            continue
+        try:
+            start_date = parse_date(record.get('start_date'), default_start_date)
+            end_date = parse_date(record.get('end_date'), default_end_date)
+            iso = parse_iso(record.get('iso'), default_iso)
+        except ValueError as e:
+            errors.append(f"row {line}: {e}")
+            continue
+        queries.append({'query': query, 'start_date': start_date, 'end_date': end_date, 'iso': iso})
+
+    max_queries = config.get_setting("bulk", "max_queries", 5000)
+    if len(queries) > max_queries:
+        errors.append(f"{len(queries)} queries, at most {max_queries} can be run at once")
+    if errors:
+        raise BulkInputError("\n".join(errors[:20]))
+    if not queries:
+        raise BulkInputError("The file has no queries")
+    return queries
+
+
+class JsonlWriter:
+    def __init__(self, path):
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def write(self, rows):
+        for row in rows:
+            self.file.write(json.dumps(row) + "\n")
+        # flushed per query so the file on disk is always complete up to the last finished query
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# one row group per finished query
+class ParquetWriter:
+    def __init__(self, path):
+        self.schema = pyarrow.schema([(name, getattr(pyarrow, kind)()) for name, kind in FIELDS])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        if rows:
+            self.writer.write_table(pyarrow.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def open_writer(path, output_format):
+    if output_format == 'parquet':
+        if pyarrow is None:
+            raise RuntimeError("Parquet output needs pyarrow")
+        return ParquetWriter(path)
+    return JsonlWriter(path)
+
+
+def result_rows(query_id, query, results=None, error=None):
+    base = {
+        'query_id': query_id,
+        'query': query['query'],
+        'start_date': query['start_date'].isoformat(),
+        'end_date': query['end_date'].isoformat(),
+        'iso': query['iso']
+    }
+    empty = {name: None for name, _ in FIELDS}
+    if error is not None:
+        return [{**empty, **base, 'error': error}]
+
+    parents = {str(document['_id']): document for document in results['non_chunked_docs']}
+    rows = []
+    for rank, chunk in enumerate(results['chunked_docs'], 1):
+        parent = parents.get(str(chunk['semi_chunked_id']), {})
+        rows.append({
+            **empty,
+            **base,
+            'rank': rank,
+            'score': float(chunk['score']) if chunk.get('score') is not None else None,
+            'chunk_id': str(chunk['_id']),
+            'parent_id': str(chunk['semi_chunked_id']),
+            'source': parent.get('source'),
+            'contents': parent.get('contents')
+        })
+    return rows
+
+
+# writes every query's hits to `path` as they come in; progress(done, total, failed) after each query, and
+# check_cancelled() (e.g. jobs.Job.check_cancelled) between them
+def run_bulk(db, queries, path, output_format='jsonl', num_candidates=None, limit=None, progress=None, check_cancelled=None):
+    num_candidates = num_candidates or config.get_setting("bulk", "num_candidates", 500)
+    limit = limit or config.get_setting("bulk", "limit", 10)
+    batch_size = config.get_setting("bulk", "embedding_batch_size", 256)
+
+    def search(query, prompt_vector):
+        return pipeline.retrieve(
+            db, query['query'], query['start_date'], query['end_date'], query['iso'],
+            num_candidates=num_candidates, limit=limit, prompt_vector=prompt_vector
+        )
+
+    summary = {'queries': len(queries), 'done': 0, 'failed': 0, 'rows': 0, 'path': path, 'format': output_format}
+    writer = open_writer(path, output_format)
+    try:
+        with ThreadPoolExecutor(max_workers=config.get_setting("bulk", "max_workers", 8)) as executor:
+            for start in range(0, len(queries), batch_size):
+                batch = queries[start:start + batch_size]
+                prompt_vectors = embedding_cache.get_embeddings([query['query'] for query in batch], priority=gateway.BATCH)
+
+                searches = {
+                    executor.submit(search, query, prompt_vector): (start + offset, query)
+                    for offset, (query, prompt_vector) in enumerate(zip(batch, prompt_vectors))
+                }
+                try:
+                    for future in as_completed(searches):
+                        query_id, query = searches[future]
+                        try:
+                            rows = result_rows(query_id, query, results=future.result())
+                        except Exception as e:
+                            rows = result_rows(query_id, query, error=f"{type(e).__name__}: {e}")
+                            summary['failed'] += 1
+
+                        writer.write(rows)
+                        summary['done'] += 1
+                        summary['rows'] += len(rows)
+                        if progress is not None:
+                            progress(summary['done'], summary['queries'], summary['failed'])
+                        if check_cancelled is not None:
+                            check_cancelled()
+                except BaseException:
+                    for future in searches:
+                        future.cancel()
+                    raise
+    finally:
+        writer.close()
+
+    return summary
+
+
+def output_dir():
+    return config.get_setting("bulk", "output_dir", None) or tempfile.gettempdir()
+
+
+# result files left behind by runs nobody picked up (a closed tab, a restart) once they are older than keep_seconds
+def sweep_outputs():
+    cutoff = time.time() - config.get_setting("bulk", "keep_seconds", 3600)
+    directory = output_dir()
+    for name in os.listdir(directory):
+        if name.startswith(OUTPUT_PREFIX):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def output_path(output_format):
+    sweep_outputs()
+    handle, path = tempfile.mkstemp(prefix=OUTPUT_PREFIX, suffix=f".{output_format}", dir=output_dir())
+    os.close(handle)
+    return path
+
+
+# the finished file's bytes, for the download; the file itself is removed
+def take_output(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    import clients
+
+    today = dt.date.today()
+    parser = argparse.ArgumentParser(description="Run a file of vector searches and write every hit to JSONL or Parquet.")
+    parser.add_argument("queries", help="CSV or JSONL with a query column and optional start_date / end_date / iso")
+    parser.add_argument("output", help="results.jsonl or results.parquet")
+    parser.add_argument("--start-date", type=dt.date.fromisoformat, default=today.replace(day=1))
+    parser.add_argument("--end-date", type=dt.date.fromisoformat, default=today)
+    parser.add_argument("--iso", default="N/A")
+    parser.add_argument("--num-candidates", type=int)
+    parser.add_argument("--limit", type=int)
+    args = parser.parse_args()
+
+    with open(args.queries, 'rb') as f:
+        queries = parse_queries(f.read(), args.queries, args.start_date, args.end_date, args.iso)
+
+    summary = run_bulk(
+        clients.get_db(),
+        queries,
+        args.output,
+        'parquet' if args.output.endswith('.parquet') else 'jsonl',
+        args.num_candidates,
+        args.limit,
+        progress=lambda done, total, failed: print(f"\r{done}/{total} queries ({failed} failed)", end="", flush=True)
+    )
+    print(f"\n{summary['rows']} rows written to {summary['path']}")
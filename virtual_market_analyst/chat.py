@@ -0,0 +1,65 @@
+import time
+
+import config
+import tokens
+import gateway
+import metrics
+
+CHAT_MODEL = "gpt-4"
+
+# [chat]
+# streaming = true    --> write the answer into the page token by token instead of waiting for the full completion
+# follow_up_turns = 10 --> follow-ups answered in the chatbot's partial-rerun region before the page is redrawn in full
+
+
+def streaming_enabled():
+    return config.get_setting("chat", "streaming", True)
+
+
+def record_usage(span, prompt_tokens, completion_tokens):
+    span['prompt_tokens'] = prompt_tokens
+    span['completion_tokens'] = completion_tokens
+    metrics.add(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+
+def create_chat_completion(messages, temperature):
+    with metrics.span("chat", model=CHAT_MODEL, streamed=False) as span:
+        response = gateway.create_chat_completion(
+            model=CHAT_MODEL,
+            messages=messages,
+            temperature=temperature
+        )
+        if response.usage is not None:
+            record_usage(span, response.usage.prompt_tokens, response.usage.completion_tokens)
+    return response.choices[0].message.content
+
+
+# yields the answer text piece by piece as the tokens arrive
+def stream_chat_completion(messages, temperature):
+    with metrics.span("chat", model=CHAT_MODEL, streamed=True) as span:
+        started = time.perf_counter()
+        stream = gateway.create_chat_completion(
+            model=CHAT_MODEL,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+
+        answer = []
+        usage = None
+        for chunk in stream:
+            # with include_usage the last chunk carries the token counts and no choices
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if not answer:
+                    span['first_token_ms'] = (time.perf_counter() - started) * 1000
+                answer.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+
+        # endpoints that ignore include_usage (e.g. some OpenAI compatible proxies) get estimated counts
+        if usage is not None:
+            record_usage(span, usage.prompt_tokens, usage.completion_tokens)
+        else:
+            record_usage(span, sum(tokens.count_message_tokens(message) for message in messages), tokens.count_tokens("".join(answer)))
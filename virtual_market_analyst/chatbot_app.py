@@ -1,12 +1,20 @@
-import re
-import time
-import openai
 import calendar
 import datetime as dt
 import streamlit as st
-from bson import ObjectId
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
+
+import chat
+import config
+import clients
+import context_builder
+import answer_cache
+import jobs
+import history
+import session_store
+import metrics
+import prompts
+import pipeline
+import retrieval
+import morning_brief
 
 ######################################################################################################## Login / Authorization ###################################################################################3
 
@@ -57,45 +65,12 @@ else:
     ############################################################################################################# ChatBot #################################################################################################################3
     ########################################################################################################### Set Prompts ####################################################################################################
 
-    system_prompt = """
-    You are a commodity research analyst that helps other understand commodity market key developments and news that impact the specified market.
-    Your answers should be one to three paragraphs depending on how many key developments there is to cover. The more the more key developments the longer the response should be and the less key developments the shorter the response should be.
-    A successful response will briefly describe a key development and explain why that development would impact the commodity market pricing for each key development. 
-    For for each key development cite the source which points to its occurrence. The source should be cited in the following format [source: "SOURCE"]. Please list the full source and make minimal alterations to the source.
-    The write-up must have proper grammar.
-    The write-up can use jargon as you should assume the reader is modestly knowledgeable of the market.
-    """
-    instructions = """
-    Use the CONTEXT above to respond to the user's REQUEST.
-    Ground your response in the facts that CONTEXT provides.
-    Do not make up any stories or market data. Only use the market data which is provided by CONTEXT and site sources in your response.
-    If CONTEXT does not contain enough information to respond to the REQUEST return "I need more information to provide an answer".
-    """
-
-    weather_prompt = f"Weather Prompt --> Please provide me with a commentary on weather developments that have occurred that could impact power or natural gas market. Weather developments of interest include those that relate to waves of oncoming or upcoming heat and or cold fronts. Other developments of interest include those that pertain to the increase or decrease of heating degree days, often referred to as 'HDDs', and/or the increase or decrease of cooling degree days, often referred to as 'CDDs'."
-    economic_prompt = f"Economic Prompt --> Please provide me with a commentary on economic developments that have occurred which could impact power or natural gas demand."
-    data_center_prompt = f"Data Center Prompt --> Please provide me with a commentary on data center developments that have occurred. Data center developments of interest are the annoucements of new planned investments and deals for power supply to data centers. Other areas of interest also include news on the progression of data center build outs or financings. Also of interest is news on how data centers can drive an increase in electricty demand."
-    lng_prompt = f"LNG Prompt --> Please provide me with a commentary on LNG developments that have occurred. LNG developments of interest include those pertaining to outages for export terminals ending, the volume of exports increasing, and progress on LNG terminals under development. Please exclude any commentary on LNG terminal outages being extended or occuring."
-    technicals_prompt = f"Market Technicals Prompt --> Please provide me with a commentary on technical developments that have occurred. Technical developments of interest include those relevant to market participant positioning such as investors, market participants, and speculators decreasing, covering, or adding to positions."
-    production_prompt = f"Production Prompt --> Please provide me with a commentary on the developments that impacted natural gas production."
-    storage_prompt = f"Storage Prompt --> Please provide me with a commentary on the developments that impacted the levels of natural gas in storage."
+    # prompts are shared with the morning brief job (see prompts.py)
+    system_prompt = prompts.system_prompt
 
     ########################################################################################## Declare Connections ########################################################################################3
-    # setting credentials for MongoDB and OpenAI
-    for key in ('uri', 'open_ai_api_key'):
-        if key not in st.session_state:
-            st.session_state[key] = ""
-
-    # Get secrets from Streamlit secrets
-    uri = st.secrets["mongodb"]["uri"]
-    openai_api_key = st.secrets["openai"]["api_key"]
-
-    # Set MongoDB client
-    client = MongoClient(uri, server_api=ServerApi('1'))
-    db = client.MarketCommentaries
-
-    # Set OpenAI API key
-    openai.api_key = openai_api_key
+    # MongoDB and OpenAI clients are created once per process and shared by every rerun / session (see clients.py)
+    db = clients.get_db()
 
     ########################################################################################### Take User Inputs ########################################################################################3
 
@@ -118,11 +93,23 @@ else:
     with spacer3:
         st.write("")
 
-    # initialize the convo btwn ChatGPT and User -- input uses contextualized user prompt and output uses regular user prompt
-    if 'conversation_input' not in st.session_state:
-        st.session_state.conversation_input = [{"role": "system", "content": system_prompt}]
-    if 'conversation_output' not in st.session_state:
-        st.session_state.conversation_output = [{"role": "system", "content": system_prompt}]
+    # identifies the session to the background job pool and the session store; kept in the URL so a reload resumes it
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = session_store.session_id_from_url()
+
+    # the convo btwn ChatGPT and User, stored outside the session with only its newest messages in memory (see session_store.py)
+    if 'conversation' not in st.session_state:
+        st.session_state.conversation = session_store.open_conversation(db, st.session_state.session_id, system_prompt)
+
+        # a resumed conversation goes straight to the follow-ups
+        if len(st.session_state.conversation):
+            st.session_state['rag_form_submitted'] = True
+            st.session_state['rag_form_completed'] = True
+            st.session_state['rag_run'] = True
+
+    # keeps what is actually sent to ChatGPT within the token budget as the conversation grows (see history.py)
+    if 'conversation_history' not in st.session_state:
+        st.session_state.conversation_history = history.create_history()
 
     # Input fields for start date, end date, ISO, an duser_prompt
     if 'user_prompt' not in st.session_state:
@@ -167,12 +154,12 @@ else:
 
             st.write("")
             st.write("Please select the ISO for which you would like your response to be grounded if applicable.")
-            isos = ['N/A','ERCOT','NYISO','PJM','MISO']
+            isos = retrieval.ISOS
             iso = st.radio("ISOs:", options=isos, index=isos.index(st.session_state.iso), horizontal=False, key='iso')
             st.write("")
 
             with st.expander("Click to see some prompt ideas"):
-                st.write(f"{weather_prompt}\n\n{economic_prompt}\n\n{data_center_prompt}\n\n{lng_prompt}\n\n{technicals_prompt}\n\n{production_prompt}\n\n{storage_prompt}")
+                st.write("\n\n".join(prompts.CANNED_PROMPTS.values()))
 
             st.write("Please write your question for the ChatBot.")
             st.text_area("Type Below:", height=250, key="user_prompt")
@@ -191,183 +178,208 @@ else:
 
     ########################################################################## Feed Inputs into the RAG ########################################################################################3
 
-        def rag(system_prompt,instructions):
-            prompt_vector = openai.embeddings.create(
-                input=st.session_state.user_prompt,
-                model="text-embedding-3-large"
-            )
-
-            prompt_vector = prompt_vector.data[0].embedding
-
-            # prepping the data for a vector search (can only run match as the first stage of an aggregation pipeline)
-            def data_prep_aggregation_framework(collection_name):
-                collection = db[collection_name]
-
-                # need this step b/c streamlit start_date and end_date are DATE objects NOT DATETIME objects which MongoDB needs
-                start_date = dt.datetime.combine(st.session_state.start_date, dt.datetime.min.time())
-                end_date = dt.datetime.combine(st.session_state.end_date, dt.datetime.min.time())
-                iso = st.session_state.iso
-                iso = iso.lower()
-
-                match_stage_a = {
-                    "$match": {
-                        "date": {
-                            "$gte": start_date,
-                            "$lte": end_date
-                        }
-                    }
-                }
-
-                
-                if iso != "n/a" :
-                    match_stage_b = {
-                        "$match": {
-                            "tags": {
-                                "$in": [iso]
-                            }
-                        }
-                    }
-                else:
-                    match_stage_b = {
-                        "$match": {}
-                    }           
-          
-                data_prep_pipeline = [
-                    match_stage_a,
-                    match_stage_b,
-                ]
-
-                return data_prep_pipeline
-
-            def update_collection_with_pipeline(source_collection_name, target_collection_name):
-                data_prep_pipeline = data_prep_aggregation_framework(source_collection_name)
-                new_documents = db[source_collection_name].aggregate(data_prep_pipeline)
-                new_documents = list(new_documents)
-
-                # Remove all documents from the target collection
-                db[target_collection_name].delete_many({})
-
-                # Insert new documents into the target collection
-                if len(new_documents) > 0:
-                    db[target_collection_name].insert_many(new_documents)
-                else:
+        # one markdown element for the whole slice rather than one per message
+        def display_conversation(messages):
+            lines = []
+            for message in messages:
+                if message['role'] == 'user':
+                    lines.append(f"**You:** {message['content']}")
+                elif message['role'] == 'system':
                     pass
+                else:
+                    lines.append(f"**ChatGPT:** {message['content']}")
+            if lines:
+                st.write("\n\n".join(lines))
 
-            update_collection_with_pipeline("Chunked", "TemporaryChunked")
-            #update_collection_with_pipeline("NonChunked", "TemporaryNonChunked")
-
-            vector_search_stage = {
-                '$vectorSearch': {
-                    'index': 'vector_index', 
-                    'path': 'vector', 
-                    'queryVector': prompt_vector,
-                    'numCandidates': 100,
-                    'limit': 3
-                }
-            }
+        # writes ChatGPT's answer to the page (token by token when streaming is on) and returns the full text
+        def get_response(temperature=1):
+            messages = st.session_state.conversation.request_messages(st.session_state.conversation_history)
 
-            # semi_chunked_id = 1 if using parent/child approach 0 otherwise
-            # option see vector_Search score --> 'score': {'$meta': 'vectorSearchScore'},
-            project_stage = {
-                '$project': {
-                    '_id': 0, 
-                    'source': 1,
-                    'contents': 1,
-                    'semi_chunked_id': 1 
-                }
-            }
+            if not chat.streaming_enabled():
+                ai_response = chat.create_chat_completion(messages, temperature)
+                st.write(f"**ChatGPT:** {ai_response}")
+                return ai_response
 
-            vector_search_pipeline = [
-                vector_search_stage,
-                project_stage
-            ]
+            tokens = []
 
-            time.sleep(90)
-            #time.sleep(15)
+            def token_stream():
+                yield "**ChatGPT:** "
+                for token in chat.stream_chat_completion(messages, temperature):
+                    tokens.append(token)
+                    yield token
 
+            st.write_stream(token_stream())
 
-            chunked_docs = db.TemporaryChunked.aggregate(vector_search_pipeline)
-            #chunked_docs = db.Chunked.aggregate(vector_search_pipeline) # used for testing
-            #non_chunked_docs = db.TemporaryNonChunked.aggregate(vector_search_pipeline)
+            return "".join(tokens)
 
-            ############################################################################################### Parent Child Option/Functionality ##################################################################################################################
+        # the part of rag() that does not touch the page, so it can also run on a job worker: the context to answer from,
+        # plus a ready answer when the morning brief or the answer cache already has one
+        def retrieve_context(user_prompt, start_date, end_date, iso):
+            # canned prompts for the default window are usually precomputed by the morning brief job
+            brief = morning_brief.find_brief(db, prompts.canned_prompt_name(user_prompt), iso, start_date, end_date)
+            if brief is not None:
+                metrics.add(morning_brief_hits=1)
+                return {'context': brief['context'], 'context_ref': session_store.context_ref(brief=brief), 'answer': brief['answer'], 'answer_cache_key': None}
 
-            non_chunked_ids = []
-            for document in chunked_docs:
-                non_chunked_id = document['semi_chunked_id']
-                non_chunked_ids.append(non_chunked_id)
+            # embed the prompt, pre-filter on date / ISO, vector search and look up the parent docs (see pipeline.py)
+            results = pipeline.retrieve(db, user_prompt, start_date, end_date, iso, num_candidates=100, limit=3)
 
-            non_chunked_ids = list(set(non_chunked_ids))
-            non_chunked_ids = [ObjectId(_id) for _id in non_chunked_ids]
+            # deduplicated, trimmed to the matching passages and kept within the context token budget (see context_builder.py)
+            context = context_builder.build_context(results['non_chunked_docs'], results['chunked_docs'])
 
-            non_chunked_query = {"_id": {"$in": non_chunked_ids}}
-            non_chunked_project = {"_id":0, "contents":1, "source":1}
+            # the conversation keeps the document ids, not the context text (see session_store.py)
+            context_ref = session_store.context_ref(results['non_chunked_docs'], results['chunked_docs'])
 
-            non_chunked_docs = db.NonChunked.find(non_chunked_query,non_chunked_project)
-            non_chunked_docs = list(non_chunked_docs)
+            # a near-identical question over the same window / ISO / parent docs was already answered (see answer_cache.py)
+            parent_ids = [document['semi_chunked_id'] for document in results['chunked_docs']]
+            answer_cache_key = (results['prompt_vector'], start_date, end_date, iso, parent_ids)
+            if answer_cache.enabled():
+                cached_answer = answer_cache.get_answer_cache().get(*answer_cache_key)
+                if cached_answer is not None:
+                    metrics.add(answer_cache_hits=1)
+                    return {'context': cached_answer['context'], 'context_ref': context_ref, 'answer': cached_answer['answer'], 'answer_cache_key': None}
 
-            context = ""
-            for doc in non_chunked_docs:
-                context += doc["source"] + "\n" + doc["contents"] + "\n\n"
+            return {'context': context, 'context_ref': context_ref, 'answer': None, 'answer_cache_key': answer_cache_key}
 
+        def add_user_turn(retrieved):
             with st.expander("Click to see the data I based my answer on."):
-                st.write(f"{context}")
+                st.write(f"{retrieved['context']}")
 
             ############################################################################################### Feeding Context into the Prompt ##################################################################################################################
 
-            # cleaning up the spacing of the inputs
-            prompts = [
-                system_prompt,
-                st.session_state.user_prompt,
-                instructions
-            ]
-
-            split_pattern = r'\n|\t'
-            for index, prompt in enumerate(prompts):
-                prompt = re.split(split_pattern,prompt)
-                prompt = [item.strip() for item in prompt]
-                prompt = ' '.join(prompt).strip()
-                prompts[index] = prompt
+            # the original prompt is stored with a reference to its context; the contextualized prompt is built when it is sent
+            st.session_state.conversation.append("user", st.session_state.user_prompt, context=retrieved['context'], context_ref=retrieved['context_ref'])
 
-            system_prompt = prompts[0]
-            modified_user_prompt = prompts[1]
-            instructions = prompts[2]
+        def add_assistant_turn(ai_response):
+            st.session_state.conversation.append("assistant", ai_response)
 
-            contextualized_user_prompt = f"CONTEXT:\n{context}REQUEST:\n{modified_user_prompt}\n\nINSTRUCTIONS:{instructions}"
+        def rag():
+            # times every stage of this query (see metrics.py)
+            trace = metrics.start_trace("chatbot", iso=st.session_state.iso, start_date=st.session_state.start_date, end_date=st.session_state.end_date)
 
-            # append the contextualized prompt and the original prompt to the conversation lists
-            st.session_state.conversation_input.append({"role": "user", "content": contextualized_user_prompt})
-            st.session_state.conversation_output.append({"role": "user", "content": st.session_state.user_prompt})
+            retrieved = retrieve_context(st.session_state.user_prompt, st.session_state.start_date, st.session_state.end_date, st.session_state.iso)
+            add_user_turn(retrieved)
 
             ############################################################################################### ChatGPT Answering Prompt ##################################################################################################################
 
-            # Generate a response
-            response = openai.chat.completions.create(
-                model="gpt-4",
-                messages=st.session_state.conversation_input,
-                temperature=.5
-            )
-
-            # Extract the response text
-            ai_response = response.choices[0].message.content
-
-            st.session_state.conversation_input.append({"role": "assistant", "content": ai_response})
-            st.session_state.conversation_output.append({"role": "assistant", "content": ai_response})
-
-            for message in st.session_state.conversation_output:
-                if message['role'] == 'user':
-                    st.write(f"**You:** {message['content']}")
-                elif message['role'] == 'system':
-                    pass
-                else:
-                    st.write(f"**ChatGPT:** {message['content']}")
+            # show the conversation so far, then write the answer into the page as it is generated
+            display_conversation(st.session_state.conversation.output())
+            if retrieved['answer'] is not None:
+                ai_response = retrieved['answer']
+                st.write(f"**ChatGPT:** {ai_response}")
+            else:
+                ai_response = get_response(temperature=.5)
+                if answer_cache.enabled():
+                    answer_cache.get_answer_cache().put(*retrieved['answer_cache_key'], ai_response, retrieved['context'])
+
+            add_assistant_turn(ai_response)
+
+            metrics.finish_trace(trace)
+            if metrics.debug_panel_enabled():
+                metrics.display_debug_panel(trace)
+
+        ############################################################################################### Background Mode ##################################################################################################################
+
+        # rag() on a job worker (see jobs.py); the answer is streamed into the job for the progress display to pick up
+        def rag_job(job, user_prompt, start_date, end_date, iso, conversation, conversation_history):
+            retrieved = retrieve_context(user_prompt, start_date, end_date, iso)
+            if retrieved['answer'] is None:
+                contextualized_user_prompt = prompts.build_contextualized_prompt(retrieved['context'], user_prompt)
+                messages = conversation.request_messages(conversation_history, pending={"role": "user", "content": contextualized_user_prompt})
+                for token in chat.stream_chat_completion(messages, .5):
+                    job.check_cancelled()
+                    job.append_text(token)
+                retrieved['answer'] = job.text()
+
+                if answer_cache.enabled():
+                    answer_cache.get_answer_cache().put(*retrieved['answer_cache_key'], retrieved['answer'], retrieved['context'])
+            return retrieved
+
+        # back to the form, keeping what was typed
+        def reset_rag_form():
+            st.session_state.pop('rag_job_id', None)
+            st.session_state['rag_form_completed'] = False
+            st.session_state['rag_form_submitted'] = False
+
+        def cancel_rag(job_id):
+            jobs.get_job_pool().cancel(job_id)
+            reset_rag_form()
+
+        # polls the job while the rest of the page stays idle; a full rerun picks up the finished job
+        @st.experimental_fragment(run_every=1)
+        def show_rag_progress(job_id):
+            pool = jobs.get_job_pool()
+            job = pool.get(job_id)
+            if job is None or job.finished:
+                st.rerun()
+
+            st.write(jobs.describe_progress(pool, job))
+            partial_answer = job.text()
+            if partial_answer:
+                st.write(f"**ChatGPT:** {partial_answer}")
+            st.button("Cancel", on_click=cancel_rag, args=(job_id,))
+
+        def rag_in_background():
+            pool = jobs.get_job_pool()
+            job = pool.get(st.session_state.get('rag_job_id'))
+
+            if job is None:
+                try:
+                    job = pool.submit(
+                        "chatbot",
+                        rag_job,
+                        st.session_state.user_prompt,
+                        st.session_state.start_date,
+                        st.session_state.end_date,
+                        st.session_state.iso,
+                        st.session_state.conversation,
+                        st.session_state.conversation_history,
+                        owner=st.session_state.session_id,
+                        attributes={'iso': st.session_state.iso, 'start_date': st.session_state.start_date, 'end_date': st.session_state.end_date}
+                    )
+                except jobs.QueueFullError as e:
+                    st.error(str(e))
+                    st.button("Back", on_click=reset_rag_form)
+                    st.stop()
+                st.session_state.rag_job_id = job.id
+
+            if not job.finished:
+                show_rag_progress(job.id)
+                st.stop()
+
+            if job.state != 'done':
+                st.error("Something went wrong while answering your question, please try again." if job.state == 'failed' else "The request was cancelled.")
+                st.button("Back", on_click=reset_rag_form)
+                st.stop()
+
+            del st.session_state['rag_job_id']
+            add_user_turn(job.result)
+            display_conversation(st.session_state.conversation.output())
+            st.write(f"**ChatGPT:** {job.result['answer']}")
+            add_assistant_turn(job.result['answer'])
+
+            if metrics.debug_panel_enabled():
+                metrics.display_debug_panel(job.trace)
 
         # making it so rag is only run once
         if 'rag_run' not in st.session_state:
             st.session_state['rag_run'] = False
         if not st.session_state['rag_run']:
-            rag(system_prompt,instructions)
+            if jobs.background_enabled():
+                rag_in_background()
+            else:
+                rag()
             st.session_state['rag_run'] = True
+        else:
+            # only a full rerun (e.g. a page reload) gets here; follow-ups rerun just the region below
+            conversation = st.session_state.conversation
+            if conversation.first_seq > 0 and st.button("Show earlier messages"):
+                display_conversation(conversation.output())
+            else:
+                display_conversation(conversation.output(conversation.first_seq))
+
+        # everything up to here is on the page until the next full rerun
+        st.session_state.transcript_rendered = len(st.session_state.conversation)
 
         ############################################################################################### Follow-up Interface ##################################################################################################################
         
@@ -383,39 +395,37 @@ else:
 
         clear_all()
 
-        def get_response(conversation_input):
-            response = openai.chat.completions.create(
-                model="gpt-4",
-                messages=conversation_input,
-                temperature=1
-            )
-
-            ai_response = response.choices[0].message.content
+        def handle_conversation(follow_up_prompt):
+            trace = metrics.start_trace("chatbot_follow_up")
+            st.session_state.conversation.append("user", follow_up_prompt)
+            display_conversation([{"role": "user", "content": follow_up_prompt}])
+            ai_response = get_response()
+            add_assistant_turn(ai_response)
 
-            return ai_response
+            metrics.finish_trace(trace)
+            if metrics.debug_panel_enabled():
+                metrics.display_debug_panel(trace)
 
-        def handle_conversation(follow_up_prompt):
-            st.session_state.conversation_input.append({"role": "user", "content": follow_up_prompt})
-            st.session_state.conversation_output.append({"role": "user", "content": follow_up_prompt})
-            ai_response = get_response(st.session_state.conversation_input)
-            st.session_state.conversation_input.append({"role": "assistant", "content": ai_response})
-            st.session_state.conversation_output.append({"role": "assistant", "content": ai_response})
-        
+        # the question is answered by the fragment's rerun, not here, so the answer is written inside the fragment
         def follow_up():
-            follow_up_prompt = st.session_state.follow_up_prompt
-            if follow_up_prompt:
-                handle_conversation(follow_up_prompt)
+            if st.session_state.follow_up_prompt:
+                st.session_state.pending_follow_up = st.session_state.follow_up_prompt
                 st.session_state.follow_up_prompt = ""
-                #del st.session_state["follow_up_prompt"]
-
-                for message in st.session_state.conversation_output:
-                    if message['role'] == 'user':
-                        st.write(f"**You:** {message['content']}")
-                    elif message['role'] == 'system':
-                        pass
-                    else:
-                        st.write(f"**ChatGPT:** {message['content']}")
-
-        follow_up_prompt = st.text_area("Ask a follow up question:", height=100, key="follow_up_prompt")
-        follow_up_button = st.button(label="Submit", type="primary", on_click=follow_up)
-        
\ No newline at end of file
+
+        # the follow-up box and the turns asked in it rerun on their own: the login, setup and transcript above are left alone
+        @st.experimental_fragment
+        def follow_up_area():
+            display_conversation(st.session_state.conversation.output(st.session_state.transcript_rendered))
+
+            pending_follow_up = st.session_state.pop('pending_follow_up', None)
+            if pending_follow_up:
+                handle_conversation(pending_follow_up)
+
+                # fold a long run of follow-ups into the transcript above with one full rerun, so this region stays small
+                if len(st.session_state.conversation) - st.session_state.transcript_rendered >= 2 * config.get_setting("chat", "follow_up_turns", 10):
+                    st.rerun()
+
+            st.text_area("Ask a follow up question:", height=100, key="follow_up_prompt")
+            st.button(label="Submit", type="primary", on_click=follow_up)
+
+        follow_up_area()
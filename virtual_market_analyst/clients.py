@@ -0,0 +1,110 @@
+import time
+import logging
+import threading
+
+import httpx
+import openai
+import streamlit as st
+from pymongo.mongo_client import MongoClient
+from pymongo.server_api import ServerApi
+from pymongo.errors import PyMongoError
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Process wide MongoDB and OpenAI clients.
+#
+# Streamlit reruns the app scripts on every widget interaction but only imports this module once per process, so the
+# clients (and their connection pools) built here are reused by every rerun and every session.
+#
+# [mongodb]
+# uri = "..."
+# max_pool_size = 50
+# min_pool_size = 0
+# server_selection_timeout_ms = 10000
+# health_check_seconds = 30       --> how often get_db() pings the cluster before handing out the client
+# retired_client_close_seconds = 300  --> how long a replaced client stays open for the queries still running on it
+#
+# [openai]
+# api_key = "..."
+# base_url = "..."                --> optional, e.g. a proxy or a local stand-in
+# max_connections = 20
+# timeout = 60
+# max_retries = 2
+
+_mongo_lock = threading.Lock()
+_openai_lock = threading.Lock()
+_mongo_client = None
+_mongo_checked_at = 0.0
+_openai_client = None
+
+
+def create_mongo_client():
+    return MongoClient(
+        st.secrets["mongodb"]["uri"],
+        server_api=ServerApi('1'),
+        maxPoolSize=config.get_setting("mongodb", "max_pool_size", 50),
+        minPoolSize=config.get_setting("mongodb", "min_pool_size", 0),
+        serverSelectionTimeoutMS=config.get_setting("mongodb", "server_selection_timeout_ms", 10000)
+    )
+
+
+def get_mongo_client():
+    global _mongo_client, _mongo_checked_at
+
+    with _mongo_lock:
+        if _mongo_client is None:
+            _mongo_client = create_mongo_client()
+            _mongo_checked_at = time.monotonic()
+            return _mongo_client
+
+        client = _mongo_client
+        if time.monotonic() - _mongo_checked_at < config.get_setting("mongodb", "health_check_seconds", 30):
+            return client
+        # claimed by this thread, so the others go on with the current client instead of pinging too
+        _mongo_checked_at = time.monotonic()
+
+    # health check, outside the lock so an unreachable cluster only holds up this caller: pymongo reconnects on its own, but
+    # a client that cannot even ping is replaced with a fresh one
+    try:
+        client.admin.command('ping')
+        return client
+    except PyMongoError:
+        logger.warning("MongoDB health check failed, reconnecting", exc_info=True)
+
+    replacement = create_mongo_client()
+    with _mongo_lock:
+        if _mongo_client is not client:
+            # another thread replaced it already
+            replacement.close()
+            return _mongo_client
+        _mongo_client = replacement
+
+    # other sessions and job workers may still be in the middle of queries on the old client
+    closer = threading.Timer(config.get_setting("mongodb", "retired_client_close_seconds", 300), client.close)
+    closer.daemon = True
+    closer.start()
+    return replacement
+
+
+def get_db():
+    return get_mongo_client().MarketCommentaries
+
+
+def get_openai_client():
+    global _openai_client
+
+    with _openai_lock:
+        if _openai_client is None:
+            max_connections = config.get_setting("openai", "max_connections", 20)
+            _openai_client = openai.OpenAI(
+                api_key=config.get_setting("openai", "api_key"),
+                base_url=config.get_setting("openai", "base_url", None),
+                timeout=config.get_setting("openai", "timeout", 60),
+                max_retries=config.get_setting("openai", "max_retries", 2),
+                http_client=openai.DefaultHttpxClient(
+                    limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+                )
+            )
+        return _openai_client
@@ -0,0 +1,31 @@
+import os
+
+import streamlit as st
+
+# optional tuning settings live next to the credentials in .streamlit/secrets.toml, e.g.
+#
+# [retrieval]
+# mode = "prefilter"
+#
+# anything that is not set falls back to the default passed in by the caller
+
+# the directory of the apps; relative file settings are resolved against it (see get_path_setting)
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# settings forced from code (e.g. by benchmark.py), checked before secrets.toml
+overrides = {}
+
+
+def get_setting(section, key, default=None):
+    if (section, key) in overrides:
+        return overrides[(section, key)]
+    try:
+        return st.secrets[section][key]
+    except (KeyError, FileNotFoundError):
+        return default
+
+
+# files the apps write next to themselves (indexes, sqlite caches): a relative path is taken relative to APP_DIR rather than
+# to wherever streamlit or the script was started from
+def get_path_setting(section, key, default):
+    return os.path.join(APP_DIR, os.path.expanduser(get_setting(section, key, default)))
@@ -0,0 +1,133 @@
+import re
+
+import config
+import tokens
+import metrics
+
+# Builds the CONTEXT block sent to ChatGPT from the retrieved parent documents.
+#
+# Unlike retrieval.build_context(), which pastes in every parent whole (still used to list results in the vector search app):
+#   1. near-duplicate parents (the same syndicated story from several sources) are dropped by word shingle similarity
+#   2. each parent is trimmed to the passages around the chunks that matched, plus passage_window passages either side
+#   3. parents are added in relevance order until token_budget is spent; the last one is cut down to fit
+#
+# [context]
+# token_budget = 3000
+# duplicate_threshold = 0.8     --> Jaccard similarity of 5-word shingles above which a parent counts as a duplicate
+# passage_window = 1
+# min_tokens = 100              --> a parent that would be cut below this is left out instead
+
+SHINGLE_WORDS = 5
+TRIM_MARKER = "[...]"
+
+
+def shingles(text, size=SHINGLE_WORDS):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[start:start + size]) for start in range(len(words) - size + 1)}
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+# paragraphs, or sentences when the commentary is one long paragraph
+def split_passages(text):
+    passages = [passage.strip() for passage in re.split(r"\n\s*\n", text) if passage.strip()]
+    if len(passages) == 1:
+        passages = [sentence.strip() for sentence in re.split(r"(?<=[.!?])\s+", passages[0]) if sentence.strip()]
+    return passages
+
+
+# share of the passage's shingles that also appear in the chunks
+def containment(passage_shingles, chunk_shingles):
+    if not passage_shingles:
+        return 0.0
+    return len(passage_shingles & chunk_shingles) / len(passage_shingles)
+
+
+# keeps the passages that overlap a matching chunk plus their neighbours; everything when nothing can be matched
+def trim_to_matches(contents, chunk_texts, window, min_containment=0.3):
+    passages = split_passages(contents)
+    chunk_shingles = set().union(*(shingles(text) for text in chunk_texts)) if chunk_texts else set()
+    if not chunk_shingles or len(passages) <= 1:
+        return passages
+
+    # chunks are cut from the parent text, so a passage inside a chunk shares most of its shingles with it
+    matched = [position for position, passage in enumerate(passages) if containment(shingles(passage), chunk_shingles) >= min_containment]
+    if not matched:
+        return passages
+
+    keep = sorted({
+        neighbour
+        for position in matched
+        for neighbour in range(max(0, position - window), min(len(passages), position + window + 1))
+    })
+
+    trimmed = []
+    for previous, position in zip([None] + keep, keep):
+        if (previous is None and position > 0) or (previous is not None and position > previous + 1):
+            trimmed.append(TRIM_MARKER)
+        trimmed.append(passages[position])
+    if keep[-1] < len(passages) - 1:
+        trimmed.append(TRIM_MARKER)
+    return trimmed
+
+
+def format_doc(source, passages):
+    return source + "\n" + "\n\n".join(passages) + "\n\n"
+
+
+# non_chunked_docs in relevance order, as returned by retrieval.fetch_parent_docs(); chunked_docs are the search hits
+def build_context(non_chunked_docs, chunked_docs, token_budget=None):
+    token_budget = token_budget or config.get_setting("context", "token_budget", 3000)
+    duplicate_threshold = config.get_setting("context", "duplicate_threshold", 0.8)
+    window = config.get_setting("context", "passage_window", 1)
+    min_tokens = config.get_setting("context", "min_tokens", 100)
+
+    with metrics.span("context", documents=len(non_chunked_docs)) as span:
+        chunk_texts = {}
+        for document in chunked_docs:
+            if document.get('contents'):
+                chunk_texts.setdefault(str(document['semi_chunked_id']), []).append(document['contents'])
+
+        context = ""
+        used_tokens = 0
+        kept_shingles = []
+        duplicates = 0
+        cut = 0
+        for doc in non_chunked_docs:
+            doc_shingles = shingles(doc["contents"])
+            if any(jaccard(doc_shingles, kept) >= duplicate_threshold for kept in kept_shingles):
+                duplicates += 1
+                continue
+
+            passages = trim_to_matches(doc["contents"], chunk_texts.get(str(doc.get("_id")), []), window)
+            text = format_doc(doc["source"], passages)
+            text_tokens = tokens.count_tokens(text)
+
+            remaining = token_budget - used_tokens
+            if text_tokens > remaining:
+                if remaining < min_tokens:
+                    cut += 1
+                    break
+
+                # drop trailing passages, then cut the text itself, to fit what is left of the budget
+                while len(passages) > 1 and tokens.count_tokens(format_doc(doc["source"], passages)) > remaining:
+                    passages = passages[:-1]
+                text = format_doc(doc["source"], passages)
+                if tokens.count_tokens(text) > remaining:
+                    text = tokens.truncate_tokens(text, remaining - 2).rstrip() + "\n\n"
+                text_tokens = tokens.count_tokens(text)
+                cut += 1
+
+            context += text
+            used_tokens += text_tokens
+            kept_shingles.append(doc_shingles)
+
+        span.update({'tokens': used_tokens, 'duplicates': duplicates, 'cut': cut})
+    metrics.add(context_tokens=used_tokens)
+    return context
@@ -0,0 +1,103 @@
+import numpy as np
+
+import config
+import metrics
+
+# Maximal marginal relevance over the retrieved chunks, before their parents are looked up.
+#
+# The top `limit` chunks by score often come from the same commentary, or from near-duplicate ones, and collapse into one or
+# two parents. With [diversity] enabled the search returns limit x candidate_multiplier chunks with their vectors and MMR
+# picks `limit` of them, each one maximising
+#
+#   lambda * similarity(chunk, prompt) - (1 - lambda) * max similarity(chunk, chunks already picked)
+#
+# with at most max_per_parent chunks per semi_chunked_id. The cap is only relaxed when there are not enough parents to fill
+# `limit`. Hybrid and lexical-only results have no vectors to compare and just get the per-parent cap.
+#
+# Off by default: it changes which chunks a query returns, and on the Atlas backend every query then brings back
+# limit x candidate_multiplier full 3072 float vectors.
+#
+# [diversity]
+# enabled = false
+# lambda = 0.7                  --> 1 = plain relevance order, 0 = as different from each other as possible
+# max_per_parent = 1
+# candidate_multiplier = 5
+
+
+def enabled():
+    return config.get_setting("diversity", "enabled", False)
+
+
+def candidate_depth(limit):
+    return limit * max(1, config.get_setting("diversity", "candidate_multiplier", 5))
+
+
+def without_vector(document):
+    return {key: value for key, value in document.items() if key != 'vector'}
+
+
+def normalise(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+# keeps the order, at most max_per_parent chunks per parent; the skipped ones fill whatever is left of limit
+def cap_per_parent(documents, limit, max_per_parent=None):
+    max_per_parent = max_per_parent or config.get_setting("diversity", "max_per_parent", 1)
+
+    kept = []
+    skipped = []
+    per_parent = {}
+    for document in documents:
+        parent_id = str(document['semi_chunked_id'])
+        if per_parent.get(parent_id, 0) < max_per_parent:
+            per_parent[parent_id] = per_parent.get(parent_id, 0) + 1
+            kept.append(document)
+        else:
+            skipped.append(document)
+
+    return (kept + skipped)[:limit]
+
+
+# documents carry their 'vector'; returns up to `limit` of them in MMR order, without the vectors
+def mmr(prompt_vector, documents, limit, mmr_lambda=None, max_per_parent=None):
+    if mmr_lambda is None:
+        mmr_lambda = config.get_setting("diversity", "lambda", 0.7)
+    max_per_parent = max_per_parent or config.get_setting("diversity", "max_per_parent", 1)
+
+    if len(documents) <= 1 or any('vector' not in document for document in documents):
+        return [without_vector(document) for document in cap_per_parent(documents, limit, max_per_parent)]
+
+    with metrics.span("diversify", candidates=len(documents)) as span:
+        vectors = normalise([document['vector'] for document in documents])
+        relevance = vectors @ normalise(prompt_vector)
+        parents = [str(document['semi_chunked_id']) for document in documents]
+
+        selected = []
+        per_parent = {}
+        # highest similarity of each candidate to anything picked so far
+        redundancy = np.zeros(len(documents), dtype=np.float32)
+        available = np.ones(len(documents), dtype=bool)
+        capped = 0
+
+        while len(selected) < min(limit, len(documents)):
+            eligible = available & np.array([per_parent.get(parent, 0) < max_per_parent for parent in parents])
+            # not enough parents left to fill limit under the cap
+            if not eligible.any():
+                eligible = available
+                capped += 1
+
+            scores = np.where(eligible, mmr_lambda * relevance - (1 - mmr_lambda) * redundancy, -np.inf)
+            pick = int(np.argmax(scores))
+
+            selected.append(pick)
+            available[pick] = False
+            per_parent[parents[pick]] = per_parent.get(parents[pick], 0) + 1
+            redundancy = np.maximum(redundancy, vectors @ vectors[pick])
+
+        span['parents'] = len(per_parent)
+        span['over_cap'] = capped
+
+    return [without_vector(documents[position]) for position in selected]
@@ -0,0 +1,157 @@
+import re
+import array
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import config
+import gateway
+import metrics
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "text-embedding-3-large"
+
+# Two tier cache of prompt embeddings shared by every session and both apps.
+#   memory --> LRU dict inside the process
+#   disk   --> sqlite file next to the apps, so the cache survives restarts and is shared between the two apps
+#
+# [embedding_cache]
+# enabled = true
+# path = "embedding_cache.sqlite3"       --> relative to this directory
+# memory_entries = 1000
+
+
+# prompts that only differ in spacing or line breaks get the same embedding
+def normalize_text(text):
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def cache_key(text, model):
+    return hashlib.sha256(f"{model}\n{normalize_text(text)}".encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path, memory_entries):
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, vector BLOB)")
+        self.connection.commit()
+        # counted once here and then kept up to date by put() (inserts by other processes show up on the next start)
+        self.disk_entries = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    # vectors are held as float32 arrays, about an eighth of the memory of the same floats in a list, and copied out to a list
+    # (what the OpenAI client and the $vectorSearch stage use) on every hit
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key].tolist()
+
+            row = self.connection.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                vector = array.array('f', row[0])
+                self._remember(key, vector)
+                self.disk_hits += 1
+                return vector.tolist()
+
+            self.misses += 1
+            return None
+
+    def put(self, key, model, vector):
+        vector = array.array('f', vector)
+        with self.lock:
+            self._remember(key, vector)
+            # a key always maps to the same embedding, so one already stored (e.g. by the other app) is left as it is
+            inserted = self.connection.execute(
+                "INSERT OR IGNORE INTO embeddings (key, model, vector) VALUES (?, ?, ?)",
+                (key, model, vector.tobytes())
+            ).rowcount
+            self.connection.commit()
+            self.disk_entries += inserted
+
+    def stats(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                'memory_entries': len(self.memory),
+                'disk_entries': self.disk_entries
+            }
+
+
+# one cache per process; a module level instance (rather than st.cache_resource) so batch scripts share it too
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def enabled():
+    return config.get_setting("embedding_cache", "enabled", True)
+
+
+def get_embedding_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache(
+                config.get_path_setting("embedding_cache", "path", "embedding_cache.sqlite3"),
+                config.get_setting("embedding_cache", "memory_entries", 1000)
+            )
+        return _cache
+
+
+# embeds a batch of texts with a single embeddings call for whatever is not cached yet, preserving the input order;
+# priority is the gateway's (see gateway.py), interactive unless the caller says otherwise
+def get_embeddings(texts, model=EMBEDDING_MODEL, priority=None):
+    with metrics.span("embed", texts=len(texts)) as span:
+        if not enabled():
+            response = gateway.create_embeddings([normalize_text(text) for text in texts], model, priority)
+            span['embedded'] = len(texts)
+            return [item.embedding for item in response.data]
+
+        cache = get_embedding_cache()
+        keys = [cache_key(text, model) for text in texts]
+        vectors = [cache.get(key) for key in keys]
+
+        # texts that normalise to the same key are only sent once
+        missing = {}
+        for index, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[index], []).append(index)
+        span['embedded'] = len(missing)
+
+        if missing:
+            missing_keys = list(missing)
+            response = gateway.create_embeddings([normalize_text(texts[missing[key][0]]) for key in missing_keys], model, priority)
+            for key, item in zip(missing_keys, response.data):
+                cache.put(key, model, item.embedding)
+                for index in missing[key]:
+                    vectors[index] = item.embedding
+
+            logger.info("embedding cache: %s", cache.stats())
+
+        return vectors
+
+
+def get_embedding(text, model=EMBEDDING_MODEL):
+    return get_embeddings([text], model)[0]
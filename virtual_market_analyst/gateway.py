@@ -0,0 +1,366 @@
+import json
+import time
+import heapq
+import random
+import hashlib
+import logging
+import itertools
+import threading
+import contextvars
+
+import openai
+
+import config
+import tokens
+import clients
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Shared front door for the OpenAI embeddings and chat calls of both apps and the batch jobs.
+#
+#   coalescing     --> identical requests in flight at the same time (e.g. several analysts submitting the same canned prompt)
+#                      share one API call; a streamed answer is replayed to every caller as it arrives
+#   rate limiting  --> a requests-per-minute and a tokens-per-minute bucket per model; callers wait for their turn instead of
+#                      getting a 429
+#   priority       --> waiting interactive requests go before waiting batch ones, and batch requests leave interactive_reserve
+#                      of each bucket untouched
+#   retries        --> 429s, timeouts, connection errors and 5xx are retried with jittered exponential backoff (or the server's
+#                      Retry-After); a 429 also pauses the model's bucket for everyone
+#
+# The buckets are per process: when both apps and a batch job share one API key, set the limits to each process's share.
+# Batch scripts (ingest.py, morning_brief.py) call set_default_priority(BATCH).
+#
+# [gateway]
+# enabled = true
+# rate_limit = true
+# limits = { "gpt-4" = [500, 40000] }    --> [requests per minute, tokens per minute] per model, see DEFAULT_LIMITS
+# interactive_reserve = 0.2
+# completion_tokens_estimate = 500       --> tokens charged up front for an answer, corrected once the usage is known
+# max_retries = 5
+# backoff_base_seconds = 0.5
+# backoff_max_seconds = 30
+
+INTERACTIVE = 0
+BATCH = 1
+
+DEFAULT_LIMITS = {
+    "gpt-4": (500, 40_000),
+    "text-embedding-3-large": (3_000, 1_000_000)
+}
+FALLBACK_LIMITS = (500, 100_000)
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # seconds until amount can be taken while leaving reserve (a share of capacity) in the bucket
+    def wait_time(self, amount, reserve, now):
+        self.refill(now)
+        # a request bigger than the whole bucket waits for a full bucket rather than forever
+        needed = min(amount + reserve * self.capacity, self.capacity)
+        return max(0.0, (needed - self.level) / self.rate)
+
+    # negative amounts give tokens back, e.g. when the real usage came in under the estimate
+    def take(self, amount):
+        self.level = min(self.capacity, self.level - amount)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute, interactive_reserve):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.interactive_reserve = interactive_reserve
+        self.paused_until = 0.0
+
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.sequence = itertools.count()
+
+    # blocks until the request may go out; returns the seconds spent waiting
+    def acquire(self, token_count, priority):
+        started = time.monotonic()
+        ticket = (priority, next(self.sequence))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            # a lower priority head of the queue has to notice it is no longer first
+            self.condition.notify_all()
+            try:
+                while True:
+                    delay = None
+                    if self.waiting[0] == ticket:
+                        now = time.monotonic()
+                        reserve = self.interactive_reserve if priority == BATCH else 0.0
+                        delay = max(
+                            self.paused_until - now,
+                            self.requests.wait_time(1, reserve, now),
+                            self.tokens.wait_time(token_count, reserve, now)
+                        )
+                        if delay <= 0:
+                            self.requests.take(1)
+                            self.tokens.take(token_count)
+                            return time.monotonic() - started
+                    self.condition.wait(delay)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def adjust(self, token_count):
+        with self.condition:
+            self.tokens.take(token_count)
+
+    def pause(self, seconds):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# one API call and everyone waiting for it; items holds the response, or the chunks of a stream as they arrive
+class Flight:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.items = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+
+    def publish(self, item):
+        with self.condition:
+            self.items.append(item)
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    def replay(self):
+        position = 0
+        while True:
+            with self.condition:
+                while position == len(self.items) and not self.done:
+                    self.condition.wait()
+                if position == len(self.items):
+                    if self.error is not None:
+                        raise self.error
+                    return
+                item = self.items[position]
+            position += 1
+            yield item
+
+
+def backoff_delay(attempt, error):
+    response = getattr(error, 'response', None)
+    if response is not None:
+        retry_after = response.headers.get('retry-after')
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            pass
+    # full jitter
+    cap = min(config.get_setting("gateway", "backoff_max_seconds", 30), config.get_setting("gateway", "backoff_base_seconds", 0.5) * 2 ** attempt)
+    return random.uniform(0, cap)
+
+
+class OpenAIGateway:
+    def __init__(self, client):
+        # the gateway does the retrying, so the client must not retry on its own as well
+        self.client = client.with_options(max_retries=0)
+        self.lock = threading.Lock()
+        self.limiters = {}
+        self.flights = {}
+
+        self.calls = 0
+        self.coalesced = 0
+        self.retries = 0
+
+    def limiter(self, model):
+        with self.lock:
+            if model not in self.limiters:
+                limits = config.get_setting("gateway", "limits", {}).get(model) or DEFAULT_LIMITS.get(model, FALLBACK_LIMITS)
+                self.limiters[model] = RateLimiter(*limits, config.get_setting("gateway", "interactive_reserve", 0.2))
+            return self.limiters[model]
+
+    # (flight, True) for the caller that has to make the call, (flight, False) for the ones that wait for it
+    def join(self, key):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                self.coalesced += 1
+            flight.subscribers += 1
+            return flight, leader
+
+    def leave(self, key, flight):
+        with self.lock:
+            flight.subscribers -= 1
+            if flight.done and self.flights.get(key) is flight:
+                del self.flights[key]
+
+    def call(self, model, token_count, priority, function):
+        limiter = self.limiter(model)
+        rate_limited = config.get_setting("gateway", "rate_limit", True)
+        attempt = 0
+        while True:
+            if rate_limited:
+                waited = limiter.acquire(token_count, priority)
+                if waited > 0:
+                    metrics.add(gateway_wait_ms=waited * 1000)
+            try:
+                with self.lock:
+                    self.calls += 1
+                return function()
+            except RETRYABLE_ERRORS as e:
+                # the failed attempt used none of its tokens, and the next one is charged again in acquire()
+                if rate_limited:
+                    limiter.adjust(-token_count)
+                if attempt >= config.get_setting("gateway", "max_retries", 5):
+                    raise
+                delay = backoff_delay(attempt, e)
+                logger.warning("OpenAI %s call failed (%s), retrying in %.1fs", model, type(e).__name__, delay)
+                with self.lock:
+                    self.retries += 1
+                metrics.add(gateway_retries=1)
+                attempt += 1
+
+                # after a 429 every caller of the model waits it out in acquire(), not just this one
+                if isinstance(e, openai.RateLimitError) and rate_limited:
+                    limiter.pause(delay)
+                else:
+                    time.sleep(delay)
+
+    def run_once(self, key, function):
+        flight, leader = self.join(key)
+        try:
+            if leader:
+                try:
+                    flight.publish(function())
+                    flight.finish()
+                except Exception as e:
+                    flight.finish(e)
+                    raise
+            else:
+                metrics.add(coalesced_requests=1)
+            return next(flight.replay())
+        finally:
+            self.leave(key, flight)
+
+    def create_embeddings(self, input, model, priority):
+        # the API also takes a single string, which would otherwise be counted character by character
+        texts = [input] if isinstance(input, str) else input
+        token_count = sum(tokens.count_tokens(text) for text in texts)
+        key = request_key("embeddings", model=model, input=input)
+        return self.run_once(key, lambda: self.call(model, token_count, priority, lambda: self.client.embeddings.create(input=input, model=model)))
+
+    def create_chat_completion(self, priority, **request):
+        model = request['model']
+        estimate = sum(tokens.count_message_tokens(message) for message in request['messages'])
+        estimate += request.get('max_tokens') or config.get_setting("gateway", "completion_tokens_estimate", 500)
+        key = request_key("chat", **request)
+
+        if not request.get('stream'):
+            def complete():
+                response = self.call(model, estimate, priority, lambda: self.client.chat.completions.create(**request))
+                if response.usage is not None:
+                    self.limiter(model).adjust(response.usage.total_tokens - estimate)
+                return response
+            return self.run_once(key, complete)
+
+        return self.stream_chat_completion(key, model, estimate, priority, request)
+
+    # the stream is read on its own thread into the flight, so any number of callers can follow it and any of them can stop early
+    def stream_chat_completion(self, key, model, estimate, priority, request):
+        flight, leader = self.join(key)
+        if leader:
+            # copies the context so waits and retries still count towards the caller's trace
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(self.pump, key, flight, model, estimate, priority, request),
+                name="openai-stream",
+                daemon=True
+            ).start()
+        else:
+            metrics.add(coalesced_requests=1)
+
+        try:
+            yield from flight.replay()
+        finally:
+            self.leave(key, flight)
+
+    def pump(self, key, flight, model, estimate, priority, request):
+        try:
+            stream = self.call(model, estimate, priority, lambda: self.client.chat.completions.create(**request))
+            with stream:
+                for chunk in stream:
+                    if chunk.usage is not None:
+                        self.limiter(model).adjust(chunk.usage.total_tokens - estimate)
+                    flight.publish(chunk)
+                    # nobody is reading any more
+                    with self.lock:
+                        abandoned = flight.subscribers == 0
+                    if abandoned:
+                        break
+            flight.finish()
+        except Exception as e:
+            flight.finish(e)
+        finally:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced, 'retries': self.retries, 'in_flight': len(self.flights)}
+
+
+def request_key(kind, **request):
+    return hashlib.sha256(json.dumps([kind, request], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+# one gateway per process, shared by every session
+_gateway = None
+_gateway_lock = threading.Lock()
+_default_priority = INTERACTIVE
+
+
+def enabled():
+    return config.get_setting("gateway", "enabled", True)
+
+
+def get_gateway():
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = OpenAIGateway(clients.get_openai_client())
+        return _gateway
+
+
+def set_default_priority(priority):
+    global _default_priority
+    _default_priority = priority
+
+
+def create_embeddings(input, model, priority=None):
+    if not enabled():
+        return clients.get_openai_client().embeddings.create(input=input, model=model)
+    return get_gateway().create_embeddings(input, model, _default_priority if priority is None else priority)
+
+
+# same arguments as client.chat.completions.create(); with stream=True an iterator over the chunks
+def create_chat_completion(priority=None, **request):
+    if not enabled():
+        return clients.get_openai_client().chat.completions.create(**request)
+    return get_gateway().create_chat_completion(_default_priority if priority is None else priority, **request)
@@ -0,0 +1,132 @@
+import hashlib
+import threading
+
+import chat
+import config
+import tokens
+
+# Keeps the messages sent to ChatGPT within a token budget however long the conversation runs.
+#
+# conversation_input itself is left untouched; messages_for_request() builds the trimmed copy that is actually sent:
+#   1. CONTEXT blocks of turns older than keep_context_turns are collapsed down to their REQUEST
+#   2. if the conversation is still over budget the oldest turns are dropped (or, with summarize on, folded into a running summary)
+#   3. the system prompt and the newest turn are always kept
+#
+# [history]
+# token_budget = 6000        --> prompt tokens, leave room below the model's context limit for the completion
+# keep_context_turns = 2     --> follow-ups that still see the full CONTEXT block
+# summarize = false
+
+COLLAPSED_CONTEXT = "CONTEXT:\n[the context for this earlier request has been omitted]\n\n"
+
+MAX_COUNTED_MESSAGES = 1000
+
+SUMMARY_PROMPT = "Summarize the following conversation between an analyst and a commodity research assistant in under 150 words. Keep any market facts and cited sources that later questions may refer to."
+
+
+def collapse_context(content):
+    if not content.startswith("CONTEXT:") or "REQUEST:" not in content:
+        return content
+    return COLLAPSED_CONTEXT + content[content.index("REQUEST:"):]
+
+
+class ConversationHistory:
+    def __init__(self, token_budget, keep_context_turns, summarize):
+        self.token_budget = token_budget
+        self.keep_context_turns = keep_context_turns
+        self.summarize = summarize
+
+        # token counts by a digest of the message content, so a conversation that only passes in its newest messages (see session_store.py)
+        # does not recount the ones it already sent
+        self.token_counts = {}
+
+        self.summary = ""
+        self.summary_tokens = 0
+        self.summarized_turns = 0
+
+        # the script thread and a background job worker (see jobs.py) can both build requests for the same conversation
+        self.lock = threading.RLock()
+
+    def count(self, message):
+        # a digest rather than hash(), which different strings can share
+        key = hashlib.sha256(message['content'].encode('utf-8')).digest()
+        if key not in self.token_counts:
+            if len(self.token_counts) >= MAX_COUNTED_MESSAGES:
+                self.token_counts.clear()
+            self.token_counts[key] = tokens.count_message_tokens(message)
+        return self.token_counts[key]
+
+    def total_tokens(self, conversation_input):
+        return sum(self.count(message) for message in conversation_input)
+
+    def update_summary(self, turns):
+        transcript = ""
+        for turn in turns:
+            for message in turn:
+                transcript += f"{message['role']}: {collapse_context(message['content'])}\n\n"
+
+        messages = [{"role": "system", "content": SUMMARY_PROMPT}]
+        if self.summary:
+            messages.append({"role": "user", "content": f"Summary so far:\n{self.summary}"})
+        messages.append({"role": "user", "content": transcript})
+
+        self.summary = chat.create_chat_completion(messages, temperature=0)
+        self.summary_tokens = tokens.count_tokens(self.summary) + tokens.MESSAGE_OVERHEAD_TOKENS
+
+    # first_turn: how many turns of the conversation come before conversation_input[1], when only the newest are passed in
+    def messages_for_request(self, conversation_input, first_turn=0):
+        with self.lock:
+            return self.trimmed_messages(conversation_input, first_turn)
+
+    def trimmed_messages(self, conversation_input, first_turn):
+        system_message = conversation_input[0]
+        counted = [(message, self.count(message)) for message in conversation_input[1:]]
+
+        # split into turns (a user message plus the answer that follows it), keeping the token count next to each message
+        turns = []
+        for message, token_count in counted:
+            if message['role'] == 'user' or not turns:
+                turns.append([])
+            turns[-1].append((message, token_count))
+
+        # collapse the CONTEXT blocks that are more than keep_context_turns turns old
+        for turn_index, turn in enumerate(turns):
+            if len(turns) - 1 - turn_index <= self.keep_context_turns:
+                continue
+            for message_index, (message, token_count) in enumerate(turn):
+                collapsed = collapse_context(message['content'])
+                if collapsed != message['content']:
+                    message = {"role": message['role'], "content": collapsed}
+                    turn[message_index] = (message, self.count(message))
+
+        # drop the oldest turns until the request fits (the newest turn is always sent)
+        budget = self.token_budget - self.count(system_message)
+        turn_tokens = [sum(token_count for _, token_count in turn) for turn in turns]
+        dropped = 0
+        while len(turns) - dropped > 1 and sum(turn_tokens[dropped:]) + self.summary_tokens > budget:
+            dropped += 1
+
+        # turns already folded into the summary are never sent again (summarized_turns counts from the start of the conversation)
+        if self.summarize:
+            dropped = max(dropped, self.summarized_turns - first_turn)
+
+        if self.summarize and first_turn + dropped > self.summarized_turns:
+            newly_dropped = turns[max(0, self.summarized_turns - first_turn):dropped]
+            self.update_summary([[message for message, _ in turn] for turn in newly_dropped])
+            self.summarized_turns = first_turn + dropped
+
+        messages = [system_message]
+        if self.summarize and self.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{self.summary}"})
+        for turn in turns[dropped:]:
+            messages.extend(message for message, _ in turn)
+
+        return messages
+
+
+def create_history():
+    return ConversationHistory(
+        config.get_setting("history", "token_budget", 6000),
+        config.get_setting("history", "keep_context_turns", 2),
+        config.get_setting("history", "summarize", False)
+    )
@@ -0,0 +1,233 @@
+import sys
+import argparse
+import calendar
+import datetime as dt
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+import config
+import retrieval
+import partitions
+
+# Index check and query plans for the date / ISO pre-filter both apps put in front of every search.
+#
+# The pre-filter is a date range on Chunked.date plus, for an ISO, an $in on Chunked.tags (retrieval.py). In the
+# temporary_collection mode it runs as a $match on Chunked for every query, in the prefilter mode it goes into $vectorSearch
+# and has to be declared on the vector index. Without a supporting index it scans the whole collection, and nothing says so
+# until queries get slow. This checks that
+#   Chunked (date, tags)     --> date first, so the same index serves the N/A shape; the tags $in is checked on the index keys
+#   NonChunked _id           --> the parent lookup after every search
+#   the Atlas vector indexes --> declare date and tags as filter fields, on Chunked and on the partitions the window touches
+#                                (atlas backend only)
+# exist, then explains the filters the apps generate for the window and reports the winning plan and the documents
+# examined against the documents returned.
+#
+#   python index_advisor.py                                 --> report only, exits 1 on a missing index or a bad plan
+#   python index_advisor.py --create                        --> also creates what is missing
+#   python index_advisor.py --start-date 2024-01-01 --end-date 2024-06-30
+#
+# Worth running after ingest.py / partitions.py and from whatever checks a deploy.
+#
+# [index_advisor]
+# max_examined_ratio = 2        --> documents examined per document returned above which a plan is reported
+
+REQUIRED_INDEXES = {
+    "Chunked": [[("date", 1), ("tags", 1)]],
+    "NonChunked": [[("_id", 1)]]
+}
+
+FILTER_PATHS = ("date", "tags")
+
+
+# an existing index serves the keys when they are a prefix of it
+def has_index(collection, keys):
+    for index in collection.index_information().values():
+        if [tuple(key) for key in index["key"]][:len(keys)] == keys:
+            return True
+    return False
+
+
+def check_indexes(db, create=False):
+    results = []
+    for collection_name, required in REQUIRED_INDEXES.items():
+        for keys in required:
+            result = {'collection': collection_name, 'index': keys, 'ok': has_index(db[collection_name], keys), 'created': False}
+            # the _id index always exists and cannot be created
+            if not result['ok'] and create and keys != [("_id", 1)]:
+                db[collection_name].create_index(keys)
+                result['ok'] = result['created'] = True
+            results.append(result)
+    return results
+
+
+def vector_index_collections(start_date, end_date):
+    names = ["Chunked"]
+    if partitions.enabled():
+        names += partitions.partitions_for(start_date, end_date)
+    return names
+
+
+def check_search_indexes(db, start_date, end_date, create=False):
+    results = []
+    for collection_name in vector_index_collections(start_date, end_date):
+        collection = db[collection_name]
+        try:
+            existing = {index["name"]: index for index in collection.list_search_indexes()}
+        except OperationFailure as e:
+            results.append({'collection': collection_name, 'index': None, 'ok': False, 'problem': f"cannot list search indexes ({e})"})
+            continue
+
+        # the same definitions partitions.py creates, the candidate index included when it is enabled
+        for model in partitions.index_models():
+            name = model.document["name"]
+            result = {'collection': collection_name, 'index': name, 'ok': True, 'problem': None}
+            if name not in existing:
+                result.update(ok=False, problem="missing")
+            else:
+                definition = existing[name].get("latestDefinition", {})
+                paths = {field["path"] for field in definition.get("fields", []) if field.get("type") == "filter"}
+                missing_paths = [path for path in FILTER_PATHS if path not in paths]
+                if missing_paths:
+                    result.update(ok=False, problem=f"no filter field for {', '.join(missing_paths)}")
+
+            if not result['ok'] and create:
+                try:
+                    if name in existing:
+                        collection.update_search_index(name, model.document["definition"])
+                    else:
+                        collection.create_search_index(model)
+                    result.update(ok=True, problem=f"{result['problem']}, fixed (the index builds in the background)")
+                except OperationFailure as e:
+                    result['problem'] = f"{result['problem']}, could not be fixed ({e})"
+            results.append(result)
+    return results
+
+
+# "FETCH > IXSCAN date_1_tags_1" for the winning plan of an explain
+def describe_plan(plan):
+    # slot based engine plans wrap the classic one
+    plan = plan.get("queryPlan", plan)
+    stages = []
+    while plan:
+        stage = plan["stage"]
+        if "indexName" in plan:
+            stage += f" {plan['indexName']}"
+        stages.append(stage)
+        inputs = plan.get("inputStages") or [plan.get("inputStage")]
+        plan = inputs[0]
+    return " > ".join(stages)
+
+
+def plan_stages(plan):
+    plan = plan.get("queryPlan", plan)
+    stages = [plan["stage"]]
+    for child in plan.get("inputStages", []) + ([plan["inputStage"]] if "inputStage" in plan else []):
+        stages += plan_stages(child)
+    return stages
+
+
+def explain_command(db, command):
+    explained = db.command({"explain": command, "verbosity": "executionStats"})
+    # an aggregation the server could not push down entirely has the query part in its first stage
+    if "queryPlanner" not in explained:
+        explained = explained["stages"][0]["$cursor"]
+
+    stats = explained["executionStats"]
+    winning_plan = explained["queryPlanner"]["winningPlan"]
+    return {
+        'plan': describe_plan(winning_plan),
+        'collection_scan': "COLLSCAN" in plan_stages(winning_plan),
+        'returned': stats["nReturned"],
+        'docs_examined': stats["totalDocsExamined"],
+        'keys_examined': stats["totalKeysExamined"],
+        'milliseconds': stats["executionTimeMillis"]
+    }
+
+
+# the filters as the apps build them: the pre-filter for N/A and for an ISO, and the parent lookup of the chunks they return
+def query_shapes(db, start_date, end_date):
+    shapes = []
+    for iso in ("N/A", retrieval.ISOS[1]):
+        shapes.append({
+            'name': f"pre-filter, iso {iso}",
+            'command': {
+                "aggregate": "Chunked",
+                "pipeline": retrieval.data_prep_aggregation_framework(start_date, end_date, iso),
+                "cursor": {}
+            }
+        })
+
+    window = retrieval.data_prep_aggregation_framework(start_date, end_date, "N/A")[0]["$match"]
+    parent_ids = list({ObjectId(document["semi_chunked_id"]) for document in db.Chunked.find(window, {"semi_chunked_id": 1}).limit(10)})
+    shapes.append({
+        'name': "parent lookup",
+        'command': {
+            "find": "NonChunked",
+            "filter": {"_id": {"$in": parent_ids}},
+            "projection": {"_id": 1, "contents": 1, "source": 1}
+        }
+    })
+    return shapes
+
+
+def explain_shapes(db, start_date, end_date):
+    max_examined_ratio = config.get_setting("index_advisor", "max_examined_ratio", 2)
+    results = []
+    for shape in query_shapes(db, start_date, end_date):
+        result = {'name': shape['name'], **explain_command(db, shape['command'])}
+        problems = []
+        if result['collection_scan']:
+            problems.append("collection scan")
+        if result['docs_examined'] > max_examined_ratio * max(result['returned'], 1):
+            problems.append(f"{result['docs_examined']} documents examined for {result['returned']} returned")
+        result['problems'] = problems
+        results.append(result)
+    return results
+
+
+def advise(db, start_date, end_date, create=False):
+    return {
+        'indexes': check_indexes(db, create),
+        'search_indexes': check_search_indexes(db, start_date, end_date, create) if retrieval.get_retrieval_backend() == 'atlas' else [],
+        # explained after any indexes were created, so the plans show their effect
+        'plans': explain_shapes(db, start_date, end_date)
+    }
+
+
+def print_report(report):
+    for result in report['indexes']:
+        keys = ", ".join(field for field, _ in result['index'])
+        status = "created" if result['created'] else "ok" if result['ok'] else "MISSING"
+        print(f"index   {result['collection']} ({keys}): {status}")
+    for result in report['search_indexes']:
+        status = "ok" if result['problem'] is None else result['problem'] if result['ok'] else result['problem'].upper()
+        print(f"search  {result['collection']} {result['index'] or ''}: {status}")
+    for result in report['plans']:
+        print(f"plan    {result['name']}: {result['plan']}")
+        print(f"        {result['returned']} returned, {result['docs_examined']} documents / {result['keys_examined']} keys examined, {result['milliseconds']} ms")
+        for problem in result['problems']:
+            print(f"        PROBLEM: {problem}")
+
+
+def healthy(report):
+    return (
+        all(result['ok'] for result in report['indexes'] + report['search_indexes'])
+        and not any(result['problems'] for result in report['plans'])
+    )
+
+
+if __name__ == "__main__":
+    import clients
+
+    # the window both apps open with
+    today = dt.date.today()
+    parser = argparse.ArgumentParser(description="Check the indexes behind the date / ISO pre-filter and explain its query plans.")
+    parser.add_argument("--start-date", type=dt.date.fromisoformat, default=today.replace(day=1))
+    parser.add_argument("--end-date", type=dt.date.fromisoformat, default=today.replace(day=calendar.monthrange(today.year, today.month)[1]))
+    parser.add_argument("--create", action="store_true", help="create the missing indexes and add missing vector index filter fields")
+    args = parser.parse_args()
+
+    report = advise(clients.get_db(), args.start_date, args.end_date, args.create)
+    print_report(report)
+    sys.exit(0 if healthy(report) else 1)
@@ -0,0 +1,302 @@
+import json
+import hashlib
+import argparse
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+import config
+import clients
+import gateway
+import partitions
+import quantization
+import embedding_cache
+
+# Incremental ingestion of new commentaries into NonChunked (parents) and Chunked (embedded chunks).
+#
+#   python ingest.py commentaries.jsonl [more.jsonl ...]
+#   python ingest.py commentaries.jsonl --dry-run          --> report what would change without embedding or writing
+#
+# Input is JSON lines, one commentary per line:
+#   {"source": "...", "date": "2024-05-14T06:30:00", "tags": ["natural gas", "ERCOT"], "contents": "...", "key": "optional id"}
+# A commentary is identified by `key`, or by source + date when there is none.
+#
+# Only what changed costs anything:
+#   - a commentary whose content hash is already in NonChunked is skipped
+#   - a changed commentary is re-chunked, but chunks whose hash is already in Chunked reuse the stored vector
+#   - everything left is embedded in large batched text-embedding-3-large calls, several batches in flight at once
+#   - both collections are written with unordered insert_many in batches
+# A changed commentary gets a new _id (the old parent and its chunks are deleted once the new ones are in), so the
+# retrieval / parent caches keyed on _id never serve the old text.
+#
+# Documents written before ingest.py existed have no ingest_key / content_hash. The first real run keys them the way
+# parse_commentary() would (source + date) and hashes their chunks, so they are matched and their vectors reused instead
+# of the corpus being inserted and embedded a second time. A --dry-run before that counts them as new.
+#
+# With [retrieval] partitioned = true the months a run wrote to are synced into their partitions at the end (every month
+# when existing chunks were backfilled), so new chunks are searchable without a separate partitions.py run.
+#
+# [ingest]
+# chunk_words = 250
+# overlap_words = 50
+# embedding_batch_size = 256     --> texts per embeddings call
+# embedding_workers = 4          --> embeddings calls in flight
+# write_batch_size = 1000
+
+
+def content_hash(*parts):
+    return hashlib.sha256("\n".join(embedding_cache.normalize_text(str(part)) for part in parts).encode('utf-8')).hexdigest()
+
+
+def legacy_key(source, date):
+    return f"{source}|{date.isoformat()}"
+
+
+# naive UTC, like the datetimes pymongo returns, so keys and hashes built from it match the stored documents
+def parse_date(value):
+    date = dt.datetime.fromisoformat(value)
+    if date.tzinfo is not None:
+        date = date.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def parse_commentary(line, location):
+    try:
+        record = json.loads(line)
+        commentary = {
+            'source': record['source'],
+            'date': parse_date(record['date']),
+            'tags': [tag.lower() for tag in record.get('tags', [])],
+            'contents': record['contents']
+        }
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"{location}: not a valid commentary ({e})") from None
+
+    commentary['ingest_key'] = record.get('key') or legacy_key(commentary['source'], commentary['date'])
+    commentary['content_hash'] = content_hash(commentary['source'], commentary['date'].isoformat(), sorted(commentary['tags']), commentary['contents'])
+    return commentary
+
+
+def read_commentaries(paths):
+    # the last version of a commentary in the input wins
+    commentaries = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if line.strip():
+                    commentary = parse_commentary(line, f"{path}:{line_number}")
+                    commentaries[commentary['ingest_key']] = commentary
+    return list(commentaries.values())
+
+
+# overlapping windows of words, so a sentence cut at a boundary still appears whole in one of the chunks
+def chunk_text(text, chunk_words, overlap_words):
+    words = text.split()
+    if len(words) <= chunk_words:
+        return [' '.join(words)] if words else []
+
+    step = chunk_words - overlap_words
+    chunks = []
+    for start in range(0, len(words), step):
+        chunks.append(' '.join(words[start:start + chunk_words]))
+        if start + chunk_words >= len(words):
+            break
+    return chunks
+
+
+def batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def embed_texts(texts):
+    batch_size = config.get_setting("ingest", "embedding_batch_size", 256)
+    workers = config.get_setting("ingest", "embedding_workers", 4)
+
+    # batch priority, so the apps' questions get ahead of a large ingest (see gateway.py)
+    def embed_batch(batch):
+        response = gateway.create_embeddings(batch, embedding_cache.EMBEDDING_MODEL, priority=gateway.BATCH)
+        return [item.embedding for item in response.data]
+
+    vectors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_vectors in executor.map(embed_batch, list(batches(texts, batch_size))):
+            vectors.extend(batch_vectors)
+    return vectors
+
+
+# unordered, so one duplicate (e.g. from a concurrent run) does not stop the rest of the batch
+def insert_unordered(collection, documents):
+    for batch in batches(documents, config.get_setting("ingest", "write_batch_size", 1000)):
+        try:
+            collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            errors = [error for error in e.details['writeErrors'] if error['code'] != 11000]
+            if errors:
+                raise
+
+
+def update_unordered(collection, requests):
+    updated = 0
+    for batch in batches(requests, config.get_setting("ingest", "write_batch_size", 1000)):
+        try:
+            updated += collection.bulk_write(batch, ordered=False).modified_count
+        except BulkWriteError as e:
+            errors = [error for error in e.details['writeErrors'] if error['code'] != 11000]
+            if errors:
+                raise
+            updated += e.details['nModified']
+    return updated
+
+
+# gives documents from before ingest.py their ingest_key / content_hash; a no-op once everything has them
+def backfill_legacy(db):
+    requests = []
+    keys = set()
+    for doc in db.NonChunked.find({'ingest_key': {'$exists': False}}, {'source': 1, 'date': 1, 'tags': 1, 'contents': 1}):
+        if not all(field in doc for field in ('source', 'date', 'contents')):
+            continue
+        key = legacy_key(doc['source'], doc['date'])
+        # of several stored copies of one commentary only the first is keyed (the unique index allows no more)
+        if key in keys:
+            continue
+        keys.add(key)
+        tags = sorted(tag.lower() for tag in doc.get('tags', []))
+        requests.append(UpdateOne(
+            {'_id': doc['_id']},
+            {'$set': {'ingest_key': key, 'content_hash': content_hash(doc['source'], doc['date'].isoformat(), tags, doc['contents'])}}
+        ))
+    parents = update_unordered(db.NonChunked, requests)
+
+    # null also matches a missing field, and uses the content_hash index
+    requests = [
+        UpdateOne({'_id': doc['_id']}, {'$set': {'content_hash': content_hash(doc['contents'])}})
+        for doc in db.Chunked.find({'content_hash': None}, {'contents': 1}) if 'contents' in doc
+    ]
+    chunks = update_unordered(db.Chunked, requests)
+
+    return {'parents': parents, 'chunks': chunks}
+
+
+def ensure_indexes(db):
+    db.NonChunked.create_index(
+        [('ingest_key', 1), ('content_hash', 1)],
+        unique=True,
+        partialFilterExpression={'ingest_key': {'$exists': True}}
+    )
+    db.Chunked.create_index('content_hash')
+    db.Chunked.create_index('semi_chunked_id')
+
+
+def ingest(db, commentaries, dry_run=False):
+    chunk_words = config.get_setting("ingest", "chunk_words", 250)
+    overlap_words = config.get_setting("ingest", "overlap_words", 50)
+
+    stats = {'commentaries': len(commentaries), 'unchanged': 0, 'new': 0, 'changed': 0, 'chunks': 0, 'reused_vectors': 0, 'embedded': 0}
+    if not dry_run:
+        stats['backfilled'] = backfill_legacy(db)
+
+    # what is already stored for these commentaries
+    existing = {}
+    for batch in batches([commentary['ingest_key'] for commentary in commentaries], 10000):
+        for doc in db.NonChunked.find({'ingest_key': {'$in': batch}}, {'ingest_key': 1, 'content_hash': 1, 'date': 1}):
+            existing.setdefault(doc['ingest_key'], []).append(doc)
+
+    parents = []
+    chunks = []
+    replaced_ids = []
+    replaced_months = set()
+    ingested_at = dt.datetime.utcnow()
+    for commentary in commentaries:
+        stored = existing.get(commentary['ingest_key'], [])
+        if any(doc['content_hash'] == commentary['content_hash'] for doc in stored):
+            stats['unchanged'] += 1
+            continue
+
+        stats['changed' if stored else 'new'] += 1
+        replaced_ids.extend(doc['_id'] for doc in stored)
+        replaced_months.update((doc['date'].year, doc['date'].month) for doc in stored)
+
+        parent = {'_id': ObjectId(), **commentary, 'ingested_at': ingested_at}
+        parents.append(parent)
+        for text in chunk_text(commentary['contents'], chunk_words, overlap_words):
+            chunks.append({
+                'source': commentary['source'],
+                'date': commentary['date'],
+                'tags': commentary['tags'],
+                'contents': text,
+                'semi_chunked_id': parent['_id'],
+                'content_hash': content_hash(text)
+            })
+    stats['chunks'] = len(chunks)
+
+    # chunks that are already embedded somewhere in Chunked (e.g. the unchanged paragraphs of an edited commentary)
+    hashes = list({chunk['content_hash'] for chunk in chunks})
+    stored_vectors = {}
+    for batch in batches(hashes, 10000):
+        for doc in db.Chunked.find({'content_hash': {'$in': batch}}, {'_id': 0, 'content_hash': 1, 'vector': 1}):
+            stored_vectors[doc['content_hash']] = doc['vector']
+
+    # identical chunks within this run are embedded once
+    to_embed = {}
+    for chunk in chunks:
+        if chunk['content_hash'] in stored_vectors:
+            stats['reused_vectors'] += 1
+        else:
+            to_embed.setdefault(chunk['content_hash'], chunk['contents'])
+    stats['embedded'] = len(to_embed)
+
+    if dry_run:
+        return stats
+
+    stored_vectors.update(zip(to_embed, embed_texts(list(to_embed.values()))))
+    for chunk in chunks:
+        chunk['vector'] = stored_vectors[chunk['content_hash']]
+
+    # the short copy searched by an Atlas candidate index (see quantization.py)
+    if quantization.enabled():
+        vector_path = config.get_setting("candidates", "vector_path", "vector_short")
+        dimensions = config.get_setting("candidates", "dimensions", 512)
+        for chunk in chunks:
+            chunk[vector_path] = quantization.shorten(chunk['vector'], dimensions).tolist()
+
+    # parents before chunks, and old versions only removed once the new ones are in, so a search never finds a chunk without its parent
+    insert_unordered(db.NonChunked, parents)
+    insert_unordered(db.Chunked, chunks)
+    if replaced_ids:
+        db.Chunked.delete_many({'semi_chunked_id': {'$in': replaced_ids}})
+        db.NonChunked.delete_many({'_id': {'$in': replaced_ids}})
+
+    if partitions.enabled():
+        months = replaced_months | {(chunk['date'].year, chunk['date'].month) for chunk in chunks}
+        # backfilled chunks got a content_hash in place, in any month
+        if stats['backfilled']['chunks']:
+            stats['partitions'] = partitions.sync_partitions(db)
+        elif months:
+            stats['partitions'] = partitions.sync_partitions(db, sorted(months))
+
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chunk, embed and store new or changed commentaries in NonChunked / Chunked.")
+    parser.add_argument("paths", nargs="+", help="JSON lines files, one commentary per line")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be embedded and written")
+    args = parser.parse_args()
+
+    db = clients.get_db()
+    ensure_indexes(db)
+
+    stats = ingest(db, read_commentaries(args.paths), args.dry_run)
+    print(
+        f"{stats['commentaries']} commentaries: {stats['new']} new, {stats['changed']} changed, {stats['unchanged']} unchanged; "
+        f"{stats['chunks']} chunks, {stats['reused_vectors']} vectors reused, {stats['embedded']} embedded"
+        + (" (dry run, nothing written)" if args.dry_run else "")
+    )
+    if not args.dry_run and any(stats['backfilled'].values()):
+        print(f"keyed {stats['backfilled']['parents']} existing commentaries and hashed {stats['backfilled']['chunks']} existing chunks")
+    for result in stats.get('partitions', []):
+        print(f"{result['partition']}: {result['copied']} copied, {result['updated']} updated, {result['removed']} removed")
@@ -0,0 +1,249 @@
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Bounded pool of worker threads for the apps' RAG / search requests.
+#
+# With [jobs] background = true the apps submit each request here instead of running it on the Streamlit script thread.
+# The page then polls the job (job id in session_state) for its stage-by-stage progress and any partial answer, and
+# can cancel it; the script thread is free the whole time. The job builds its request from the session's Conversation,
+# which is locked for that (see session_store.py).
+#
+# Admission control: a submit is refused with QueueFullError when max_queued jobs are already waiting, or when the session
+# already has max_jobs_per_session unfinished jobs.
+# Cancellation is cooperative: a cancelled job stops at the start of its next stage (see metrics.py) or the next streamed token.
+#
+# [jobs]
+# background = false
+# max_workers = 8
+# max_queued = 32
+# max_jobs_per_session = 1
+# keep_seconds = 600        --> how long a finished job stays around to be picked up
+
+JOB_STATES = ('queued', 'running', 'done', 'failed', 'cancelled')
+FINISHED_STATES = ('done', 'failed', 'cancelled')
+
+JobCancelled = metrics.QueryCancelled
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class Job:
+    def __init__(self, name, function, args, owner=None, attributes=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.function = function
+        self.args = args
+        self.owner = owner
+        self.attributes = attributes or {}
+
+        self.state = 'queued'
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        # per-stage timings of the running job, see metrics.QueryTrace
+        self.trace = None
+        self.cancel_requested = threading.Event()
+        self.lock = threading.Lock()
+        # answer text streamed so far, for the page to show while the job runs
+        self.partial_text = []
+        # a line the job sets itself, e.g. how far a bulk search has got; shown instead of the current stage
+        self.status = None
+
+    @property
+    def finished(self):
+        return self.state in FINISHED_STATES
+
+    def append_text(self, text):
+        with self.lock:
+            self.partial_text.append(text)
+
+    def text(self):
+        with self.lock:
+            return "".join(self.partial_text)
+
+    def check_cancelled(self):
+        if self.cancel_requested.is_set():
+            raise JobCancelled(self.name)
+
+    def progress(self):
+        progress = {'state': self.state, 'finished': [], 'running': []}
+        if self.trace is not None:
+            progress.update(self.trace.progress())
+        end = self.finished_at or time.time()
+        progress['elapsed'] = end - (self.started_at or self.created_at)
+        return progress
+
+
+class JobPool:
+    def __init__(self, max_workers, max_queued, max_jobs_per_session, keep_seconds):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_jobs_per_session = max_jobs_per_session
+        self.keep_seconds = keep_seconds
+
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.jobs = {}
+        self.running = 0
+        self.rejected = 0
+
+        self.workers = [threading.Thread(target=self.work, name=f"job-worker-{number}", daemon=True) for number in range(max_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _expire(self):
+        cutoff = time.time() - self.keep_seconds
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished and job.finished_at is not None and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+
+    # function(job, *args) runs on a worker; it can report partial text and check for cancellation through the job
+    def submit(self, name, function, *args, owner=None, attributes=None):
+        with self.condition:
+            self._expire()
+
+            if owner is not None:
+                active = sum(1 for job in self.jobs.values() if job.owner == owner and not job.finished)
+                if active >= self.max_jobs_per_session:
+                    self.rejected += 1
+                    raise QueueFullError("Your previous request is still running.")
+
+            if len(self.queue) >= self.max_queued:
+                self.rejected += 1
+                raise QueueFullError("The server is busy, please try again in a minute.")
+
+            job = Job(name, function, args, owner, attributes)
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            self.condition.notify()
+            return job
+
+    def get(self, job_id):
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    # 1 for the next job to start, None once it has started
+    def queue_position(self, job):
+        with self.condition:
+            try:
+                return self.queue.index(job) + 1
+            except ValueError:
+                return None
+
+    def cancel(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.finished:
+                return
+            job.cancel_requested.set()
+            if job.trace is not None:
+                job.trace.cancelled.set()
+            # a job that has not started is simply taken off the queue
+            if job in self.queue:
+                self.queue.remove(job)
+                job.state = 'cancelled'
+                job.finished_at = time.time()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                job = self.queue.popleft()
+                job.state = 'running'
+                job.started_at = time.time()
+                self.running += 1
+
+            job.trace = metrics.start_trace(job.name, **job.attributes)
+            if job.cancel_requested.is_set():
+                job.trace.cancelled.set()
+            result = error = None
+            state = 'failed'
+            try:
+                result = job.function(job, *job.args)
+                state = 'done'
+            except JobCancelled:
+                state = 'cancelled'
+            except Exception as e:
+                logger.exception("Job %s (%s) failed", job.id, job.name)
+                error = e
+                state = 'failed'
+            finally:
+                metrics.finish_trace(job.trace)
+                # all at once, so a finished job always has its finished_at (see _expire)
+                with self.condition:
+                    job.result = result
+                    job.error = error
+                    job.state = state
+                    job.finished_at = time.time()
+                    self.running -= 1
+
+    def stats(self):
+        with self.condition:
+            return {'queued': len(self.queue), 'running': self.running, 'jobs': len(self.jobs), 'rejected': self.rejected}
+
+
+# one pool per process, shared by every session
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def background_enabled():
+    return config.get_setting("jobs", "background", False)
+
+
+def get_job_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = JobPool(
+                config.get_setting("jobs", "max_workers", 8),
+                config.get_setting("jobs", "max_queued", 32),
+                config.get_setting("jobs", "max_jobs_per_session", 1),
+                config.get_setting("jobs", "keep_seconds", 600)
+            )
+        return _pool
+
+
+STAGE_LABELS = {
+    'embed': "Embedding the question",
+    'filter': "Filtering by date / ISO",
+    'index_sync_wait': "Waiting for the search index",
+    'lexical': "Keyword search",
+    'search': "Vector search",
+    'diversify': "Picking diverse results",
+    'parents': "Fetching the commentaries",
+    'context': "Assembling the context",
+    'chat': "Writing the answer"
+}
+
+
+# one line describing where a job is, for the progress display
+def describe_progress(pool, job):
+    progress = job.progress()
+    if job.state == 'queued':
+        position = pool.queue_position(job)
+        return f"Waiting for a free worker (position {position} in the queue)" if position else "Starting..."
+
+    if job.status and not job.finished:
+        return f"{job.status} ({progress['elapsed']:.0f}s)"
+
+    if progress['running']:
+        current = ", ".join(STAGE_LABELS.get(stage, stage) for stage in progress['running'])
+    elif job.finished:
+        current = job.state.capitalize()
+    else:
+        current = "Working"
+    return f"{current}... ({progress['elapsed']:.0f}s, {len(progress['finished'])} steps done)"
@@ -0,0 +1,297 @@
+import os
+import re
+import json
+import time
+import argparse
+import threading
+from collections import Counter
+
+import numpy as np
+
+import config
+import metrics
+import local_index
+
+# Local BM25 inverted index over Chunked.contents for hybrid lexical + vector retrieval.
+#
+# Exact terms (HDDs, CDDs, terminal names, ISO names) are matched by BM25 and fused with the vector results by reciprocal
+# rank fusion; a short keyword-style query whose terms are all in the index can skip the embeddings call altogether
+# (see pipeline.py). Rows are sorted by date, with the same date / ISO filtering as the local vector index.
+#
+#   python lexical_index.py --path lexical_index      --> builds the index from Chunked and saves it
+#
+# [hybrid]
+# enabled = false
+# candidates = 50               --> results taken from each of the vector and lexical lists into the fusion
+# rrf_k = 60
+# max_keyword_terms = 4         --> longest query treated as keyword-shaped for the lexical-only fast path
+#
+# [lexical_index]
+# path = "lexical_index"       --> relative to this directory
+# reload_seconds = 3600
+
+INDEX_FILES = ('postings.npz', 'vocabulary.json', 'tags.json')
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.'][a-z0-9]+)*")
+
+
+# lower case words with a simple plural fold, so "HDDs" matches "HDD" and "terminals" matches "terminal"
+def tokenize(text):
+    terms = []
+    for term in TOKEN_PATTERN.findall(text.lower()):
+        term = term.replace("'", "")
+        if len(term) > 3 and term.endswith('s') and not term.endswith('ss'):
+            term = term[:-1]
+        terms.append(term)
+    return terms
+
+
+class LexicalIndex:
+    def __init__(self, vocabulary, term_offsets, posting_rows, posting_counts, doc_lengths, dates, semi_chunked_ids, chunk_ids, tag_rows):
+        # term --> term id; the postings of term id t are posting_rows / posting_counts[term_offsets[t]:term_offsets[t + 1]]
+        self.vocabulary = vocabulary
+        self.term_offsets = term_offsets
+        self.posting_rows = posting_rows
+        self.posting_counts = posting_counts
+
+        self.doc_lengths = doc_lengths
+        self.average_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+        self.dates = dates
+        self.semi_chunked_ids = semi_chunked_ids
+        self.chunk_ids = chunk_ids
+        self.tag_rows = tag_rows
+
+    def __len__(self):
+        return len(self.dates)
+
+    def filter_rows(self, start_date, end_date, iso):
+        return local_index.filter_rows(self.dates, self.tag_rows, start_date, end_date, iso)
+
+    def postings(self, term):
+        term_id = self.vocabulary.get(term)
+        if term_id is None:
+            return None, None
+        start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+        return self.posting_rows[start:end], self.posting_counts[start:end]
+
+    def search(self, query, start_date, end_date, iso, limit):
+        return self.search_rows(query, self.filter_rows(start_date, end_date, iso), limit)
+
+    # BM25 top-k within the filtered rows
+    def search_rows(self, query, rows, limit):
+        if len(rows) == 0 or len(self) == 0:
+            return []
+
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in set(tokenize(query)):
+            posting_rows, counts = self.postings(term)
+            if posting_rows is None:
+                continue
+            idf = np.log(1 + (len(self) - len(posting_rows) + .5) / (len(posting_rows) + .5))
+            lengths = self.doc_lengths[posting_rows]
+            # rows are unique within one term's postings, so plain fancy indexing accumulates correctly
+            scores[posting_rows] += idf * counts * (K1 + 1) / (counts + K1 * (1 - B + B * lengths / self.average_length))
+
+        scores = scores[rows]
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) == 0:
+            return []
+
+        k = min(limit, len(matched))
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+
+        return [
+            {'_id': self.chunk_ids[rows[position]], 'semi_chunked_id': self.semi_chunked_ids[rows[position]], 'score': float(scores[position])}
+            for position in top
+        ]
+
+    # short, no question, and every term is in the index, so BM25 alone should answer it
+    def is_keyword_query(self, query):
+        if '?' in query or len(query.split()) > config.get_setting("hybrid", "max_keyword_terms", 4):
+            return False
+        terms = tokenize(query)
+        return bool(terms) and all(term in self.vocabulary for term in terms)
+
+
+# fuses ranked result lists by summing 1 / (rrf_k + rank); documents are matched on their chunk _id
+def reciprocal_rank_fusion(result_lists, limit, rrf_k=None):
+    rrf_k = rrf_k or config.get_setting("hybrid", "rrf_k", 60)
+
+    scores = {}
+    documents = {}
+    for results in result_lists:
+        for rank, document in enumerate(results, 1):
+            key = str(document['_id'])
+            scores[key] = scores.get(key, 0.0) + 1 / (rrf_k + rank)
+            # the first list's copy wins, so vector results keep their source / contents
+            documents.setdefault(key, document)
+
+    fused = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [{**documents[key], 'score': scores[key]} for key in fused]
+
+
+def build(documents):
+    vocabulary = {}
+    term_ids = []
+    rows = []
+    counts = []
+    doc_lengths = []
+    dates = []
+    semi_chunked_ids = []
+    chunk_ids = []
+    tag_rows = {}
+
+    for row, doc in enumerate(documents):
+        terms = tokenize(doc.get('contents', ''))
+        doc_lengths.append(len(terms))
+        for term, count in Counter(terms).items():
+            term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+            rows.append(row)
+            counts.append(count)
+
+        dates.append(doc['date'])
+        semi_chunked_ids.append(str(doc['semi_chunked_id']))
+        chunk_ids.append(str(doc['_id']))
+        for tag in doc.get('tags', []):
+            tag_rows.setdefault(tag.lower(), []).append(row)
+
+    # postings grouped by term (and by row within a term, as the rows were visited in order)
+    term_ids = np.asarray(term_ids, dtype=np.int64)
+    order = np.argsort(term_ids, kind='stable')
+    term_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_ids, minlength=len(vocabulary)), out=term_offsets[1:])
+
+    return LexicalIndex(
+        vocabulary,
+        term_offsets,
+        np.asarray(rows, dtype=np.int64)[order],
+        np.asarray(counts, dtype=np.float32)[order],
+        np.asarray(doc_lengths, dtype=np.float32),
+        np.asarray(dates, dtype='datetime64[s]'),
+        np.asarray(semi_chunked_ids),
+        np.asarray(chunk_ids),
+        {tag: np.asarray(tag_row_list, dtype=np.int64) for tag, tag_row_list in tag_rows.items()}
+    )
+
+
+def load_from_mongo(db):
+    projection = {'_id': 1, 'contents': 1, 'date': 1, 'tags': 1, 'semi_chunked_id': 1}
+    return build(db.Chunked.find({}, projection).sort('date', 1))
+
+
+def save(index, path):
+    os.makedirs(path, exist_ok=True)
+    np.savez(
+        os.path.join(path, 'postings.npz'),
+        term_offsets=index.term_offsets,
+        posting_rows=index.posting_rows,
+        posting_counts=index.posting_counts,
+        doc_lengths=index.doc_lengths,
+        dates=index.dates,
+        semi_chunked_ids=index.semi_chunked_ids,
+        chunk_ids=index.chunk_ids
+    )
+    with open(os.path.join(path, 'vocabulary.json'), 'w') as f:
+        json.dump(index.vocabulary, f)
+    with open(os.path.join(path, 'tags.json'), 'w') as f:
+        json.dump({tag: rows.tolist() for tag, rows in index.tag_rows.items()}, f)
+
+
+def load(path):
+    with open(os.path.join(path, 'vocabulary.json')) as f:
+        vocabulary = json.load(f)
+    with open(os.path.join(path, 'tags.json')) as f:
+        tag_rows = {tag: np.asarray(rows, dtype=np.int64) for tag, rows in json.load(f).items()}
+    with np.load(os.path.join(path, 'postings.npz')) as stored:
+        return LexicalIndex(
+            vocabulary,
+            stored['term_offsets'],
+            stored['posting_rows'],
+            stored['posting_counts'],
+            stored['doc_lengths'],
+            stored['dates'],
+            stored['semi_chunked_ids'],
+            stored['chunk_ids'],
+            tag_rows
+        )
+
+
+def index_exists(path):
+    return all(os.path.exists(os.path.join(path, name)) for name in INDEX_FILES)
+
+
+# one index per process, shared by every session
+_index = None
+_index_loaded_at = 0.0
+_index_lock = threading.Lock()
+# held by the one thread (re)building the index; the lock above only guards swapping the reference
+_reload_lock = threading.Lock()
+
+
+def index_is_current():
+    return _index is not None and time.monotonic() - _index_loaded_at <= config.get_setting("lexical_index", "reload_seconds", 3600)
+
+
+def build_index(db):
+    path = config.get_path_setting("lexical_index", "path", "lexical_index")
+    return load(path) if index_exists(path) else load_from_mongo(db)
+
+
+# same as local_index.get_local_index(): the rebuild runs outside _index_lock and the other queries keep searching the
+# current index meanwhile; only the very first load is waited for
+def get_lexical_index(db):
+    global _index, _index_loaded_at
+    with _index_lock:
+        if index_is_current():
+            return _index
+        current = _index
+
+    if not _reload_lock.acquire(blocking=current is None):
+        return current
+    try:
+        with _index_lock:
+            if index_is_current():
+                return _index
+        index = build_index(db)
+        with _index_lock:
+            _index = index
+            _index_loaded_at = time.monotonic()
+        return index
+    finally:
+        _reload_lock.release()
+
+
+def use_lexical_index(index):
+    global _index, _index_loaded_at
+    with _index_lock:
+        _index = index
+        _index_loaded_at = time.monotonic()
+
+
+def hybrid_enabled():
+    return config.get_setting("hybrid", "enabled", False)
+
+
+# the lexical half of a hybrid search
+def search_lexical(db, user_prompt, start_date, end_date, iso, limit):
+    with metrics.span("lexical") as span:
+        results = get_lexical_index(db).search(user_prompt, start_date, end_date, iso, limit)
+        span['chunks'] = len(results)
+    return results
+
+
+if __name__ == "__main__":
+    import clients
+
+    parser = argparse.ArgumentParser(description="Build the BM25 lexical index from the Chunked collection.")
+    parser.add_argument("--path", default=config.get_path_setting("lexical_index", "path", "lexical_index"))
+    args = parser.parse_args()
+
+    index = load_from_mongo(clients.get_db())
+    save(index, args.path)
+    print(f"Wrote {len(index)} chunks and {len(index.vocabulary)} terms to {args.path}")
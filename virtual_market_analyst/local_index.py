@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import argparse
+import threading
+import datetime as dt
+import numpy as np
+
+import config
+import quantization
+
+# In-process alternative to Atlas $vectorSearch.
+#
+# The Chunked embeddings are held in a (rows x dims) float32 matrix, L2 normalised so a dot product is the cosine similarity,
+# with date / tags / semi_chunked_id side columns. Rows are sorted by date so the date range filter is a slice.
+#
+# [local_index]
+# path = "local_index"      --> directory written by `python local_index.py`, relative to this directory; loaded
+#                               memory-mapped when present, otherwise the index is built from Chunked
+# reload_seconds = 3600     --> how long a process keeps a loaded index before re-reading it; one module level index
+#                               per process, rebuilt in the background while queries keep using the current one
+#
+# With [candidates] enabled the search first ranks a reduced / quantized copy of the matrix and only rescores the top
+# numCandidates rows with the full vectors (see quantization.py)
+
+INDEX_FILES = ('vectors.npy', 'dates.npy', 'semi_chunked_ids.npy', 'chunk_ids.npy', 'tags.json')
+
+
+# same date / ISO filtering as retrieval.data_prep_aggregation_framework(), returned as row numbers of a date sorted index
+def filter_rows(dates, tag_rows, start_date, end_date, iso):
+    start = np.datetime64(dt.datetime.combine(start_date, dt.datetime.min.time()), 's')
+    end = np.datetime64(dt.datetime.combine(end_date, dt.datetime.min.time()), 's')
+
+    lo = np.searchsorted(dates, start, side='left')
+    hi = np.searchsorted(dates, end, side='right')
+    rows = np.arange(lo, hi)
+
+    iso = iso.lower()
+    if iso != "n/a":
+        rows = np.intersect1d(rows, tag_rows.get(iso, np.empty(0, dtype=np.int64)), assume_unique=True)
+
+    return rows
+
+
+class LocalVectorIndex:
+    def __init__(self, vectors, dates, semi_chunked_ids, chunk_ids, tag_rows, candidates=None):
+        self.vectors = vectors
+        self.dates = dates
+        self.semi_chunked_ids = semi_chunked_ids
+        self.chunk_ids = chunk_ids
+        # tag --> sorted array of the row numbers carrying that tag
+        self.tag_rows = tag_rows
+        # quantization.CandidateVectors, or None for an exact search over every row
+        self.candidates = candidates
+
+    def __len__(self):
+        return len(self.dates)
+
+    def filter_rows(self, start_date, end_date, iso):
+        return filter_rows(self.dates, self.tag_rows, start_date, end_date, iso)
+
+    # top-k cosine search over the filtered rows; exact unless candidate vectors are attached
+    def search(self, prompt_vector, start_date, end_date, iso, limit, num_candidates=None):
+        return self.search_rows(prompt_vector, self.filter_rows(start_date, end_date, iso), limit, num_candidates)
+
+    def search_rows(self, prompt_vector, rows, limit, num_candidates=None, with_vectors=False):
+        if len(rows) == 0:
+            return []
+
+        query = np.asarray(prompt_vector, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+
+        # narrow down to the best candidates on the small matrix, then rescore those with the full vectors below
+        if self.candidates is not None and num_candidates and len(rows) > num_candidates:
+            rows = np.sort(self.candidates.candidate_rows(query, rows, max(num_candidates, limit)))
+
+        # without an ISO filter the rows are one contiguous date slice, which avoids copying the matrix
+        if rows[-1] - rows[0] + 1 == len(rows):
+            scores = self.vectors[rows[0]:rows[-1] + 1] @ query
+        else:
+            scores = self.vectors[rows] @ query
+
+        k = min(limit, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        for position in top:
+            row = rows[position]
+            result = {
+                '_id': self.chunk_ids[row],
+                'semi_chunked_id': self.semi_chunked_ids[row],
+                'score': float(scores[position])
+            }
+            # for the MMR stage (see diversity.py)
+            if with_vectors:
+                result['vector'] = self.vectors[row]
+            results.append(result)
+        return results
+
+
+# divides rows by their norm in place, a block at a time, so no second full size matrix is allocated
+def normalise_in_place(vectors, block_rows=65536):
+    for start in range(0, len(vectors), block_rows):
+        block = vectors[start:start + block_rows]
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        block /= norms
+
+
+# reads the vector / date / tags / semi_chunked_id columns out of Chunked and builds the index in memory; each vector is
+# copied straight into a float32 matrix sized from the document count, never held as a list of Python floats
+def load_from_mongo(db):
+    projection = {'_id': 1, 'vector': 1, 'date': 1, 'tags': 1, 'semi_chunked_id': 1}
+    count = db.Chunked.count_documents({})
+    cursor = db.Chunked.find({}, projection).sort('date', 1)
+
+    vectors = None
+    dates = []
+    semi_chunked_ids = []
+    chunk_ids = []
+    tag_lists = []
+    for row, doc in enumerate(cursor):
+        if vectors is None:
+            vectors = np.empty((max(count, 1), len(doc['vector'])), dtype=np.float32)
+        elif row == len(vectors):
+            # chunks inserted since the count
+            vectors = np.concatenate([vectors, np.empty((max(1024, row // 10), vectors.shape[1]), dtype=np.float32)])
+        vectors[row] = doc['vector']
+        dates.append(doc['date'])
+        semi_chunked_ids.append(str(doc['semi_chunked_id']))
+        chunk_ids.append(str(doc['_id']))
+        tag_lists.append([tag.lower() for tag in doc.get('tags', [])])
+
+    if vectors is not None:
+        vectors = vectors[:len(dates)]
+        normalise_in_place(vectors)
+    else:
+        vectors = np.empty((0, 0), dtype=np.float32)
+
+    tag_rows = {}
+    for row, tags in enumerate(tag_lists):
+        for tag in tags:
+            tag_rows.setdefault(tag, []).append(row)
+    tag_rows = {tag: np.asarray(rows, dtype=np.int64) for tag, rows in tag_rows.items()}
+
+    return LocalVectorIndex(
+        vectors,
+        np.asarray(dates, dtype='datetime64[s]'),
+        np.asarray(semi_chunked_ids),
+        np.asarray(chunk_ids),
+        tag_rows
+    )
+
+
+def save(index, path):
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'vectors.npy'), index.vectors)
+    np.save(os.path.join(path, 'dates.npy'), index.dates)
+    np.save(os.path.join(path, 'semi_chunked_ids.npy'), index.semi_chunked_ids)
+    np.save(os.path.join(path, 'chunk_ids.npy'), index.chunk_ids)
+    with open(os.path.join(path, 'tags.json'), 'w') as f:
+        json.dump({tag: rows.tolist() for tag, rows in index.tag_rows.items()}, f)
+
+
+# the embedding matrix is memory-mapped so several processes can share the page cache instead of each holding a copy
+def load(path):
+    with open(os.path.join(path, 'tags.json')) as f:
+        tag_rows = {tag: np.asarray(rows, dtype=np.int64) for tag, rows in json.load(f).items()}
+
+    return LocalVectorIndex(
+        np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r'),
+        np.load(os.path.join(path, 'dates.npy')),
+        np.load(os.path.join(path, 'semi_chunked_ids.npy')),
+        np.load(os.path.join(path, 'chunk_ids.npy')),
+        tag_rows
+    )
+
+
+def index_exists(path):
+    return all(os.path.exists(os.path.join(path, name)) for name in INDEX_FILES)
+
+
+# one index per process, shared by every session; a module level instance so batch scripts and benchmarks share it too
+_index = None
+_index_loaded_at = 0.0
+_index_lock = threading.Lock()
+# held by the one thread (re)building the index; the lock above only guards swapping the reference
+_reload_lock = threading.Lock()
+
+
+def index_is_current():
+    return _index is not None and time.monotonic() - _index_loaded_at <= config.get_setting("local_index", "reload_seconds", 3600)
+
+
+def build_index(db):
+    path = config.get_path_setting("local_index", "path", "local_index")
+    index = load(path) if index_exists(path) else load_from_mongo(db)
+    if quantization.enabled():
+        index.candidates = quantization.candidates_for(index, path if index_exists(path) else None)
+    return index
+
+
+# a reload runs on whichever thread finds the index expired while every other query keeps using the current one; only the
+# very first load is waited for
+def get_local_index(db):
+    global _index, _index_loaded_at
+    with _index_lock:
+        if index_is_current():
+            return _index
+        current = _index
+
+    if not _reload_lock.acquire(blocking=current is None):
+        return current
+    try:
+        with _index_lock:
+            if index_is_current():
+                return _index
+        index = build_index(db)
+        with _index_lock:
+            _index = index
+            _index_loaded_at = time.monotonic()
+        return index
+    finally:
+        _reload_lock.release()
+
+
+# installs an index built elsewhere (e.g. the benchmark's synthetic corpus) as the process wide one
+def use_local_index(index):
+    global _index, _index_loaded_at
+    with _index_lock:
+        _index = index
+        _index_loaded_at = time.monotonic()
+
+
+if __name__ == "__main__":
+    import clients
+
+    parser = argparse.ArgumentParser(description="Build the local vector index from the Chunked collection.")
+    parser.add_argument("--path", default=config.get_path_setting("local_index", "path", "local_index"))
+    args = parser.parse_args()
+
+    index = load_from_mongo(clients.get_db())
+    save(index, args.path)
+    print(f"Wrote {len(index)} chunks to {args.path}")
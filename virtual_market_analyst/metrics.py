@@ -0,0 +1,226 @@
+import sys
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager, nullcontext
+
+import streamlit as st
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Per-query timing spans for the query path: embed --> filter (and the TemporaryChunked index sync wait) --> search --> parents
+# --> context --> chat, plus document and token counts.
+#
+# The apps open a trace per query with start_trace(); the stages record into whichever trace is current, including from the
+# pipeline's worker threads (asyncio.to_thread copies the context). With no trace open (batch jobs, benchmark) span() is a no-op.
+# The start of every span is also where a cancelled query stops (see jobs.py).
+#
+# [metrics]
+# debug_panel = false       --> show a "Query timings" expander under every answer / search
+# json_log = false          --> write one JSON line per query to stderr
+# prometheus_port = 0       --> serve stage latency histograms and token / document counters on this port (needs prometheus_client)
+
+STAGES = ('embed', 'filter', 'index_sync_wait', 'lexical', 'search', 'diversify', 'parents', 'context', 'chat')
+
+
+class QueryCancelled(Exception):
+    pass
+
+
+class QueryTrace:
+    def __init__(self, app, **attributes):
+        self.app = app
+        self.attributes = attributes
+        self.started = time.perf_counter()
+        self.duration_ms = None
+        self.lock = threading.Lock()
+
+        # {'stage', 'offset_ms', 'duration_ms', ...}; offsets are from the start of the query, so overlapping stages are visible
+        self.spans = []
+        self.counts = {}
+        # spans entered but not finished yet, for progress reporting
+        self.running = []
+        self.cancelled = threading.Event()
+
+    @contextmanager
+    def span(self, stage, **attributes):
+        if self.cancelled.is_set():
+            raise QueryCancelled(stage)
+
+        started = time.perf_counter()
+        span = {'stage': stage, 'offset_ms': (started - self.started) * 1000, **attributes}
+        with self.lock:
+            self.running.append(span)
+        try:
+            yield span
+        finally:
+            span['duration_ms'] = (time.perf_counter() - started) * 1000
+            with self.lock:
+                self.running = [running for running in self.running if running is not span]
+                self.spans.append(span)
+
+    # stages finished so far and the ones in flight, in the order they started
+    def progress(self):
+        with self.lock:
+            finished = [span['stage'] for span in sorted(self.spans, key=lambda span: span['offset_ms'])]
+            running = [span['stage'] for span in self.running]
+        return {'finished': list(dict.fromkeys(finished)), 'running': list(dict.fromkeys(running))}
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.counts[name] = self.counts.get(name, 0) + value
+
+    # total time per stage; concurrent spans of the same stage (e.g. parent fetches) are summed
+    def stage_totals(self):
+        with self.lock:
+            totals = {}
+            for span in self.spans:
+                totals[span['stage']] = totals.get(span['stage'], 0.0) + span['duration_ms']
+            return totals
+
+    def finish(self):
+        self.duration_ms = (time.perf_counter() - self.started) * 1000
+
+    def to_dict(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span['offset_ms'])
+            counts = dict(self.counts)
+        return {
+            'app': self.app,
+            **self.attributes,
+            'duration_ms': self.duration_ms,
+            'stages_ms': self.stage_totals(),
+            'counts': counts,
+            'spans': spans
+        }
+
+
+_current_trace = contextvars.ContextVar("query_trace", default=None)
+
+
+def start_trace(app, **attributes):
+    trace = QueryTrace(app, **attributes)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+# with span("search") as s: ... s['chunks'] = n; without an open trace the attributes go nowhere
+def span(stage, **attributes):
+    trace = _current_trace.get()
+    if trace is None:
+        return nullcontext({})
+    return trace.span(stage, **attributes)
+
+
+def add(**counts):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(**counts)
+
+
+# time.sleep() that a cancelled query wakes up from
+def sleep(seconds):
+    trace = _current_trace.get()
+    if trace is None:
+        time.sleep(seconds)
+    elif trace.cancelled.wait(seconds):
+        raise QueryCancelled("sleep")
+
+
+def finish_trace(trace):
+    trace.finish()
+    _current_trace.set(None)
+
+    if config.get_setting("metrics", "json_log", False):
+        get_json_logger().info(json.dumps(trace.to_dict(), default=str))
+
+    if config.get_setting("metrics", "prometheus_port", 0):
+        export_to_prometheus(trace)
+
+
+############################################################################################### Exporters ##################################################################################################################
+
+_json_logger = None
+_json_logger_lock = threading.Lock()
+
+
+def get_json_logger():
+    global _json_logger
+    with _json_logger_lock:
+        if _json_logger is None:
+            _json_logger = logging.getLogger(f"{__name__}.queries")
+            _json_logger.setLevel(logging.INFO)
+            _json_logger.propagate = False
+            handler = logging.StreamHandler(sys.stderr)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            _json_logger.addHandler(handler)
+        return _json_logger
+
+
+# created once per process along with the HTTP endpoint that serves them
+_prometheus_metrics = None
+_prometheus_lock = threading.Lock()
+
+
+def get_prometheus_metrics():
+    global _prometheus_metrics
+    with _prometheus_lock:
+        if _prometheus_metrics is None:
+            _prometheus_metrics = {
+                'stage_seconds': prometheus_client.Histogram(
+                    "vma_stage_seconds", "Time spent per query stage", ["app", "stage"],
+                    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+                ),
+                'query_seconds': prometheus_client.Histogram(
+                    "vma_query_seconds", "End-to-end query time", ["app"],
+                    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+                ),
+                'counts': prometheus_client.Counter("vma_query_counts", "Documents and tokens per query", ["app", "name"])
+            }
+            prometheus_client.start_http_server(config.get_setting("metrics", "prometheus_port", 0))
+        return _prometheus_metrics
+
+
+def export_to_prometheus(trace):
+    if prometheus_client is None:
+        logger.warning("[metrics] prometheus_port is set but prometheus_client is not installed")
+        return
+
+    metrics = get_prometheus_metrics()
+    for stage, duration_ms in trace.stage_totals().items():
+        metrics['stage_seconds'].labels(trace.app, stage).observe(duration_ms / 1000)
+    metrics['query_seconds'].labels(trace.app).observe(trace.duration_ms / 1000)
+    for name, value in trace.to_dict()['counts'].items():
+        metrics['counts'].labels(trace.app, name).inc(value)
+
+
+############################################################################################### Debug Panel ##################################################################################################################
+
+def debug_panel_enabled():
+    return config.get_setting("metrics", "debug_panel", False)
+
+
+def display_debug_panel(trace):
+    summary = trace.to_dict()
+    with st.expander(f"Query timings ({summary['duration_ms']:.0f} ms)"):
+        st.write("Time per stage (ms)")
+        st.table({stage: [f"{duration_ms:.1f}"] for stage, duration_ms in summary['stages_ms'].items()})
+        if summary['counts']:
+            st.write("Counts")
+            st.table({name: [value] for name, value in summary['counts'].items()})
+        st.write("Spans")
+        st.json(summary['spans'], expanded=False)
@@ -0,0 +1,124 @@
+import argparse
+import calendar
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+
+import chat
+import config
+import clients
+import gateway
+import context_builder
+import prompts
+import pipeline
+import retrieval
+import embedding_cache
+
+# Morning brief: precomputes every canned prompt x ISO for a date window so the apps can serve them instantly.
+#
+#   python morning_brief.py                                    --> current month, same window the apps default to
+#   python morning_brief.py --start-date 2024-05-01 --end-date 2024-05-31
+#
+# The seven canned prompts are embedded in one batched call, the 35 retrievals and commentaries run concurrently and the
+# results are upserted into the MorningBrief collection keyed on (prompt_name, iso, start_date, end_date).
+#
+# [morning_brief]
+# max_workers = 8
+# max_age_hours = 24     --> older briefs are ignored by the apps
+
+# same search settings as chatbot_app.py and vector_search_app.py
+CHATBOT_SEARCH = {'num_candidates': 100, 'limit': 3}
+VECTOR_SEARCH_APP_SEARCH = {'num_candidates': 500, 'limit': 10}
+
+
+def current_month():
+    today = dt.date.today()
+    bom = today.replace(day=1)
+    _, last_day = calendar.monthrange(today.year, today.month)
+    eom = today.replace(day=last_day)
+    return bom, eom
+
+
+def brief_key(prompt_name, iso, start_date, end_date):
+    return {
+        'prompt_name': prompt_name,
+        'iso': iso,
+        'start_date': retrieval.to_datetime(start_date),
+        'end_date': retrieval.to_datetime(end_date)
+    }
+
+
+# returns the stored brief for a canned prompt, or None if there is no recent one for this window
+def find_brief(db, prompt_name, iso, start_date, end_date):
+    if prompt_name is None:
+        return None
+
+    max_age = dt.timedelta(hours=config.get_setting("morning_brief", "max_age_hours", 24))
+    query = brief_key(prompt_name, iso, start_date, end_date)
+    query['created_at'] = {'$gte': dt.datetime.utcnow() - max_age}
+
+    return db.MorningBrief.find_one(query)
+
+
+def build_brief(db, prompt_name, prompt_vector, iso, start_date, end_date):
+    user_prompt = prompts.CANNED_PROMPTS[prompt_name]
+
+    # what the chatbot would have retrieved and answered
+    chatbot_results = pipeline.retrieve(db, user_prompt, start_date, end_date, iso, prompt_vector=prompt_vector, **CHATBOT_SEARCH)
+    context = context_builder.build_context(chatbot_results['non_chunked_docs'], chatbot_results['chunked_docs'])
+
+    messages = [
+        {"role": "system", "content": prompts.system_prompt},
+        {"role": "user", "content": prompts.build_contextualized_prompt(context, user_prompt)}
+    ]
+    answer = chat.create_chat_completion(messages, temperature=.5)
+
+    # what the vector search app would have listed
+    search_results = pipeline.retrieve(db, user_prompt, start_date, end_date, iso, prompt_vector=prompt_vector, **VECTOR_SEARCH_APP_SEARCH)
+    search_context = retrieval.build_context(search_results['non_chunked_docs'])
+
+    brief = brief_key(prompt_name, iso, start_date, end_date)
+    db.MorningBrief.update_one(
+        brief,
+        {'$set': {
+            'user_prompt': user_prompt,
+            'context': context,
+            'answer': answer,
+            'search_context': search_context,
+            'created_at': dt.datetime.utcnow()
+        }},
+        upsert=True
+    )
+    return brief
+
+
+def run_morning_brief(db, start_date, end_date):
+    prompt_names = list(prompts.CANNED_PROMPTS)
+
+    # one embeddings call for all the canned prompts (or none at all once they are cached)
+    prompt_vectors = embedding_cache.get_embeddings([prompts.CANNED_PROMPTS[name] for name in prompt_names])
+
+    jobs = []
+    with ThreadPoolExecutor(max_workers=config.get_setting("morning_brief", "max_workers", 8)) as executor:
+        for prompt_name, prompt_vector in zip(prompt_names, prompt_vectors):
+            for iso in retrieval.ISOS:
+                jobs.append(executor.submit(build_brief, db, prompt_name, prompt_vector, iso, start_date, end_date))
+
+    return [job.result() for job in jobs]
+
+
+if __name__ == "__main__":
+    bom, eom = current_month()
+
+    parser = argparse.ArgumentParser(description="Precompute the canned prompts for every ISO and store them in MorningBrief.")
+    parser.add_argument("--start-date", type=dt.date.fromisoformat, default=bom)
+    parser.add_argument("--end-date", type=dt.date.fromisoformat, default=eom)
+    args = parser.parse_args()
+
+    # the apps' questions go ahead of the brief's calls (see gateway.py)
+    gateway.set_default_priority(gateway.BATCH)
+
+    db = clients.get_db()
+    db.MorningBrief.create_index([('prompt_name', 1), ('iso', 1), ('start_date', 1), ('end_date', 1)], unique=True)
+
+    briefs = run_morning_brief(db, args.start_date, args.end_date)
+    print(f"Stored {len(briefs)} briefs for {args.start_date} to {args.end_date}")
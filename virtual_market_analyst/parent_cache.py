@@ -0,0 +1,115 @@
+import zlib
+import time
+import threading
+from collections import OrderedDict
+
+import config
+
+# Memory bounded LRU of NonChunked parent documents keyed by ObjectId, shared by every session in the process.
+# `contents` is kept zlib compressed; the size budget counts the compressed bytes.
+#
+# Parents are updated in place (e.g. ingest.backfill_legacy), which no newer _id gives away, so entries expire after
+# ttl_seconds. With the retrieval cache's change_stream invalidation, changed NonChunked documents are also dropped as
+# the change arrives (see retrieval_cache.py).
+#
+# [parent_cache]
+# enabled = true
+# max_bytes = 67108864
+# ttl_seconds = 600
+
+
+class ParentDocCache:
+    def __init__(self, max_bytes, ttl_seconds):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+
+        # ObjectId --> (source, compressed contents, stored at), oldest used first
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def entry_size(entry):
+        source, compressed, _ = entry
+        return len(source) + len(compressed)
+
+    # returns {ObjectId: doc} for the cached ids; anything not returned has to come from Mongo
+    def get_many(self, ids):
+        found = {}
+        cutoff = time.monotonic() - self.ttl_seconds
+        with self.lock:
+            for _id in ids:
+                entry = self.entries.get(_id)
+                if entry is not None and entry[2] < cutoff:
+                    self.size -= self.entry_size(self.entries.pop(_id))
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    continue
+                self.entries.move_to_end(_id)
+                self.hits += 1
+                found[_id] = entry
+
+        # decompress outside the lock
+        return {
+            _id: {"source": source, "contents": zlib.decompress(compressed).decode('utf-8')}
+            for _id, (source, compressed, _) in found.items()
+        }
+
+    def put_many(self, docs):
+        now = time.monotonic()
+        entries = {doc["_id"]: (doc["source"], zlib.compress(doc["contents"].encode('utf-8')), now) for doc in docs}
+
+        with self.lock:
+            for _id, entry in entries.items():
+                if _id in self.entries:
+                    self.size -= self.entry_size(self.entries.pop(_id))
+
+                # a single document bigger than the whole budget is not worth caching
+                if self.entry_size(entry) > self.max_bytes:
+                    continue
+
+                self.entries[_id] = entry
+                self.size += self.entry_size(entry)
+
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self.entry_size(evicted)
+
+    # drops the given ids, or everything when ids is None
+    def invalidate(self, ids=None):
+        with self.lock:
+            if ids is None:
+                self.entries.clear()
+                self.size = 0
+                return
+            for _id in ids:
+                if _id in self.entries:
+                    self.size -= self.entry_size(self.entries.pop(_id))
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.size}
+
+
+# one cache per process, shared by every session
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def enabled():
+    return config.get_setting("parent_cache", "enabled", True)
+
+
+def get_parent_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ParentDocCache(
+                config.get_setting("parent_cache", "max_bytes", 64 * 1024 * 1024),
+                config.get_setting("parent_cache", "ttl_seconds", 600)
+            )
+        return _cache
@@ -0,0 +1,157 @@
+import logging
+import argparse
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import ReplaceOne
+from pymongo.errors import OperationFailure
+from pymongo.operations import SearchIndexModel
+
+import config
+import quantization
+
+logger = logging.getLogger(__name__)
+
+# Monthly partitions of Chunked for the Atlas backend.
+#
+# Both apps default to the current month and nearly every query covers a few weeks, but a $vectorSearch on Chunked walks
+# an index over the whole history. With [retrieval] partitioned = true each month's chunks also live in their own
+# collection (Chunked_2024_05, ...) with its own vector index; a query only searches the months overlapping its date range,
+# in parallel, and merges the per-month top-k by score. Latency then follows the window, not the corpus.
+#
+#   python partitions.py                         --> bring every month's partition in line with Chunked and create missing indexes
+#   python partitions.py --months 2024-05 2024-06
+#
+# ingest.py and `quantization.py backfill` sync the months they touched when partitioning is on; a sync also re-copies
+# chunks changed in place since they were copied (a new content_hash, or a short vector added). The local backend needs
+# no partitions since its rows are date sorted and a date range is already a slice of the matrix (see local_index.py).
+#
+# [retrieval]
+# partitioned = false
+# partition_workers = 4
+# vector_dimensions = 3072     --> numDimensions of the partition vector indexes
+
+PARTITION_PREFIX = "Chunked_"
+
+
+def enabled():
+    return config.get_setting("retrieval", "partitioned", False)
+
+
+def partition_name(year, month):
+    return f"{PARTITION_PREFIX}{year}_{month:02d}"
+
+
+# the (year, month) pairs a date range touches, oldest first
+def months_between(start_date, end_date):
+    year, month = start_date.year, start_date.month
+    months = []
+    while (year, month) <= (end_date.year, end_date.month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def partitions_for(start_date, end_date):
+    return [partition_name(year, month) for year, month in months_between(start_date, end_date)]
+
+
+def month_range(year, month):
+    start = dt.datetime(year, month, 1)
+    end = dt.datetime(year + 1, 1, 1) if month == 12 else dt.datetime(year, month + 1, 1)
+    return {"$gte": start, "$lt": end}
+
+
+# the same vector index as on Chunked (see retrieval.py), plus the candidate index when that is enabled (see quantization.py)
+def index_models():
+    models = [SearchIndexModel(
+        {"fields": [
+            {"type": "vector", "path": "vector", "numDimensions": config.get_setting("retrieval", "vector_dimensions", 3072), "similarity": "cosine"},
+            {"type": "filter", "path": "date"},
+            {"type": "filter", "path": "tags"}
+        ]},
+        name=config.get_setting("retrieval", "vector_index", "vector_index"),
+        type="vectorSearch"
+    )]
+
+    if quantization.enabled():
+        scalar_or_binary = {'int8': 'scalar', 'binary': 'binary'}.get(quantization.get_quantization())
+        vector_field = {
+            "type": "vector",
+            "path": config.get_setting("candidates", "vector_path", "vector_short"),
+            "numDimensions": config.get_setting("candidates", "dimensions", 512) or config.get_setting("retrieval", "vector_dimensions", 3072),
+            "similarity": "cosine"
+        }
+        if scalar_or_binary is not None:
+            vector_field["quantization"] = scalar_or_binary
+        models.append(SearchIndexModel(
+            {"fields": [vector_field, {"type": "filter", "path": "date"}, {"type": "filter", "path": "tags"}]},
+            name=config.get_setting("candidates", "vector_index", "vector_short_index"),
+            type="vectorSearch"
+        ))
+
+    return models
+
+
+def months_in_chunked(db):
+    grouped = db.Chunked.aggregate([{"$group": {"_id": {"year": {"$year": "$date"}, "month": {"$month": "$date"}}}}])
+    return sorted((group["_id"]["year"], group["_id"]["month"]) for group in grouped)
+
+
+# _id --> what an in-place update changes (the content_hash, whether the short vector is there), without the vectors themselves
+def fingerprints(collection, query):
+    projection = {
+        "content_hash": 1,
+        "short": {"$ne": [{"$type": "$" + config.get_setting("candidates", "vector_path", "vector_short")}, "missing"]}
+    }
+    return {doc["_id"]: (doc.get("content_hash"), doc["short"]) for doc in collection.find(query, projection)}
+
+
+# copies the month's new and changed chunks into its partition and drops the ones that are gone from Chunked
+def sync_partition(db, year, month, batch_size=1000):
+    name = partition_name(year, month)
+    date_query = {"date": month_range(year, month)}
+
+    source = fingerprints(db.Chunked, date_query)
+    partition = fingerprints(db[name], {})
+
+    missing = [_id for _id in source if _id not in partition]
+    changed = [_id for _id in source if _id in partition and partition[_id] != source[_id]]
+    copy = missing + changed
+    for start in range(0, len(copy), batch_size):
+        documents = db.Chunked.find({"_id": {"$in": copy[start:start + batch_size]}})
+        requests = [ReplaceOne({"_id": document["_id"]}, document, upsert=True) for document in documents]
+        # the chunks may have been deleted from Chunked since they were listed
+        if requests:
+            db[name].bulk_write(requests, ordered=False)
+
+    removed = [_id for _id in partition if _id not in source]
+    if removed:
+        db[name].delete_many({"_id": {"$in": removed}})
+
+    existing_indexes = {index["name"] for index in db[name].list_search_indexes()}
+    for model in index_models():
+        if model.document["name"] not in existing_indexes:
+            try:
+                db[name].create_search_index(model)
+            except OperationFailure as e:
+                logger.warning("Could not create search index %s on %s: %s", model.document['name'], name, e)
+
+    return {'partition': name, 'copied': len(missing), 'updated': len(changed), 'removed': len(removed)}
+
+
+def sync_partitions(db, months=None):
+    months = months or months_in_chunked(db)
+    with ThreadPoolExecutor(max_workers=config.get_setting("retrieval", "partition_workers", 4)) as executor:
+        return list(executor.map(lambda year_month: sync_partition(db, *year_month), months))
+
+
+if __name__ == "__main__":
+    import clients
+
+    parser = argparse.ArgumentParser(description="Sync the monthly Chunked partitions and their vector indexes.")
+    parser.add_argument("--months", nargs="+", type=lambda value: tuple(int(part) for part in value.split("-")), help="YYYY-MM, default every month in Chunked")
+    args = parser.parse_args()
+
+    for result in sync_partitions(clients.get_db(), args.months):
+        print(f"{result['partition']}: {result['copied']} copied, {result['updated']} updated, {result['removed']} removed")
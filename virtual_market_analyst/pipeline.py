@@ -0,0 +1,179 @@
+import asyncio
+
+import config
+import metrics
+import retrieval
+import diversity
+import lexical_index
+import embedding_cache
+import retrieval_cache
+
+# The retrieval pipeline both apps run on every query: embed the prompt --> pre-filter Chunked --> vector search --> parent lookup in NonChunked.
+#
+# With [pipeline] concurrent = true (default) the prompt is embedded while the date / ISO pre-filter is prepared, so
+# end-to-end latency approaches the slowest of the two rather than their sum. The parents of the chunks the search returns
+# are looked up in NonChunked in one query afterwards.
+#
+# With [hybrid] enabled (see lexical_index.py) a BM25 search runs alongside the embedding and the two ranked lists are
+# fused before the parent lookup; callers passing lexical_fast_path=True skip the embedding for keyword-shaped queries.
+#
+# [pipeline]
+# concurrent = true
+# embed_timeout = 30        --> seconds allowed per stage before the query fails
+# filter_timeout = 120
+# lexical_timeout = 30
+# search_timeout = 60
+# parent_timeout = 30
+
+
+class StageTimeoutError(TimeoutError):
+    def __init__(self, stage, timeout):
+        super().__init__(f"The {stage} stage did not finish within {timeout} seconds")
+        self.stage = stage
+        self.timeout = timeout
+
+
+def stage_timeout(stage, default):
+    return config.get_setting("pipeline", f"{stage}_timeout", default)
+
+
+# the blocking pymongo / OpenAI calls run on worker threads; a timed out thread is abandoned rather than interrupted
+async def run_stage(stage, default_timeout, function, *args):
+    timeout = stage_timeout(stage, default_timeout)
+    try:
+        return await asyncio.wait_for(asyncio.to_thread(function, *args), timeout)
+    except asyncio.TimeoutError:
+        raise StageTimeoutError(stage, timeout) from None
+
+
+# how deep each of the vector and lexical lists goes into the fusion
+def hybrid_depth(limit):
+    return max(limit, config.get_setting("hybrid", "candidates", 50))
+
+
+# lexical hits carry no vectors for MMR, so the fused list only gets the per-parent cap (see diversity.py)
+def fuse(result_lists, limit):
+    if not diversity.enabled():
+        return lexical_index.reciprocal_rank_fusion(result_lists, limit)
+    fused = lexical_index.reciprocal_rank_fusion(result_lists, sum(len(results) for results in result_lists))
+    return diversity.cap_per_parent(fused, limit)
+
+
+async def retrieve_concurrently(db, user_prompt, start_date, end_date, iso, num_candidates, limit, prompt_vector=None):
+    if prompt_vector is None:
+        embedding = asyncio.ensure_future(run_stage("embed", 30, embedding_cache.get_embedding, user_prompt))
+    else:
+        embedding = asyncio.ensure_future(asyncio.sleep(0, prompt_vector))
+    prepared = asyncio.ensure_future(run_stage("filter", 120, retrieval.prepare_search, db, start_date, end_date, iso))
+    stages = [embedding, prepared]
+
+    hybrid = lexical_index.hybrid_enabled()
+    if hybrid:
+        depth = hybrid_depth(limit)
+        stages.append(asyncio.ensure_future(run_stage("lexical", 30, lexical_index.search_lexical, db, user_prompt, start_date, end_date, iso, depth)))
+
+    try:
+        prompt_vector, prepared, *lexical_hits = await asyncio.gather(*stages)
+    except Exception:
+        for stage in stages:
+            stage.cancel()
+        raise
+
+    # the results come back as one list (the first cursor batch at these limits, or MMR's pick), so the parents missing
+    # from the cache are looked up in a single NonChunked query afterwards
+    if hybrid:
+        vector_hits = await run_stage("search", 60, retrieval.run_search, db, prepared, prompt_vector, max(num_candidates, depth), depth)
+        chunked_docs = fuse([vector_hits, lexical_hits[0]], limit)
+    else:
+        chunked_docs = await run_stage("search", 60, retrieval.run_search, db, prepared, prompt_vector, num_candidates, limit)
+    non_chunked_docs = await run_stage("parent", 30, retrieval.fetch_parent_docs, db, chunked_docs)
+
+    return {
+        'prompt_vector': prompt_vector,
+        'chunked_docs': chunked_docs,
+        'non_chunked_docs': non_chunked_docs
+    }
+
+
+def retrieve_sequentially(db, user_prompt, start_date, end_date, iso, num_candidates, limit, prompt_vector=None):
+    # cached across sessions and both apps, so repeated prompts skip the embeddings call
+    if prompt_vector is None:
+        prompt_vector = embedding_cache.get_embedding(user_prompt)
+
+    # pre-filter on date / ISO and run the vector search (see retrieval.py for the available modes)
+    if lexical_index.hybrid_enabled():
+        depth = hybrid_depth(limit)
+        vector_hits = retrieval.search_chunks(db, prompt_vector, start_date, end_date, iso, max(num_candidates, depth), depth)
+        lexical_hits = lexical_index.search_lexical(db, user_prompt, start_date, end_date, iso, depth)
+        chunked_docs = fuse([vector_hits, lexical_hits], limit)
+    else:
+        chunked_docs = retrieval.search_chunks(db, prompt_vector, start_date, end_date, iso, num_candidates, limit)
+
+    non_chunked_docs = retrieval.fetch_parent_docs(db, chunked_docs)
+
+    return {
+        'prompt_vector': prompt_vector,
+        'chunked_docs': chunked_docs,
+        'non_chunked_docs': non_chunked_docs
+    }
+
+
+# like asyncio.run() but without waiting on worker threads abandoned by a stage timeout
+def run_async(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        pending = asyncio.all_tasks(loop)
+        if pending:
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+
+# keyword-shaped queries answered by BM25 alone, without an embeddings call; prompt_vector is None in the results
+def retrieve_lexically(db, user_prompt, start_date, end_date, iso, limit):
+    if diversity.enabled():
+        chunked_docs = diversity.cap_per_parent(lexical_index.search_lexical(db, user_prompt, start_date, end_date, iso, diversity.candidate_depth(limit)), limit)
+    else:
+        chunked_docs = lexical_index.search_lexical(db, user_prompt, start_date, end_date, iso, limit)
+    non_chunked_docs = retrieval.fetch_parent_docs(db, chunked_docs)
+
+    return {
+        'prompt_vector': None,
+        'chunked_docs': chunked_docs,
+        'non_chunked_docs': non_chunked_docs
+    }
+
+
+def run_pipeline(db, user_prompt, start_date, end_date, iso, num_candidates, limit, prompt_vector=None, lexical_fast_path=False):
+    if lexical_fast_path and prompt_vector is None and lexical_index.hybrid_enabled() and lexical_index.get_lexical_index(db).is_keyword_query(user_prompt):
+        metrics.add(lexical_fast_path=1)
+        return retrieve_lexically(db, user_prompt, start_date, end_date, iso, limit)
+
+    if config.get_setting("pipeline", "concurrent", True):
+        return run_async(retrieve_concurrently(db, user_prompt, start_date, end_date, iso, num_candidates, limit, prompt_vector))
+    return retrieve_sequentially(db, user_prompt, start_date, end_date, iso, num_candidates, limit, prompt_vector)
+
+
+# prompt_vector can be passed in when the prompt has already been embedded (e.g. in a batch with others);
+# lexical_fast_path lets keyword-shaped queries skip the embedding when hybrid search is on
+def retrieve(db, user_prompt, start_date, end_date, iso, num_candidates, limit, prompt_vector=None, lexical_fast_path=False):
+    if not retrieval_cache.enabled():
+        return run_pipeline(db, user_prompt, start_date, end_date, iso, num_candidates, limit, prompt_vector, lexical_fast_path)
+
+    # repeated searches are answered from the cache until new documents land in the date window (see retrieval_cache.py)
+    cache = retrieval_cache.get_retrieval_cache()
+    key = cache.key(user_prompt, start_date, end_date, iso, num_candidates, limit, lexical_fast_path)
+    watermark = cache.watermark(db, start_date, end_date)
+
+    results = cache.get(key, watermark)
+    metrics.add(retrieval_cache_hits=int(results is not None))
+    if results is None:
+        results = run_pipeline(db, user_prompt, start_date, end_date, iso, num_candidates, limit, prompt_vector, lexical_fast_path)
+        cache.put(key, watermark, results)
+    else:
+        # the cache keeps no parent docs, they come from the parent cache
+        results['non_chunked_docs'] = retrieval.fetch_parent_docs(db, results['chunked_docs'])
+    return results
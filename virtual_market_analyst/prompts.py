@@ -0,0 +1,60 @@
+import re
+
+# Prompts shared by both apps and the morning brief job (see morning_brief.py)
+
+system_prompt = """
+You are a commodity research analyst that helps other understand commodity market key developments and news that impact the specified market.
+Your answers should be one to three paragraphs depending on how many key developments there is to cover. The more the more key developments the longer the response should be and the less key developments the shorter the response should be.
+A successful response will briefly describe a key development and explain why that development would impact the commodity market pricing for each key development. 
+For for each key development cite the source which points to its occurrence. The source should be cited in the following format [source: "SOURCE"]. Please list the full source and make minimal alterations to the source.
+The write-up must have proper grammar.
+The write-up can use jargon as you should assume the reader is modestly knowledgeable of the market.
+"""
+instructions = """
+Use the CONTEXT above to respond to the user's REQUEST.
+Ground your response in the facts that CONTEXT provides.
+Do not make up any stories or market data. Only use the market data which is provided by CONTEXT and site sources in your response.
+If CONTEXT does not contain enough information to respond to the REQUEST return "I need more information to provide an answer".
+"""
+
+weather_prompt = f"Weather Prompt --> Please provide me with a commentary on weather developments that have occurred that could impact power or natural gas market. Weather developments of interest include those that relate to waves of oncoming or upcoming heat and or cold fronts. Other developments of interest include those that pertain to the increase or decrease of heating degree days, often referred to as 'HDDs', and/or the increase or decrease of cooling degree days, often referred to as 'CDDs'."
+economic_prompt = f"Economic Prompt --> Please provide me with a commentary on economic developments that have occurred which could impact power or natural gas demand."
+data_center_prompt = f"Data Center Prompt --> Please provide me with a commentary on data center developments that have occurred. Data center developments of interest are the annoucements of new planned investments and deals for power supply to data centers. Other areas of interest also include news on the progression of data center build outs or financings. Also of interest is news on how data centers can drive an increase in electricty demand."
+lng_prompt = f"LNG Prompt --> Please provide me with a commentary on LNG developments that have occurred. LNG developments of interest include those pertaining to outages for export terminals ending, the volume of exports increasing, and progress on LNG terminals under development. Please exclude any commentary on LNG terminal outages being extended or occuring."
+technicals_prompt = f"Market Technicals Prompt --> Please provide me with a commentary on technical developments that have occurred. Technical developments of interest include those relevant to market participant positioning such as investors, market participants, and speculators decreasing, covering, or adding to positions."
+production_prompt = f"Production Prompt --> Please provide me with a commentary on the developments that impacted natural gas production."
+storage_prompt = f"Storage Prompt --> Please provide me with a commentary on the developments that impacted the levels of natural gas in storage."
+
+# the canned prompts, keyed by the name the morning brief stores them under
+CANNED_PROMPTS = {
+    'weather': weather_prompt,
+    'economic': economic_prompt,
+    'data_center': data_center_prompt,
+    'lng': lng_prompt,
+    'technicals': technicals_prompt,
+    'production': production_prompt,
+    'storage': storage_prompt
+}
+
+
+# cleaning up the spacing of the inputs
+def clean_prompt(prompt):
+    split_pattern = r'\n|\t'
+    prompt = re.split(split_pattern, prompt)
+    prompt = [item.strip() for item in prompt]
+    return ' '.join(prompt).strip()
+
+
+def build_contextualized_prompt(context, user_prompt):
+    modified_user_prompt = clean_prompt(user_prompt)
+    cleaned_instructions = clean_prompt(instructions)
+    return f"CONTEXT:\n{context}REQUEST:\n{modified_user_prompt}\n\nINSTRUCTIONS:{cleaned_instructions}"
+
+
+# name of the canned prompt the user submitted, or None for a free-form prompt
+def canned_prompt_name(user_prompt):
+    cleaned = clean_prompt(user_prompt)
+    for name, prompt in CANNED_PROMPTS.items():
+        if clean_prompt(prompt) == cleaned:
+            return name
+    return None
@@ -0,0 +1,280 @@
+import os
+import time
+import argparse
+
+import numpy as np
+
+import config
+
+# Reduced-dimension / quantized candidate vectors with exact rescoring.
+#
+# text-embedding-3-large vectors are Matryoshka embeddings: the first N of the 3072 floats, re-normalised, are a usable
+# N-dimensional embedding (the same thing the API's `dimensions` parameter returns). A short, quantized copy is searched
+# for the top numCandidates, and only those candidates are rescored with the full float vectors before the limit cut.
+#
+# Quantization ([candidates] quantization = "...")
+#   none   --> float32 short vectors
+#   int8   --> one byte per dimension with a per-dimension scale, 4x smaller than float32
+#   binary --> one bit per dimension (the sign), 32x smaller, compared by Hamming distance
+#
+# Local backend: the candidate matrix is held in RAM and the full matrix stays memory-mapped, so only the candidate rows
+# are read from it. Atlas backend: set vector_path to a field holding the short vectors (written by ingest.py, or
+# `python quantization.py backfill`) indexed with Atlas' own quantization, e.g.
+#   {"type": "vector", "path": "vector_short", "numDimensions": 512, "similarity": "cosine", "quantization": "scalar"}
+# and the full `vector` of each candidate is returned for the rescoring.
+#
+#   python quantization.py recall                    --> recall@limit of every mode against the exact float search
+#   python quantization.py backfill --dimensions 512 --> writes vector_short to the Chunked docs that do not have it
+#
+# [candidates]
+# enabled = false
+# dimensions = 512          --> 0 keeps every dimension
+# quantization = "int8"
+# vector_path = "vector_short"
+# vector_index = "vector_short_index"
+
+QUANTIZATIONS = ('none', 'int8', 'binary')
+
+# bits set in every byte value, for Hamming distances over packed bits
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+def enabled():
+    return config.get_setting("candidates", "enabled", False)
+
+
+def get_quantization():
+    quantization = config.get_setting("candidates", "quantization", "int8")
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown candidate quantization '{quantization}', expected one of {QUANTIZATIONS}")
+    return quantization
+
+
+# first `dimensions` components, re-normalised; works on one vector or a (rows x dims) matrix
+def shorten(vectors, dimensions):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dimensions:
+        vectors = vectors[..., :dimensions]
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class CandidateVectors:
+    def __init__(self, codes, dimensions, quantization, scale=None):
+        self.codes = codes
+        self.dimensions = dimensions
+        self.quantization = quantization
+        # int8 only: code * scale approximates the short float vector
+        self.scale = scale
+
+    @classmethod
+    def build(cls, vectors, dimensions, quantization, block_rows=65536):
+        # in blocks, so a memory-mapped full matrix is streamed rather than loaded whole
+        dimensions = dimensions or vectors.shape[1]
+        if quantization == 'int8':
+            scale = np.zeros(dimensions, dtype=np.float32)
+            for start in range(0, len(vectors), block_rows):
+                scale = np.maximum(scale, np.abs(shorten(vectors[start:start + block_rows], dimensions)).max(axis=0))
+            scale = np.where(scale == 0, 1, scale) / 127
+        else:
+            scale = None
+
+        blocks = []
+        for start in range(0, len(vectors), block_rows):
+            short = shorten(vectors[start:start + block_rows], dimensions)
+            if quantization == 'int8':
+                blocks.append(np.clip(np.rint(short / scale), -127, 127).astype(np.int8))
+            elif quantization == 'binary':
+                blocks.append(np.packbits(short > 0, axis=1))
+            else:
+                blocks.append(short)
+
+        if blocks:
+            codes = np.concatenate(blocks)
+        else:
+            codes = np.empty((0, dimensions), dtype=np.float32)
+        return cls(codes, dimensions, quantization, scale)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    # higher is better; only used to rank candidates, so the scales do not need to match the exact scores
+    def scores(self, query, rows, block_rows=65536):
+        query = shorten(query, self.dimensions)
+        if self.quantization == 'binary':
+            query_bits = np.packbits(query > 0)
+
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), block_rows):
+            codes = self.codes[rows[start:start + block_rows]]
+            if self.quantization == 'int8':
+                scores[start:start + block_rows] = codes.astype(np.float32) @ (query * self.scale)
+            elif self.quantization == 'binary':
+                scores[start:start + block_rows] = -POPCOUNT[np.bitwise_xor(codes, query_bits)].sum(axis=1, dtype=np.int32)
+            else:
+                scores[start:start + block_rows] = codes @ query
+        return scores
+
+    # the rows of the best num_candidates, unordered
+    def candidate_rows(self, query, rows, num_candidates):
+        scores = self.scores(query, rows)
+        k = min(num_candidates, len(rows))
+        return rows[np.argpartition(-scores, k - 1)[:k]]
+
+
+def candidate_file(path, dimensions, quantization):
+    return os.path.join(path, f"candidates_{quantization}_{dimensions}.npz")
+
+
+def save_candidates(candidates, path):
+    np.savez(
+        candidate_file(path, candidates.dimensions, candidates.quantization),
+        codes=candidates.codes,
+        scale=candidates.scale if candidates.scale is not None else np.empty(0, dtype=np.float32)
+    )
+
+
+def load_candidates(path, dimensions, quantization):
+    filename = candidate_file(path, dimensions, quantization)
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as stored:
+        scale = stored['scale'] if len(stored['scale']) else None
+        return CandidateVectors(stored['codes'], dimensions, quantization, scale)
+
+
+# candidates for a local index per the [candidates] settings, from the index directory when they were saved there
+def candidates_for(index, path=None):
+    dimensions = config.get_setting("candidates", "dimensions", 512) or index.vectors.shape[1]
+    quantization = get_quantization()
+
+    candidates = load_candidates(path, dimensions, quantization) if path is not None else None
+    if candidates is None or len(candidates.codes) != len(index):
+        candidates = CandidateVectors.build(index.vectors, dimensions, quantization)
+    return candidates
+
+
+# keeps the best `limit` of the candidate documents by exact cosine against their full `vector`, dropping the vector
+def rescore(prompt_vector, candidate_docs, limit, keep_vectors=False):
+    if not candidate_docs:
+        return []
+
+    query = shorten(prompt_vector, 0)
+    scores = shorten([doc['vector'] for doc in candidate_docs], 0) @ query
+    best = np.argsort(-scores)[:limit]
+
+    results = []
+    for position in best:
+        doc = {key: value for key, value in candidate_docs[position].items() if keep_vectors or key != 'vector'}
+        doc['score'] = float(scores[position])
+        results.append(doc)
+    return results
+
+
+############################################################################################### Recall Check ##################################################################################################################
+
+def exact_top(index, query, rows, limit):
+    scores = np.asarray(index.vectors[rows]) @ query
+    k = min(limit, len(rows))
+    return set(rows[np.argpartition(-scores, k - 1)[:k]].tolist())
+
+
+# recall@limit of candidate search + rescoring against the exact float search, over stored chunks used as queries
+# (each query's own row is left out so it does not inflate the recall)
+def recall_check(index, candidates, queries, limit, num_candidates):
+    all_rows = np.arange(len(index))
+    rng = np.random.default_rng(0)
+    query_rows = rng.choice(len(index), size=min(queries, len(index)), replace=False)
+
+    recall = []
+    exact_seconds = 0.0
+    candidate_seconds = 0.0
+    for query_row in query_rows:
+        query = shorten(index.vectors[query_row], 0)
+        rows = np.delete(all_rows, query_row)
+
+        started = time.perf_counter()
+        expected = exact_top(index, query, rows, limit)
+        exact_seconds += time.perf_counter() - started
+
+        started = time.perf_counter()
+        found = exact_top(index, query, candidates.candidate_rows(query, rows, num_candidates), limit)
+        candidate_seconds += time.perf_counter() - started
+
+        recall.append(len(expected & found) / len(expected))
+
+    return {
+        'dimensions': candidates.dimensions,
+        'quantization': candidates.quantization,
+        f'recall@{limit}': float(np.mean(recall)),
+        'min_recall': float(np.min(recall)),
+        'candidate_mb': candidates.nbytes / (1024 * 1024),
+        'float_mb': index.vectors.nbytes / (1024 * 1024),
+        'exact_ms': exact_seconds / len(query_rows) * 1000,
+        'candidate_ms': candidate_seconds / len(query_rows) * 1000
+    }
+
+
+def backfill(db, dimensions, vector_path, batch_size=1000):
+    from pymongo import UpdateOne
+
+    updated = 0
+    cursor = db.Chunked.find({vector_path: {'$exists': False}}, {'_id': 1, 'vector': 1})
+    requests = []
+    for doc in cursor:
+        requests.append(UpdateOne({'_id': doc['_id']}, {'$set': {vector_path: shorten(doc['vector'], dimensions).tolist()}}))
+        if len(requests) == batch_size:
+            updated += db.Chunked.bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if requests:
+        updated += db.Chunked.bulk_write(requests, ordered=False).modified_count
+    return updated
+
+
+if __name__ == "__main__":
+    import clients
+    import local_index
+
+    parser = argparse.ArgumentParser(description="Recall check and backfill for the reduced / quantized candidate vectors.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    recall_parser = subparsers.add_parser("recall", help="compare candidate search + rescoring with the exact float search")
+    recall_parser.add_argument("--dimensions", type=int, nargs="+", default=[256, 512, 1024])
+    recall_parser.add_argument("--quantization", choices=QUANTIZATIONS, nargs="+", default=list(QUANTIZATIONS))
+    recall_parser.add_argument("--queries", type=int, default=200)
+    recall_parser.add_argument("--limit", type=int, default=10)
+    recall_parser.add_argument("--num-candidates", type=int, default=100)
+    recall_parser.add_argument("--save", action="store_true", help="write the candidate matrices into the local index directory")
+
+    backfill_parser = subparsers.add_parser("backfill", help="write the short vectors to Chunked for an Atlas candidate index")
+    backfill_parser.add_argument("--dimensions", type=int, default=config.get_setting("candidates", "dimensions", 512))
+    backfill_parser.add_argument("--vector-path", default=config.get_setting("candidates", "vector_path", "vector_short"))
+
+    args = parser.parse_args()
+    db = clients.get_db()
+
+    if args.command == "backfill":
+        print(f"Wrote {args.vector_path} to {backfill(db, args.dimensions, args.vector_path)} chunks")
+        # the partitions hold copies of the chunks, which the backfill does not reach
+        import partitions
+        if partitions.enabled():
+            for result in partitions.sync_partitions(db):
+                print(f"{result['partition']}: {result['copied']} copied, {result['updated']} updated, {result['removed']} removed")
+    else:
+        path = config.get_path_setting("local_index", "path", "local_index")
+        index = local_index.load(path) if local_index.index_exists(path) else local_index.load_from_mongo(db)
+
+        print(f"{len(index):,} chunks, {args.queries} queries, top {args.limit} of {args.num_candidates} candidates")
+        for quantization in args.quantization:
+            for dimensions in args.dimensions:
+                candidates = CandidateVectors.build(index.vectors, dimensions, quantization)
+                result = recall_check(index, candidates, args.queries, args.limit, args.num_candidates)
+                print(
+                    f"{quantization:>6} x {dimensions:>4}: recall@{args.limit} {result[f'recall@{args.limit}']:.3f} (min {result['min_recall']:.2f}), "
+                    f"{result['candidate_mb']:.1f} MB vs {result['float_mb']:.1f} MB float, "
+                    f"{result['candidate_ms']:.2f} ms vs {result['exact_ms']:.2f} ms exact"
+                )
+                if args.save and local_index.index_exists(path):
+                    save_candidates(candidates, path)
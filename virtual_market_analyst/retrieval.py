@@ -0,0 +1,331 @@
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+import config
+import metrics
+import local_index
+import partitions
+import diversity
+import parent_cache
+import quantization
+
+# Retrieval backends (set with [retrieval] backend = "..." in secrets.toml)
+#   atlas --> $vectorSearch on the Atlas cluster (default)
+#   local --> in-process NumPy index over the Chunked embeddings (see local_index.py), no network round-trip per query
+# with [retrieval] fallback_to_local = true an Atlas search that fails (e.g. while the index is rebuilding) is answered by the local index
+RETRIEVAL_BACKENDS = ('atlas', 'local')
+
+# Retrieval modes (set with [retrieval] mode = "..." in secrets.toml)
+#   prefilter            --> the date/ISO filters are pushed into $vectorSearch and the search runs directly against Chunked.
+#                            The Atlas vector index on Chunked must declare date and tags as filter fields:
+#                            {"fields": [{"type": "vector", "path": "vector", "numDimensions": 3072, "similarity": "cosine"},
+#                                        {"type": "filter", "path": "date"},
+#                                        {"type": "filter", "path": "tags"}]}
+#   temporary_collection --> the original approach; copies the filtered Chunked docs into TemporaryChunked and waits for the index to catch up
+RETRIEVAL_MODES = ('prefilter', 'temporary_collection')
+
+ISOS = ['N/A', 'ERCOT', 'NYISO', 'PJM', 'MISO']
+
+
+def get_retrieval_backend():
+    backend = config.get_setting("retrieval", "backend", "atlas")
+    if backend not in RETRIEVAL_BACKENDS:
+        raise ValueError(f"Unknown retrieval backend '{backend}', expected one of {RETRIEVAL_BACKENDS}")
+    return backend
+
+
+def get_retrieval_mode():
+    mode = config.get_setting("retrieval", "mode", "prefilter")
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode '{mode}', expected one of {RETRIEVAL_MODES}")
+    return mode
+
+
+# need this step b/c streamlit start_date and end_date are DATE objects NOT DATETIME objects which MongoDB needs
+def to_datetime(date):
+    return dt.datetime.combine(date, dt.datetime.min.time())
+
+
+# prepping the data for a vector search (can only run match as the first stage of an aggregation pipeline)
+def data_prep_aggregation_framework(start_date, end_date, iso):
+    start_date = to_datetime(start_date)
+    end_date = to_datetime(end_date)
+    iso = iso.lower()
+
+    match_stage_a = {
+        "$match": {
+            "date": {
+                "$gte": start_date,
+                "$lte": end_date
+            }
+        }
+    }
+
+    if iso != "n/a":
+        match_stage_b = {
+            "$match": {
+                "tags": {
+                    "$in": [iso]
+                }
+            }
+        }
+    else:
+        match_stage_b = {
+            "$match": {}
+        }
+
+    data_prep_pipeline = [
+        match_stage_a,
+        match_stage_b,
+    ]
+
+    return data_prep_pipeline
+
+
+# the same date/ISO filters as data_prep_aggregation_framework() written in $vectorSearch filter syntax
+def vector_search_filter(start_date, end_date, iso):
+    start_date = to_datetime(start_date)
+    end_date = to_datetime(end_date)
+    iso = iso.lower()
+
+    date_filter = {
+        "date": {
+            "$gte": start_date,
+            "$lte": end_date
+        }
+    }
+
+    if iso != "n/a":
+        return {
+            "$and": [
+                date_filter,
+                {"tags": {"$in": [iso]}}
+            ]
+        }
+
+    return date_filter
+
+
+def update_collection_with_pipeline(db, source_collection_name, target_collection_name, data_prep_pipeline):
+    new_documents = db[source_collection_name].aggregate(data_prep_pipeline)
+    new_documents = list(new_documents)
+
+    # Remove all documents from the target collection
+    db[target_collection_name].delete_many({})
+
+    # Insert new documents into the target collection
+    if len(new_documents) > 0:
+        db[target_collection_name].insert_many(new_documents)
+
+
+def build_vector_search_pipeline(prompt_vector, num_candidates, limit, vector_filter=None):
+    vector_search_stage = {
+        '$vectorSearch': {
+            'index': config.get_setting("retrieval", "vector_index", "vector_index"),
+            'path': 'vector',
+            'queryVector': prompt_vector,
+            'numCandidates': num_candidates,
+            'limit': limit
+        }
+    }
+
+    # candidate search on the short / quantized vectors: all num_candidates come back with their full vector for
+    # quantization.rescore() to make the limit cut
+    candidates = quantization.enabled()
+    if candidates:
+        vector_search_stage['$vectorSearch'].update({
+            'index': config.get_setting("candidates", "vector_index", "vector_short_index"),
+            'path': config.get_setting("candidates", "vector_path", "vector_short"),
+            'queryVector': quantization.shorten(prompt_vector, config.get_setting("candidates", "dimensions", 512)).tolist(),
+            'numCandidates': min(num_candidates * 10, 10000),
+            'limit': num_candidates
+        })
+
+    if vector_filter is not None:
+        vector_search_stage['$vectorSearch']['filter'] = vector_filter
+
+    # semi_chunked_id = 1 if using parent/child approach 0 otherwise
+    # the chunk _id is kept so hybrid search can match vector and lexical results (see lexical_index.py)
+    # and the score so results from several partitions can be merged (see partitions.py)
+    project_stage = {
+        '$project': {
+            '_id': 1,
+            'source': 1,
+            'contents': 1,
+            'semi_chunked_id': 1,
+            'score': {'$meta': 'vectorSearchScore'}
+        }
+    }
+    # quantization.rescore() and the MMR stage (see diversity.py) both need the full vectors
+    if candidates or diversity.enabled():
+        project_stage['$project']['vector'] = 1
+
+    return [
+        vector_search_stage,
+        project_stage
+    ]
+
+
+# Searching is split in two so the filter work can run while the prompt is still being embedded (see pipeline.py):
+#   prepare_search() --> everything that only depends on the date range / ISO
+#   run_search()     --> the vector search itself
+def prepare_search(db, start_date, end_date, iso):
+    with metrics.span("filter") as span:
+        prepared = {
+            'backend': get_retrieval_backend(),
+            'start_date': start_date,
+            'end_date': end_date,
+            'iso': iso
+        }
+        span['backend'] = prepared['backend']
+
+        if prepared['backend'] == 'local':
+            prepared['rows'] = local_index.get_local_index(db).filter_rows(start_date, end_date, iso)
+            span['rows'] = len(prepared['rows'])
+            return prepared
+
+        if get_retrieval_mode() == 'prefilter':
+            prepared['collection'] = "Chunked"
+            prepared['filter'] = vector_search_filter(start_date, end_date, iso)
+            # only the monthly partitions overlapping the window are searched
+            if partitions.enabled():
+                prepared['partitions'] = partitions.partitions_for(start_date, end_date)
+                span['partitions'] = len(prepared['partitions'])
+            return prepared
+
+        data_prep_pipeline = data_prep_aggregation_framework(start_date, end_date, iso)
+        update_collection_with_pipeline(db, "Chunked", "TemporaryChunked", data_prep_pipeline)
+
+    # give the Atlas index time to pick up the rewritten collection
+    with metrics.span("index_sync_wait"):
+        metrics.sleep(config.get_setting("retrieval", "index_sync_seconds", 90))
+
+    prepared['collection'] = "TemporaryChunked"
+    prepared['filter'] = None
+    return prepared
+
+
+# with [diversity] enabled a deeper list is searched and MMR picks `limit` chunks from it (see diversity.py)
+def iter_search(db, prepared, prompt_vector, num_candidates, limit):
+    diversify = diversity.enabled()
+    depth = diversity.candidate_depth(limit) if diversify else limit
+    num_candidates = max(num_candidates, depth)
+
+    documents = search_candidates(db, prepared, prompt_vector, num_candidates, depth, with_vectors=diversify)
+    if diversify:
+        return iter(diversity.mmr(prompt_vector, list(documents), limit))
+    return iter(documents)
+
+
+def search_candidates(db, prepared, prompt_vector, num_candidates, limit, with_vectors=False):
+    if prepared['backend'] == 'local':
+        return search_chunks_local(db, prepared, prompt_vector, limit, num_candidates, with_vectors)
+
+    vector_search_pipeline = build_vector_search_pipeline(prompt_vector, num_candidates, limit, prepared['filter'])
+    try:
+        if 'partitions' in prepared:
+            return search_partitions(db, prepared['partitions'], vector_search_pipeline, prompt_vector, limit, with_vectors)
+        cursor = db[prepared['collection']].aggregate(vector_search_pipeline)
+    except OperationFailure:
+        if not config.get_setting("retrieval", "fallback_to_local", False):
+            raise
+        return search_chunks_local(db, prepared, prompt_vector, limit, num_candidates, with_vectors)
+
+    if quantization.enabled():
+        return quantization.rescore(prompt_vector, list(cursor), limit, keep_vectors=with_vectors)
+    return cursor
+
+
+# runs the same $vectorSearch on every partition in parallel and keeps the overall top `limit`
+def search_partitions(db, partition_names, vector_search_pipeline, prompt_vector, limit, with_vectors=False):
+    def search_partition(name):
+        return list(db[name].aggregate(vector_search_pipeline))
+
+    if len(partition_names) == 1:
+        results = search_partition(partition_names[0])
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(partition_names), config.get_setting("retrieval", "partition_workers", 4))) as executor:
+            results = [document for partition in executor.map(search_partition, partition_names) for document in partition]
+
+    if quantization.enabled():
+        return quantization.rescore(prompt_vector, results, limit, keep_vectors=with_vectors)
+    return sorted(results, key=lambda document: document['score'], reverse=True)[:limit]
+
+
+# exact search, unless [candidates] is enabled in which case numCandidates rows are rescored (see quantization.py)
+def search_chunks_local(db, prepared, prompt_vector, limit, num_candidates=None, with_vectors=False):
+    index = local_index.get_local_index(db)
+    rows = prepared.get('rows')
+    if rows is None:
+        rows = index.filter_rows(prepared['start_date'], prepared['end_date'], prepared['iso'])
+    return index.search_rows(prompt_vector, rows, limit, num_candidates, with_vectors)
+
+
+# returns the chunks that best match the prompt vector within the date range / ISO
+def search_chunks(db, prompt_vector, start_date, end_date, iso, num_candidates, limit):
+    prepared = prepare_search(db, start_date, end_date, iso)
+    return run_search(db, prepared, prompt_vector, num_candidates, limit)
+
+
+def run_search(db, prepared, prompt_vector, num_candidates, limit):
+    with metrics.span("search") as span:
+        chunked_docs = list(iter_search(db, prepared, prompt_vector, num_candidates, limit))
+        span['chunks'] = len(chunked_docs)
+    metrics.add(chunks=len(chunked_docs))
+    return chunked_docs
+
+
+############################################################################################### Parent Child Option/Functionality ##################################################################################################################
+
+# parents ({_id, source, contents}) are returned in the rank order of their best chunk
+def fetch_parent_docs(db, chunked_docs):
+    with metrics.span("parents") as span:
+        non_chunked_ids = []
+        for document in chunked_docs:
+            non_chunked_id = ObjectId(document['semi_chunked_id'])
+            if non_chunked_id not in non_chunked_ids:
+                non_chunked_ids.append(non_chunked_id)
+
+        # popular parents are served from the in-process cache; only the missing ids go to Mongo, in one query (see parent_cache.py)
+        cache = parent_cache.get_parent_cache() if parent_cache.enabled() else None
+        found = cache.get_many(non_chunked_ids) if cache is not None else {}
+        missing_ids = [_id for _id in non_chunked_ids if _id not in found]
+        span['cached'] = len(found)
+        span['fetched'] = len(missing_ids)
+
+        if missing_ids:
+            non_chunked_query = {"_id": {"$in": missing_ids}}
+            non_chunked_project = {"_id": 1, "contents": 1, "source": 1}
+
+            fetched = list(db.NonChunked.find(non_chunked_query, non_chunked_project))
+            if cache is not None:
+                cache.put_many(fetched)
+            for doc in fetched:
+                found[doc["_id"]] = {"source": doc["source"], "contents": doc["contents"]}
+
+        non_chunked_docs = [{'_id': _id, **found[_id]} for _id in non_chunked_ids if _id in found]
+
+        # local / lexical index hits carry ids only; context_builder trims parents to the chunk texts and context_ref
+        # keeps only chunks with contents, so theirs are looked up here (filled in on the hits)
+        without_contents = [document for document in chunked_docs if 'contents' not in document]
+        if without_contents:
+            chunk_query = {"_id": {"$in": [ObjectId(document['_id']) for document in without_contents]}}
+            contents = {str(doc["_id"]): doc["contents"] for doc in db.Chunked.find(chunk_query, {"_id": 1, "contents": 1})}
+            for document in without_contents:
+                if str(document['_id']) in contents:
+                    document['contents'] = contents[str(document['_id'])]
+            span['chunk_contents'] = len(contents)
+
+    metrics.add(parent_docs=len(non_chunked_docs))
+    return non_chunked_docs
+
+
+def build_context(non_chunked_docs):
+    with metrics.span("context", documents=len(non_chunked_docs)) as span:
+        context = ""
+        for doc in non_chunked_docs:
+            context += doc["source"] + "\n" + doc["contents"] + "\n\n"
+        span['characters'] = len(context)
+    return context
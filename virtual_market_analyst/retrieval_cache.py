@@ -0,0 +1,207 @@
+import time
+import array
+import logging
+import threading
+from collections import OrderedDict
+
+from pymongo.errors import PyMongoError
+
+import config
+import retrieval
+import diversity
+import partitions
+import parent_cache
+import quantization
+import lexical_index
+import embedding_cache
+
+logger = logging.getLogger(__name__)
+
+# Cache of retrieval pipeline results (prompt vector, chunks and the parent docs from NonChunked), shared by every session.
+# Only the prompt vector (as float32) and the chunks are stored; the parent docs are resolved again on every hit, mostly
+# from the parent cache (see parent_cache.py), so each entry stays a few KB instead of a 3072 float list plus whole parents.
+#
+# Entries are keyed on (prompt hash, start_date, end_date, iso, limit, numCandidates, lexical_fast_path) plus every setting
+# that changes what the pipeline returns (see retrieval_settings), and are dropped as soon as new documents land in Chunked
+# or NonChunked inside the cached date window. Both collections carry the commentary `date`.
+#
+# Invalidation modes ([retrieval_cache] invalidation = "...")
+#   watermark     --> the newest _id in Chunked / NonChunked within the window is stored with each entry and compared on lookup.
+#                     The watermark itself is re-read at most every watermark_refresh_seconds, so repeated searches
+#                     within that interval skip Mongo entirely.
+#   change_stream --> a background change stream on the two collections drops the affected windows as documents arrive
+#                     (needs a replica set, which Atlas always is); changed NonChunked documents are dropped from the
+#                     parent cache as well
+#
+# [retrieval_cache]
+# enabled = true
+# invalidation = "watermark"
+# watermark_refresh_seconds = 60
+# max_entries = 1000
+
+INVALIDATION_MODES = ('watermark', 'change_stream')
+
+
+# the settings results depend on, so a changed setting never serves results retrieved under the old one
+def retrieval_settings():
+    return (
+        retrieval.get_retrieval_backend(),
+        retrieval.get_retrieval_mode(),
+        partitions.enabled(),
+        lexical_index.hybrid_enabled() and (
+            config.get_setting("hybrid", "candidates", 50),
+            config.get_setting("hybrid", "rrf_k", 60),
+            config.get_setting("hybrid", "max_keyword_terms", 4)
+        ),
+        diversity.enabled() and (
+            config.get_setting("diversity", "lambda", 0.7),
+            config.get_setting("diversity", "max_per_parent", 1),
+            config.get_setting("diversity", "candidate_multiplier", 5)
+        ),
+        quantization.enabled() and (
+            quantization.get_quantization(),
+            config.get_setting("candidates", "dimensions", 512),
+            config.get_setting("candidates", "vector_path", "vector_short")
+        )
+    )
+
+
+def window_watermark(db, start_date, end_date):
+    date_query = {"date": {"$gte": retrieval.to_datetime(start_date), "$lte": retrieval.to_datetime(end_date)}}
+
+    watermark = []
+    for collection_name in ("Chunked", "NonChunked"):
+        newest = db[collection_name].find_one(date_query, {"_id": 1}, sort=[("_id", -1)])
+        watermark.append(None if newest is None else newest["_id"])
+    return tuple(watermark)
+
+
+class RetrievalCache:
+    def __init__(self, invalidation, watermark_refresh_seconds, max_entries):
+        if invalidation not in INVALIDATION_MODES:
+            raise ValueError(f"Unknown retrieval cache invalidation '{invalidation}', expected one of {INVALIDATION_MODES}")
+
+        self.invalidation = invalidation
+        self.watermark_refresh_seconds = watermark_refresh_seconds
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        # key --> {'result', 'window', 'watermark'}, oldest used first
+        self.entries = OrderedDict()
+        # (start_date, end_date) --> (watermark, time it was read)
+        self.watermarks = {}
+
+        self.watcher = None
+        # bumped by every change stream invalidation, so results retrieved across an invalidation are not cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(user_prompt, start_date, end_date, iso, num_candidates, limit, lexical_fast_path=False):
+        prompt_hash = embedding_cache.cache_key(user_prompt, embedding_cache.EMBEDDING_MODEL)
+        return (prompt_hash, start_date, end_date, iso, limit, num_candidates, lexical_fast_path, retrieval_settings())
+
+    # the watermark for a window, re-read from Mongo only once it is older than watermark_refresh_seconds
+    def watermark(self, db, start_date, end_date):
+        if self.invalidation == 'change_stream':
+            self.start_watcher(db)
+            with self.lock:
+                return self.generation
+
+        window = (start_date, end_date)
+        with self.lock:
+            cached = self.watermarks.get(window)
+        if cached is not None and time.monotonic() - cached[1] < self.watermark_refresh_seconds:
+            return cached[0]
+
+        watermark = window_watermark(db, start_date, end_date)
+        with self.lock:
+            self.watermarks[window] = (watermark, time.monotonic())
+        return watermark
+
+    def get(self, key, watermark):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.invalidation == 'watermark' and entry['watermark'] != watermark:
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            prompt_vector, chunked_docs = entry['result']
+
+        return {'prompt_vector': None if prompt_vector is None else prompt_vector.tolist(), 'chunked_docs': chunked_docs}
+
+    # keeps the prompt vector and the chunks of a pipeline result, not its parent docs
+    def put(self, key, watermark, result):
+        prompt_vector = None if result['prompt_vector'] is None else array.array('f', result['prompt_vector'])
+        with self.lock:
+            if self.invalidation == 'change_stream' and watermark != self.generation:
+                return
+            self.entries[key] = {'result': (prompt_vector, result['chunked_docs']), 'window': (key[1], key[2]), 'watermark': watermark}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # drops every entry whose window contains the date (or everything when the date is unknown, e.g. for deletes)
+    def invalidate(self, date=None):
+        with self.lock:
+            self.generation += 1
+            for key in list(self.entries):
+                start_date, end_date = self.entries[key]['window']
+                if date is None or retrieval.to_datetime(start_date) <= date <= retrieval.to_datetime(end_date):
+                    del self.entries[key]
+
+    def start_watcher(self, db):
+        with self.lock:
+            if self.watcher is not None and self.watcher.is_alive():
+                return
+            self.watcher = threading.Thread(target=self.watch, args=(db,), name="retrieval-cache-watcher", daemon=True)
+            self.watcher.start()
+
+    def watch(self, db):
+        change_pipeline = [{"$match": {"ns.coll": {"$in": ["Chunked", "NonChunked"]}}}]
+        while True:
+            try:
+                with db.watch(change_pipeline, full_document='updateLookup') as stream:
+                    for change in stream:
+                        document = change.get('fullDocument') or {}
+                        self.invalidate(document.get('date'))
+                        if change['ns']['coll'] == "NonChunked" and 'documentKey' in change:
+                            parent_cache.get_parent_cache().invalidate([change['documentKey']['_id']])
+            except PyMongoError:
+                # anything could have changed while the stream was down
+                logger.warning("Retrieval cache change stream failed, restarting", exc_info=True)
+                self.invalidate()
+                parent_cache.get_parent_cache().invalidate()
+                time.sleep(5)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+# one cache per process, shared by every session
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def enabled():
+    return config.get_setting("retrieval_cache", "enabled", True)
+
+
+def get_retrieval_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = RetrievalCache(
+                config.get_setting("retrieval_cache", "invalidation", "watermark"),
+                config.get_setting("retrieval_cache", "watermark_refresh_seconds", 60),
+                config.get_setting("retrieval_cache", "max_entries", 1000)
+            )
+        return _cache
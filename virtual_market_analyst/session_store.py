@@ -0,0 +1,343 @@
+import json
+import time
+import uuid
+import sqlite3
+import datetime as dt
+import threading
+from collections import OrderedDict
+
+import streamlit as st
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+import config
+import history
+import prompts
+import retrieval
+import context_builder
+
+# Chatbot conversations kept outside session_state.
+#
+# Every message is stored once, as the plain text the analyst typed or ChatGPT answered. The CONTEXT block of a RAG turn is
+# not stored at all, only what it was built from (the parent / chunk ids, or the morning brief it came from); it is rebuilt
+# from those when a request still needs it in full (see history.py, keep_context_turns) and sent collapsed otherwise.
+# A session holds just its newest memory_messages in memory and reads older ones back from the store when they are shown.
+#
+# The session id is kept in the page URL (?session=...), so a reload or a redeploy picks the conversation back up. The same
+# URL open in two tabs (or on two replicas) shares the conversation: a message numbered by one is never overwritten by the
+# other, which reloads the newest messages and takes the next number instead.
+#
+# [session_store]
+# backend = "sqlite"                 --> "sqlite" (file next to the apps), "mongo" (ChatMessages / ChatSessions collections)
+#                                        or "memory"
+# path = "session_store.sqlite3"     --> relative to this directory
+# memory_messages = 20
+# ttl_days = 30                      --> conversations untouched for longer are deleted, all of their messages at once
+# purge_seconds = 3600               --> how often an append also deletes the expired conversations
+# max_memory_sessions = 1000         --> "memory" backend only, the least recently active conversations go first
+
+
+# raised by append() when another tab or replica already stored a message under the same sequence number
+class DuplicateMessageError(Exception):
+    pass
+
+
+# the stores delete idle conversations as part of an append, at most every `seconds`
+class PurgeTimer:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        self.purged_at = 0.0
+
+    def due(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.purged_at < self.seconds:
+                return False
+            self.purged_at = now
+            return True
+
+
+class MemorySessionStore:
+    def __init__(self, ttl_days, max_sessions, purge_seconds):
+        self.ttl_seconds = ttl_days * 86400
+        self.max_sessions = max_sessions
+        self.purge_timer = PurgeTimer(purge_seconds)
+        self.lock = threading.Lock()
+        # session id --> {'records', 'last_active'}, least recently active first
+        self.sessions = OrderedDict()
+
+    def append(self, session_id, record):
+        with self.lock:
+            session = self.sessions.setdefault(session_id, {'records': [], 'last_active': 0.0})
+            if any(existing['seq'] == record['seq'] for existing in session['records']):
+                raise DuplicateMessageError(session_id, record['seq'])
+            session['records'].append(record)
+            session['last_active'] = time.time()
+            self.sessions.move_to_end(session_id)
+
+            if self.purge_timer.due():
+                cutoff = time.time() - self.ttl_seconds
+                while self.sessions and next(iter(self.sessions.values()))['last_active'] < cutoff:
+                    self.sessions.popitem(last=False)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    # the newest `limit` records before sequence number `before`, oldest first
+    def load(self, session_id, before=None, limit=None):
+        with self.lock:
+            session = self.sessions.get(session_id, {'records': []})
+            records = [record for record in session['records'] if before is None or record['seq'] < before]
+        return records[-limit:] if limit else records
+
+
+class SqliteSessionStore:
+    def __init__(self, path, ttl_days, purge_seconds):
+        self.ttl_seconds = ttl_days * 86400
+        self.purge_timer = PurgeTimer(purge_seconds)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS messages (session_id TEXT, seq INTEGER, record TEXT, created_at REAL, PRIMARY KEY (session_id, seq))"
+        )
+        self.connection.commit()
+        self.purge()
+
+    def purge(self):
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM messages WHERE session_id IN (SELECT session_id FROM messages GROUP BY session_id HAVING MAX(created_at) < ?)",
+                (time.time() - self.ttl_seconds,)
+            )
+            self.connection.commit()
+
+    def append(self, session_id, record):
+        with self.lock:
+            try:
+                self.connection.execute(
+                    "INSERT INTO messages VALUES (?, ?, ?, ?)",
+                    (session_id, record['seq'], json.dumps(record), time.time())
+                )
+                self.connection.commit()
+            except sqlite3.IntegrityError:
+                self.connection.rollback()
+                raise DuplicateMessageError(session_id, record['seq']) from None
+        if self.purge_timer.due():
+            self.purge()
+
+    def load(self, session_id, before=None, limit=None):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT record FROM messages WHERE session_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (session_id, before if before is not None else 2 ** 62, limit or -1)
+            ).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+
+# messages in ChatMessages, one {_id: session id, last_active} document per conversation in ChatSessions; a conversation
+# idle for longer than the TTL is deleted with all of its messages
+class MongoSessionStore:
+    def __init__(self, db, ttl_days, purge_seconds):
+        self.ttl_seconds = ttl_days * 86400
+        self.purge_timer = PurgeTimer(purge_seconds)
+        self.collection = db.ChatMessages
+        self.sessions = db.ChatSessions
+        self.collection.create_index([('session_id', 1), ('seq', 1)], unique=True)
+        self.sessions.create_index('last_active')
+
+        # the TTL indexes on the messages this replaces deleted single messages, the old turns of conversations still in use
+        existing_indexes = self.collection.index_information()
+        for name in ('created_at_1', 'last_active_1'):
+            if name in existing_indexes:
+                self.collection.drop_index(name)
+                self.collection.aggregate([
+                    {'$group': {'_id': '$session_id', 'last_active': {'$max': '$created_at'}}},
+                    {'$merge': {'into': 'ChatSessions', 'whenMatched': 'keepExisting'}}
+                ])
+
+    def purge(self):
+        cutoff = dt.datetime.utcnow() - dt.timedelta(seconds=self.ttl_seconds)
+        stale = [session['_id'] for session in self.sessions.find({'last_active': {'$lt': cutoff}}, {'_id': 1})]
+        if stale:
+            self.collection.delete_many({'session_id': {'$in': stale}})
+            # one that came back to life in the meantime keeps its session document, its newest messages survive
+            self.sessions.delete_many({'_id': {'$in': stale}, 'last_active': {'$lt': cutoff}})
+
+    def append(self, session_id, record):
+        now = dt.datetime.utcnow()
+        try:
+            self.collection.insert_one({'session_id': session_id, 'created_at': now, **record})
+        except DuplicateKeyError:
+            raise DuplicateMessageError(session_id, record['seq']) from None
+        self.sessions.update_one({'_id': session_id}, {'$set': {'last_active': now}}, upsert=True)
+        if self.purge_timer.due():
+            self.purge()
+
+    def load(self, session_id, before=None, limit=None):
+        query = {'session_id': session_id}
+        if before is not None:
+            query['seq'] = {'$lt': before}
+        cursor = self.collection.find(query, {'_id': 0, 'session_id': 0, 'created_at': 0, 'last_active': 0}).sort('seq', -1)
+        if limit:
+            cursor = cursor.limit(limit)
+        return list(reversed(list(cursor)))
+
+
+# the CONTEXT block a RAG turn was answered from, rebuilt from the documents it referenced; None when they are gone
+def rebuild_context(db, context_ref):
+    if 'brief_id' in context_ref:
+        brief = db.MorningBrief.find_one({'_id': ObjectId(context_ref['brief_id'])}, {'context': 1})
+        return brief['context'] if brief is not None else None
+
+    non_chunked_docs = retrieval.fetch_parent_docs(db, [{'semi_chunked_id': parent_id} for parent_id in context_ref['parent_ids']])
+    if not non_chunked_docs:
+        return None
+    chunked_docs = []
+    if context_ref['chunk_ids']:
+        chunk_query = {'_id': {'$in': [ObjectId(chunk_id) for chunk_id in context_ref['chunk_ids']]}}
+        chunked_docs = list(db.Chunked.find(chunk_query, {'semi_chunked_id': 1, 'contents': 1}))
+    return context_builder.build_context(non_chunked_docs, chunked_docs)
+
+
+# what a context was built from, see rebuild_context()
+def context_ref(non_chunked_docs=None, chunked_docs=None, brief=None):
+    if brief is not None:
+        return {'brief_id': str(brief['_id'])}
+    return {
+        'parent_ids': [str(document['_id']) for document in non_chunked_docs],
+        'chunk_ids': [str(document['_id']) for document in chunked_docs if document.get('contents')]
+    }
+
+
+# Used from the script thread and, with [jobs] background on, from the job worker answering the newest turn (see jobs.py),
+# so everything that reads or changes the messages / contexts holds the lock.
+class Conversation:
+    def __init__(self, store, db, session_id, system_prompt, memory_messages):
+        self.store = store
+        self.db = db
+        self.session_id = session_id
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.memory_messages = memory_messages
+        self.lock = threading.RLock()
+
+        # seq --> CONTEXT text of RAG turns answered in this process, so the newest ones are not rebuilt
+        self.contexts = {}
+        self.reload()
+
+    # the newest records: {'seq', 'turn', 'role', 'content', 'context_ref'}
+    def reload(self):
+        with self.lock:
+            self.messages = self.store.load(self.session_id, limit=self.memory_messages)
+            self.next_seq = self.messages[-1]['seq'] + 1 if self.messages else 0
+            self.turns = self.messages[-1]['turn'] + 1 if self.messages else 0
+
+    # number of messages in the whole conversation, system prompt excluded
+    def __len__(self):
+        return self.next_seq
+
+    @property
+    def first_seq(self):
+        with self.lock:
+            return self.messages[0]['seq'] if self.messages else self.next_seq
+
+    def append(self, role, content, context=None, context_ref=None):
+        with self.lock:
+            while True:
+                turn = self.turns if role == 'user' else self.turns - 1
+                record = {'seq': self.next_seq, 'turn': turn, 'role': role, 'content': content, 'context_ref': context_ref}
+                try:
+                    self.store.append(self.session_id, record)
+                    break
+                except DuplicateMessageError:
+                    # another tab got there first; pick up its messages and number this one after them
+                    self.reload()
+            self.turns = turn + 1
+            self.next_seq += 1
+
+            self.messages.append(record)
+            if context is not None:
+                self.contexts[record['seq']] = context
+            while len(self.messages) > self.memory_messages:
+                self.contexts.pop(self.messages.pop(0)['seq'], None)
+
+    # the messages as shown on the page, from sequence number `start` on; older ones are read from the store
+    def output(self, start=0):
+        with self.lock:
+            records = [record for record in self.messages if record['seq'] >= start]
+            first_seq = self.first_seq
+        if start < first_seq:
+            older = self.store.load(self.session_id, before=first_seq)
+            records = [record for record in older if record['seq'] >= start] + records
+        return [{"role": record['role'], "content": record['content']} for record in records]
+
+    def context(self, record):
+        with self.lock:
+            if record['seq'] not in self.contexts:
+                self.contexts[record['seq']] = rebuild_context(self.db, record['context_ref'])
+            return self.contexts[record['seq']]
+
+    # the in-memory messages as ChatGPT sees them: the newest keep_context_turns + 1 RAG turns with their CONTEXT block
+    def input(self, keep_context_turns):
+        with self.lock:
+            user_turns = [record['turn'] for record in self.messages if record['role'] == 'user']
+            full_context_turns = set(user_turns[-(keep_context_turns + 1):])
+
+            messages = [self.system_message]
+            for record in self.messages:
+                content = record['content']
+                if record['context_ref'] is not None:
+                    if record['turn'] in full_context_turns:
+                        context = self.context(record)
+                    else:
+                        # sent collapsed from now on, so the text is no longer needed
+                        self.contexts.pop(record['seq'], None)
+                        context = None
+                    content = prompts.build_contextualized_prompt(context or "", content)
+                    if context is None:
+                        content = history.collapse_context(content)
+                messages.append({"role": record['role'], "content": content})
+
+            first_turn = self.messages[0]['turn'] if self.messages else self.turns
+            return messages, first_turn
+
+    # what to send for the next answer, optionally with a user message that is not part of the conversation yet
+    def request_messages(self, conversation_history, pending=None):
+        messages, first_turn = self.input(conversation_history.keep_context_turns)
+        if pending is not None:
+            messages.append(pending)
+        return conversation_history.messages_for_request(messages, first_turn)
+
+
+# one store per process, shared by every session
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_session_store(db):
+    global _store
+    with _store_lock:
+        if _store is None:
+            backend = config.get_setting("session_store", "backend", "sqlite")
+            ttl_days = config.get_setting("session_store", "ttl_days", 30)
+            purge_seconds = config.get_setting("session_store", "purge_seconds", 3600)
+            if backend == "mongo":
+                _store = MongoSessionStore(db, ttl_days, purge_seconds)
+            elif backend == "sqlite":
+                _store = SqliteSessionStore(config.get_path_setting("session_store", "path", "session_store.sqlite3"), ttl_days, purge_seconds)
+            else:
+                _store = MemorySessionStore(ttl_days, config.get_setting("session_store", "max_memory_sessions", 1000), purge_seconds)
+        return _store
+
+
+# the session id in the page URL, or a new one put there
+def session_id_from_url():
+    session_id = st.query_params.get("session")
+    if not session_id:
+        session_id = uuid.uuid4().hex
+        st.query_params["session"] = session_id
+    return session_id
+
+
+def open_conversation(db, session_id, system_prompt):
+    return Conversation(get_session_store(db), db, session_id, system_prompt, config.get_setting("session_store", "memory_messages", 20))
@@ -0,0 +1,52 @@
+import logging
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# chat models count a few extra tokens per message for the role / separators
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+_encoding_lock = threading.Lock()
+_encoding_loaded = False
+
+
+# tiktoken downloads its BPE file on first use, so offline (or without tiktoken installed) we fall back to ~4 characters per token
+def get_encoding():
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        if not _encoding_loaded:
+            _encoding_loaded = True
+            if tiktoken is not None:
+                try:
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    logger.warning("Could not load the tiktoken encoding (%s), estimating token counts instead", e)
+        return _encoding
+
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message):
+    return count_tokens(message['content']) + MESSAGE_OVERHEAD_TOKENS
+
+
+# the longest prefix of text within max_tokens
+def truncate_tokens(text, max_tokens):
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    encoded = encoding.encode(text, disallowed_special=())
+    if len(encoded) <= max_tokens:
+        return text
+    return encoding.decode(encoded[:max_tokens])
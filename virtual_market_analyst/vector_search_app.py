@@ -1,12 +1,17 @@
-import re
-import time
-import openai
+import os
+import uuid
 import calendar
 import datetime as dt
 import streamlit as st
-from bson import ObjectId
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
+
+import jobs
+import clients
+import metrics
+import prompts
+import pipeline
+import retrieval
+import bulk_search
+import morning_brief
 
 ######################################################################################################## Login / Authorization ###################################################################################3
 
@@ -55,31 +60,8 @@ else:
     # code moves on
 
    ########################################################################################## Declare Connections ########################################################################################3
-    # setting credentials for MongoDB and OpenAI
-    for key in ('uri', 'open_ai_api_key'):
-        if key not in st.session_state:
-            st.session_state[key] = ""
-
-    # Get secrets from Streamlit secrets
-    uri = st.secrets["mongodb"]["uri"]
-    openai_api_key = st.secrets["openai"]["api_key"]
-
-    # Set MongoDB client
-    client = MongoClient(uri, server_api=ServerApi('1'))
-    db = client.MarketCommentaries
-
-    # Set OpenAI API key
-    openai.api_key = openai_api_key
-
-    ########################################################################################################### Set Prompts ####################################################################################################
-
-    weather_prompt = f"Weather Prompt --> Please provide me with a commentary on weather developments that have occurred that could impact power or natural gas market. Weather developments of interest include those that relate to waves of oncoming or upcoming heat and or cold fronts. Other developments of interest include those that pertain to the increase or decrease of heating degree days, often referred to as 'HDDs', and/or the increase or decrease of cooling degree days, often referred to as 'CDDs'."
-    economic_prompt = f"Economic Prompt --> Please provide me with a commentary on economic developments that have occurred which could impact power or natural gas demand."
-    data_center_prompt = f"Data Center Prompt --> Please provide me with a commentary on data center developments that have occurred. Data center developments of interest are the annoucements of new planned investments and deals for power supply to data centers. Other areas of interest also include news on the progression of data center build outs or financings. Also of interest is news on how data centers can drive an increase in electricty demand."
-    lng_prompt = f"LNG Prompt --> Please provide me with a commentary on LNG developments that have occurred. LNG developments of interest include those pertaining to outages for export terminals ending, the volume of exports increasing, and progress on LNG terminals under development. Please exclude any commentary on LNG terminal outages being extended or occuring."
-    technicals_prompt = f"Market Technicals Prompt --> Please provide me with a commentary on technical developments that have occurred. Technical developments of interest include those relevant to market participant positioning such as investors, market participants, and speculators decreasing, covering, or adding to positions."
-    production_prompt = f"Production Prompt --> Please provide me with a commentary on the developments that impacted natural gas production."
-    storage_prompt = f"Storage Prompt --> Please provide me with a commentary on the developments that impacted the levels of natural gas in storage."
+    # MongoDB client is created once per process and shared by every rerun / session (see clients.py)
+    db = clients.get_db()
 
     ######################################################################################################### Take User Inputs ########################################################################################3
 
@@ -121,140 +103,98 @@ else:
     if 'end_date' not in st.session_state:
         st.session_state.end_date = eom
 
+    # identifies the session to the background job pool (see jobs.py)
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+
     if 'vector_search_submitted' not in st.session_state:
         st.session_state['vector_search_submitted'] = False
     
     if 'vector_search_completed' not in st.session_state:
         st.session_state['vector_search_completed'] = False
 
+    # the search itself, without touching the page, so it can also run on a job worker (see jobs.py)
+    def find_search_context(user_prompt, start_date, end_date, iso):
+        # canned prompts for the default window are usually precomputed by the morning brief job
+        brief = morning_brief.find_brief(db, prompts.canned_prompt_name(user_prompt), iso, start_date, end_date)
+        if brief is not None:
+            metrics.add(morning_brief_hits=1)
+            return brief['search_context']
+
+        # embed the prompt, pre-filter on date / ISO, vector search and look up the parent docs (see pipeline.py)
+        results = pipeline.retrieve(db, user_prompt, start_date, end_date, iso, num_candidates=500, limit=10, lexical_fast_path=True)
+        return retrieval.build_context(results['non_chunked_docs'])
+
+    def search_job(job, user_prompt, start_date, end_date, iso):
+        return find_search_context(user_prompt, start_date, end_date, iso)
+
     # Callback function to run the vector search
     def run_vector_search():
         # checking if the data is accurately submitted
         if not st.session_state.user_prompt or not st.session_state.start_date or not st.session_state.end_date:
             st.error("Please select a Start Date, End Date, ISO, and a request for the query.")
+        elif jobs.background_enabled():
+            # the page polls the job below instead of waiting here
+            try:
+                job = jobs.get_job_pool().submit(
+                    "vector_search",
+                    search_job,
+                    st.session_state.user_prompt,
+                    st.session_state.start_date,
+                    st.session_state.end_date,
+                    st.session_state.iso,
+                    owner=st.session_state.session_id,
+                    attributes={'iso': st.session_state.iso, 'start_date': st.session_state.start_date, 'end_date': st.session_state.end_date}
+                )
+                st.session_state.search_job_id = job.id
+            except jobs.QueueFullError as e:
+                st.error(str(e))
         else:
             # contuing with search if accurately submitted
-            
-            prompt_vector = openai.embeddings.create(
-                input=st.session_state.user_prompt,
-                model="text-embedding-3-large"
-            )
 
-            prompt_vector = prompt_vector.data[0].embedding
-
-            # prepping the data for a vector search (can only run match as the first stage of an aggregation pipeline)
-            def data_prep_aggregation_framework(collection_name):
-                collection = db[collection_name]
-
-                # need this step b/c streamlit start_date and end_date are DATE objects NOT DATETIME objects which MongoDB needs
-                start_date = dt.datetime.combine(st.session_state.start_date, dt.datetime.min.time())
-                end_date = dt.datetime.combine(st.session_state.end_date, dt.datetime.min.time())
-                iso = st.session_state.iso
-                iso = iso.lower()
-
-                match_stage_a = {
-                    "$match": {
-                        "date": {
-                            "$gte": start_date,
-                            "$lte": end_date
-                        }
-                    }
-                }
-
-                
-                if iso != "n/a" :
-                    match_stage_b = {
-                        "$match": {
-                            "tags": {
-                                "$in": [iso]
-                            }
-                        }
-                    }
-                else:
-                    match_stage_b = {
-                        "$match": {}
-                    }           
-          
-                data_prep_pipeline = [
-                    match_stage_a,
-                    match_stage_b,
-                ]
-
-                return data_prep_pipeline
-
-            def update_collection_with_pipeline(source_collection_name, target_collection_name):
-                data_prep_pipeline = data_prep_aggregation_framework(source_collection_name)
-                new_documents = db[source_collection_name].aggregate(data_prep_pipeline)
-                new_documents = list(new_documents)
-
-                # Remove all documents from the target collection
-                db[target_collection_name].delete_many({})
-
-                # Insert new documents into the target collection
-                if len(new_documents) > 0:
-                    db[target_collection_name].insert_many(new_documents)
-                else:
-                    pass
-
-            update_collection_with_pipeline("Chunked", "TemporaryChunked")
-            #update_collection_with_pipeline("NonChunked", "TemporaryNonChunked")
-
-            vector_search_stage = {
-                '$vectorSearch': {
-                    'index': 'vector_index', 
-                    'path': 'vector', 
-                    'queryVector': prompt_vector,
-                    'numCandidates': 500,
-                    'limit': 10
-                }
-            }
-
-            # semi_chunked_id = 1 if using parent/child approach 0 otherwise
-            # option see vector_Search score --> 'score': {'$meta': 'vectorSearchScore'},
-            project_stage = {
-                '$project': {
-                    '_id': 0, 
-                    'source': 1,
-                    'contents': 1,
-                    'semi_chunked_id': 1 
-                }
-            }
-
-            vector_search_pipeline = [
-                vector_search_stage,
-                project_stage
-            ]
-
-            time.sleep(90)
-            #time.sleep(15)
-
-
-            chunked_docs = db.TemporaryChunked.aggregate(vector_search_pipeline)
-            #chunked_docs = db.Chunked.aggregate(vector_search_pipeline) # used for testing
-            #non_chunked_docs = db.TemporaryNonChunked.aggregate(vector_search_pipeline)
-
-            ############################################################################################### Parent Child Option/Functionality ##################################################################################################################
-
-            non_chunked_ids = []
-            for document in chunked_docs:
-                non_chunked_id = document['semi_chunked_id']
-                non_chunked_ids.append(non_chunked_id)
-
-            non_chunked_ids = list(set(non_chunked_ids))
-            non_chunked_ids = [ObjectId(_id) for _id in non_chunked_ids]
-
-            non_chunked_query = {"_id": {"$in": non_chunked_ids}}
-            non_chunked_project = {"_id":0, "contents":1, "source":1}
-
-            non_chunked_docs = db.NonChunked.find(non_chunked_query,non_chunked_project)
-            non_chunked_docs = list(non_chunked_docs)
-
-            context = ""
-            for doc in non_chunked_docs:
-                context += doc["source"] + "\n" + doc["contents"] + "\n\n"
+            # times every stage of this query (see metrics.py)
+            trace = metrics.start_trace("vector_search", iso=st.session_state.iso, start_date=st.session_state.start_date, end_date=st.session_state.end_date)
 
+            context = find_search_context(st.session_state.user_prompt, st.session_state.start_date, st.session_state.end_date, st.session_state.iso)
             st.write(f"Search Results Below:\n\n{context}")
 
+            metrics.finish_trace(trace)
+            if metrics.debug_panel_enabled():
+                metrics.display_debug_panel(trace)
+
+    # state_key is the session_state entry holding the job id; a job that has already started is polled until it stops
+    def cancel_job(job_id, state_key):
+        pool = jobs.get_job_pool()
+        pool.cancel(job_id)
+        job = pool.get(job_id)
+        if job is None or job.finished:
+            st.session_state.pop(state_key, None)
+
+    # polls the job while the rest of the page stays idle; a full rerun picks up the finished job
+    @st.experimental_fragment(run_every=1)
+    def show_job_progress(job_id, state_key):
+        pool = jobs.get_job_pool()
+        job = pool.get(job_id)
+        if job is None or job.finished:
+            st.rerun()
+
+        st.write(jobs.describe_progress(pool, job))
+        st.button("Cancel", on_click=cancel_job, args=(job_id, state_key), key=f"cancel_{state_key}")
+
+    if 'search_job_id' in st.session_state:
+        search_job_pool = jobs.get_job_pool()
+        running_search = search_job_pool.get(st.session_state.search_job_id)
+        if running_search is not None and not running_search.finished:
+            show_job_progress(running_search.id, 'search_job_id')
+        else:
+            del st.session_state['search_job_id']
+            if running_search is not None and running_search.state == 'done':
+                st.write(f"Search Results Below:\n\n{running_search.result}")
+                if metrics.debug_panel_enabled():
+                    metrics.display_debug_panel(running_search.trace)
+            elif running_search is not None and running_search.state == 'failed':
+                st.error("Something went wrong while searching, please try again.")
+
     # Display the series of data requests/options for the RAG
     with st.form("vector_search"):
         
@@ -264,14 +204,103 @@ else:
 
         st.write("")
         st.write("Please select the ISO for which you would like your response to be grounded if applicable.")
-        isos = ['N/A','ERCOT','NYISO','PJM','MISO']
+        isos = retrieval.ISOS
         iso = st.radio("ISOs:", options=isos, index=isos.index(st.session_state.iso), horizontal=False, key='iso')
         st.write("")
 
         with st.expander("Click to see some search ideas"):
-            st.write(f"{weather_prompt}\n\n{economic_prompt}\n\n{data_center_prompt}\n\n{lng_prompt}\n\n{technicals_prompt}\n\n{production_prompt}\n\n{storage_prompt}")
+            st.write("\n\n".join(prompts.CANNED_PROMPTS.values()))
 
         st.write("Please write your query for the Vector Search.")
         st.text_area("Type Below:", height=250, key="user_prompt")
         
         st.form_submit_button("Submit", on_click=run_vector_search)
+
+
+    ######################################################################################################### Bulk Search ########################################################################################3
+
+    # a file of queries searched in one go, every hit written to a JSONL / Parquet file to download (see bulk_search.py)
+    def bulk_job(job, queries, path, output_format):
+        def progress(done, total, failed):
+            job.status = f"{done} of {total} queries searched, {failed} failed"
+
+        return bulk_search.run_bulk(db, queries, path, output_format, progress=progress, check_cancelled=job.check_cancelled)
+
+    def run_bulk_search():
+        uploaded = st.session_state.bulk_file
+        if uploaded is None:
+            st.error("Please upload a CSV or JSONL file of queries.")
+            return
+        try:
+            queries = bulk_search.parse_queries(
+                uploaded.getvalue(), uploaded.name, st.session_state.start_date, st.session_state.end_date, st.session_state.iso
+            )
+        except bulk_search.BulkInputError as e:
+            st.error(f"The file could not be read:\n\n{e}")
+            return
+
+        output_format = st.session_state.bulk_format
+        path = bulk_search.output_path(output_format)
+        # kept even if the run is cancelled or fails, what was written so far can still be downloaded
+        st.session_state.bulk_output = {'path': path, 'format': output_format, 'summary': None, 'data': None}
+
+        if jobs.background_enabled():
+            try:
+                job = jobs.get_job_pool().submit(
+                    "bulk_search",
+                    bulk_job,
+                    queries,
+                    path,
+                    output_format,
+                    # its own owner, so a long bulk run does not hold up single searches
+                    owner=f"{st.session_state.session_id}:bulk",
+                    attributes={'queries': len(queries), 'format': output_format}
+                )
+                st.session_state.bulk_job_id = job.id
+            except jobs.QueueFullError as e:
+                st.session_state.pop('bulk_output', None)
+                os.remove(path)
+                st.error(str(e))
+        else:
+            bar = st.progress(0.0)
+            st.session_state.bulk_output['summary'] = bulk_search.run_bulk(
+                db, queries, path, output_format,
+                progress=lambda done, total, failed: bar.progress(done / total, text=f"{done} of {total} queries searched, {failed} failed")
+            )
+            st.session_state.bulk_output['data'] = bulk_search.take_output(path)
+
+    if 'bulk_job_id' in st.session_state:
+        bulk_job_pool = jobs.get_job_pool()
+        running_bulk = bulk_job_pool.get(st.session_state.bulk_job_id)
+        if running_bulk is not None and not running_bulk.finished:
+            show_job_progress(running_bulk.id, 'bulk_job_id')
+        else:
+            del st.session_state['bulk_job_id']
+            if running_bulk is not None and running_bulk.state == 'done':
+                st.session_state.bulk_output['summary'] = running_bulk.result
+            elif running_bulk is not None and running_bulk.state == 'failed':
+                st.error("Something went wrong during the bulk search, the results so far can still be downloaded.")
+            # read once into the session and the file removed, instead of re-reading it on every rerun
+            if os.path.exists(st.session_state.bulk_output['path']):
+                st.session_state.bulk_output['data'] = bulk_search.take_output(st.session_state.bulk_output['path'])
+
+    bulk_output = st.session_state.get('bulk_output')
+    if bulk_output is not None and bulk_output['data'] is not None:
+        summary = bulk_output['summary']
+        if summary is not None:
+            st.write(f"Bulk search finished: {summary['done']} queries, {summary['failed']} failed, {summary['rows']} results.")
+        st.download_button(
+            "Download bulk search results",
+            data=bulk_output['data'],
+            file_name=f"bulk_search_results.{bulk_output['format']}",
+            mime="application/vnd.apache.parquet" if bulk_output['format'] == 'parquet' else "application/x-ndjson"
+        )
+
+    with st.expander("Bulk search: run a file of queries"):
+        st.write(
+            "Upload a CSV or JSONL file with a `query` column and, optionally, `start_date`, `end_date` (YYYY-MM-DD) and `iso`. "
+            "Rows without them use the dates and ISO selected above."
+        )
+        st.file_uploader("Queries", type=["csv", "jsonl", "ndjson", "json"], key="bulk_file")
+        st.radio("Output format:", options=bulk_search.available_formats(), horizontal=True, key="bulk_format")
+        st.button("Run bulk search", on_click=run_bulk_search, disabled='bulk_job_id' in st.session_state)